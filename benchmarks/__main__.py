@@ -0,0 +1,315 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# builds the layouts in 'benchmarks/corpus' with each set of formats, records
+# how long each stage took and the peak memory, and compares them (and the
+# fingerprint of the plates) with a baseline saved by an earlier run:
+#
+#   python -m benchmarks -o baseline.json
+#   python -m benchmarks -b baseline.json
+#
+# '-t' also exports the meshes with each tessellation tolerance and prints
+# their triangles, size and export time:
+#
+#   python -m benchmarks -s dxf -t 0.5,0.1,0.02
+from __future__ import print_function
+
+import argparse
+import collections
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from config import config as cfg
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# the request options added to every layout for each set of formats
+FORMAT_SETS = collections.OrderedDict([
+    ('2d', {'engine': '2d', 'formats': ['dxf', 'svg', 'json']}),
+    ('dxf', {'formats': ['dxf']}),
+    ('default', {}),
+    ('all', {'formats': cfg['app']['formats']}),
+])
+
+# the tessellated formats exported by the sets of '--tolerances'
+MESH_FORMATS = ['preview', 'glb', 'stl']
+
+
+# a set of formats for each tolerance in mm, exporting the meshes with it
+def tolerance_sets(tolerances):
+    return collections.OrderedDict(
+        ('mesh-%s' % tolerance, {'formats': MESH_FORMATS,
+                                 'mesh_tolerance': float(tolerance)})
+        for tolerance in tolerances)
+
+
+def load_corpus(names=None):
+    corpus = collections.OrderedDict()
+    for filename in sorted(os.listdir(CORPUS)):
+        name, ext = os.path.splitext(filename)
+        if ext == '.json' and (not names or name in names):
+            with open(os.path.join(CORPUS, filename)) as corpus_file:
+                corpus[name] = json.load(corpus_file)
+    return corpus
+
+
+# the peak resident memory in bytes of this process ('self') or of the
+# processes it waited for ('children'), the export processes
+def peak_rss(who):
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else
+                               resource.RUSAGE_CHILDREN)
+    # linux reports kilobytes, os x bytes
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p*(len(values) - 1))))]
+
+
+# build 'data' once in a fresh process with empty caches.  runs in the
+# benchmark pool, so the peak memory is only that of this build.
+def run(name, data):
+    tmp = tempfile.mkdtemp(prefix='kb_bench_')
+    try:
+        config = copy.deepcopy(cfg)
+        for path in ('static', 'export', 'cache', 'blanks', 'layers'):
+            config['app'][path] = os.path.join(tmp, path)
+        config['app']['pwd'] = tmp
+        os.makedirs(config['app']['export'])
+        start = time.time()
+        from lib import builder
+        import_seconds = time.time() - start
+        start = time.time()
+        result = builder.build(name, data, config, fingerprint=True)
+        seconds = time.time() - start
+        # the export processes are kept for the next build, they only count
+        # towards the peak memory of the children once they exited
+        if builder.fan_out:
+            builder.fan_out.close()
+            builder.fan_out = None
+        # the size and triangles of every file, the lazy ones were not
+        # exported
+        files = []
+        for label, exports in sorted(result['exports'].items()):
+            for export in exports:
+                path = tmp + export['url']
+                if os.path.exists(path):
+                    files.append([label, export['name'],
+                                  os.path.getsize(path),
+                                  export.get('triangles')])
+    finally:
+        shutil.rmtree(tmp)
+    timings = result['timings']
+    # the CAD stack is imported by the build itself, which is left out of
+    # 'seconds' so it is the same whether the libraries were loaded or not
+    cad_seconds = builder.cad_seconds or 0
+    return {
+        'seconds': round(seconds - cad_seconds, 4),
+        'imports': {'builder': round(import_seconds, 4),
+                    'cad': round(cad_seconds, 4)},
+        'stages': timings['stages'],
+        'operations': dict((operation, {
+            'count': len(samples),
+            'sum': round(sum(samples), 4),
+            'p50': percentile(samples, 0.5),
+            'max': max(samples),
+        }) for operation, samples in timings['samples'].items()),
+        'exports': timings['exports'],
+        'files': files,
+        'fingerprint': result['fingerprint'],
+        'peak_rss': peak_rss('self'),
+        'peak_export_rss': peak_rss('children'),
+    }
+
+
+# run every layout with every set of formats 'repeat' times and keep the
+# fastest run of each
+def bench(corpus, format_sets, repeat):
+    runs = collections.OrderedDict()
+    for name, data in corpus.items():
+        for set_name in format_sets:
+            data_set = dict(data, **FORMAT_SETS[set_name])
+            key = '%s/%s' % (name, set_name)
+            best = None
+            for i in range(repeat):
+                worker = multiprocessing.Pool(1, maxtasksperchild=1)
+                try:
+                    measured = worker.apply(run, (key.replace('/', '_'),
+                                                  data_set))
+                finally:
+                    worker.close()
+                    worker.join()
+                if best is None or measured['seconds'] < best['seconds']:
+                    best = measured
+            runs[key] = best
+            print('%-28s %8.3fs %8.1f MB  import=%.3f cad=%.3f %s' % (
+                key, best['seconds'], best['peak_rss']/1048576.0,
+                best['imports']['builder'], best['imports']['cad'],
+                ' '.join('%s=%.3f' % stage
+                         for stage in sorted(best['stages'].items()))))
+    return runs
+
+
+# how the tolerance trades the triangles and the size of each mesh format
+# against its export time, added up over the layers
+def print_tolerances(runs, tolerance_names):
+    print('\n%-28s %-8s %10s %10s %9s' % ('tolerance', 'format', 'triangles',
+                                         'KB', 'seconds'))
+    for key, run in runs.items():
+        if key.partition('/')[2] not in tolerance_names:
+            continue
+        for name in MESH_FORMATS:
+            files = [f for f in run['files'] if f[1] == name]
+            print('%-28s %-8s %10d %10.1f %9.3f' % (
+                key, name, sum(f[3] or 0 for f in files),
+                sum(f[2] for f in files)/1024.0,
+                sum(e[2] for e in run['exports'] if e[1] == name)))
+
+
+def same(a, b, tolerance=1e-6):
+    return abs(a - b) <= tolerance*max(1.0, abs(a), abs(b))
+
+
+# the differences between 'runs' and the 'baseline' runs which are worse than
+# the thresholds, and the runs whose fingerprint changed
+def compare(runs, baseline, threshold, min_seconds, rss_threshold):
+    problems = []
+    for key, run in runs.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        for field in ('cutouts', 'area', 'volume'):
+            if not same(run['fingerprint'][field],
+                        base['fingerprint'][field]):
+                problems.append('%s: %s changed from %s to %s' % (
+                    key, field, base['fingerprint'][field],
+                    run['fingerprint'][field]))
+        times = [('total', run['seconds'], base['seconds'])]
+        times.extend((stage, seconds, base['stages'][stage])
+                     for stage, seconds in sorted(run['stages'].items())
+                     if stage in base['stages'])
+        times.extend(('import_%s' % name, seconds, base['imports'][name])
+                     for name, seconds in sorted(run['imports'].items())
+                     if name in base.get('imports', {}))
+        for stage, seconds, before in times:
+            if seconds > before*(1 + threshold) and \
+                    seconds - before > min_seconds:
+                problems.append('%s: %s took %.3fs, was %.3fs (+%.0f%%)' % (
+                    key, stage, seconds, before,
+                    100.0*(seconds - before)/max(before, 1e-9)))
+        if run['peak_rss'] > base['peak_rss']*(1 + rss_threshold):
+            problems.append('%s: peak memory %.1f MB, was %.1f MB' % (
+                key, run['peak_rss']/1048576.0, base['peak_rss']/1048576.0))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument(
+        '-l', '--layouts',
+        help='Comma separated layouts of the corpus to build (Default: all '
+        'of %s)' % ', '.join(load_corpus()))
+    parser.add_argument(
+        '-s', '--format-sets',
+        default=','.join(FORMAT_SETS),
+        help='Comma separated sets of formats to export (Default: %s)' %
+        ','.join(FORMAT_SETS))
+    parser.add_argument(
+        '-t', '--tolerances',
+        help='Comma separated tessellation tolerances in mm to export the '
+        '%s meshes with, and compare' % ', '.join(MESH_FORMATS))
+    parser.add_argument(
+        '-r', '--repeat', default=1, type=int,
+        help='Build each layout this many times and keep the fastest '
+        '(Default: 1)')
+    parser.add_argument(
+        '--cut-mode', choices=('batch', 'single'),
+        default=cfg['app']['cut_mode'],
+        help='Cut all the openings at once or one by one (Default: %s)' %
+        cfg['app']['cut_mode'])
+    parser.add_argument('-o', '--output', help='Save the results as JSON.')
+    parser.add_argument(
+        '-b', '--baseline', help='Compare with the results of an earlier run.')
+    parser.add_argument(
+        '--threshold', default=0.2, type=float,
+        help='How much slower a stage can get before it is a regression '
+        '(Default: 0.2 for 20%%)')
+    parser.add_argument(
+        '--min-seconds', default=0.05, type=float,
+        help='Ignore slowdowns smaller than this many seconds (Default: '
+        '0.05)')
+    parser.add_argument(
+        '--rss-threshold', default=0.2, type=float,
+        help='How much more memory a build can use before it is a regression '
+        '(Default: 0.2 for 20%%)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    cfg['app']['cut_mode'] = args.cut_mode
+
+    corpus = load_corpus(args.layouts and args.layouts.split(','))
+    format_sets = args.format_sets.split(',')
+    for set_name in format_sets:
+        if set_name not in FORMAT_SETS:
+            parser.error('Unknown format set: %s' % set_name)
+    try:
+        tolerances = tolerance_sets(args.tolerances.split(',')
+                                    if args.tolerances else [])
+    except ValueError:
+        parser.error('The tolerances have to be numbers')
+    FORMAT_SETS.update(tolerances)
+    format_sets.extend(tolerances)
+    if not corpus:
+        parser.error('No layouts to build')
+
+    runs = bench(corpus, format_sets, args.repeat)
+    if tolerances:
+        print_tolerances(runs, tolerances)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'created': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cut_mode': cfg['app']['cut_mode'],
+                'runs': runs,
+            }, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            problems = compare(runs, json.load(baseline)['runs'],
+                               args.threshold, args.min_seconds,
+                               args.rss_threshold)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
 
 config = {}
@@ -24,8 +25,97 @@ config['app']['port'] = 80
 config['app']['pwd'] = os.path.dirname(__file__)
 config['app']['static'] = os.path.join(config['app']['pwd'], 'static')
 config['app']['export'] = os.path.join(config['app']['static'], 'exports')
-config['app']['formats'] = ['js', 'dxf', 'svg', 'brp', 'stp', 'stl', 'json']
-# ^ remove formats to speed up build time
+config['app']['cache'] = os.path.join(config['app']['pwd'], 'cache')
+# ^ manifests of finished builds, so a repeated request skips the build
+config['app']['blanks'] = os.path.join(config['app']['cache'], 'blanks')
+# ^ BREP files of the plates before any key is cut, shared by all the builds
+#   of the same size and case
+config['app']['blank_cache_size'] = 16
+# ^ number of blank plates each worker keeps in memory
+config['app']['layers'] = os.path.join(config['app']['cache'], 'layers')
+# ^ switch layers of previous builds, which a build naming one of them as its
+#   'base' only has to change instead of cutting every key again
+config['app']['export_quota'] = 10*1024**3
+# ^ bytes the exports, saved layers and manifests of all the builds can take
+#   before the least recently used builds are removed, 0 for no limit
+config['app']['export_index'] = os.path.join(config['app']['cache'],
+                                             'exports.db')
+# ^ SQLite index of the size and the last use of every build
+config['app']['precompress'] = ['js', 'dxf', 'svg', 'brp', 'stp', 'stl',
+                                 'json', 'preview', 'glb']
+# ^ formats written with a gzip (and with the brotli module a brotli) copy
+#   next to them, which is served to the browsers accepting it
+config['app']['precompress_min_size'] = 1024
+# ^ files smaller than this many bytes are not worth compressing
+config['app']['export_max_age'] = 365*24*3600
+# ^ seconds browsers can keep an export, they are named by the hash of the
+#   request so they never change
+config['app']['formats'] = ['preview', 'dxf', 'svg', 'brp', 'stp', 'stl',
+                             'glb', 'json']
+# ^ remove formats to speed up build time ('js', the three.js JSON the viewer
+#   used to load, can still be added)
+config['app']['lazy_formats'] = ['brp', 'stp', 'stl', 'glb']
+# ^ formats which are only exported when they are first downloaded, unless a
+#   request lists them in its 'formats'
+config['app']['mesh_tolerance'] = {'preview': [0.5, 30], 'glb': [0.05, 15],
+                                   'stl': [0.1, 30], 'js': [0.1, 30]}
+# ^ how far in mm the triangles of each tessellated format may be from the
+#   surface of a layer and how many degrees apart the normals of neighbouring
+#   triangles may be, for the 'preview' mesh the viewer loads first, the finer
+#   'glb' mesh, the STL and the three.js JSON.  a request can change them with
+#   'mesh_tolerance'.
+config['app']['mesh_min_tolerance'] = [0.01, 1]
+# ^ the smallest tolerance in mm and degrees a request can ask for
+config['app']['cut_mode'] = 'batch'
+# ^ 'batch' removes all the cutouts of a layer in one boolean cut, 'single'
+#   cuts every switch and stabilizer opening on its own
+config['app']['cut_tile'] = 0
+# ^ in 'batch' mode, the number of keys to cut at a time (0 for all at once)
+config['app']['workers'] = multiprocessing.cpu_count()
+# ^ number of build processes, each one draws a single layout at a time
+config['app']['worker_max_builds'] = 100
+# ^ a build worker is replaced by a fresh one after this many builds, 0 to
+#   keep it forever
+config['app']['worker_max_rss'] = 2*1024**3
+# ^ a build worker is replaced by a fresh one once it uses more than this many
+#   bytes of memory after a build, 0 for no limit
+config['app']['export_workers'] = 2
+# ^ number of processes each 3d build exports its layers and formats with at
+#   the same time (0 exports them one after the other in the build process).
+#   a pool of build workers gives each of them at most its share of the CPUs.
+config['app']['cost_weights'] = {
+    '3d': {'build': 0.5, 'cutout': 0.05, 'layer': 1.0,
+           'export': {'js': 0.02, 'preview': 0.004, 'dxf': 0.03,
+                      'svg': 0.03, 'brp': 0.005, 'stp': 0.03, 'stl': 0.02,
+                      'glb': 0.01, 'json': 0.0005}},
+    '2d': {'build': 0.005, 'cutout': 0.0006, 'layer': 0.002,
+           'export': {'dxf': 0.0002, 'svg': 0.0002, 'json': 0.00005}},
+}
+# ^ seconds a build starts from, plus for each cutout (a key or its
+#   stabilizer), each layer past the switch layer and for each format for
+#   every cutout and layer.  the scheduler runs the cheapest builds first and
+#   these weights follow the timings of the finished builds.
+config['app']['cost_model'] = os.path.join(config['app']['cache'],
+                                           'cost.json')
+# ^ the weights as they were calibrated by the finished builds
+config['app']['max_cost'] = 0
+# ^ builds estimated to take more seconds than this are refused with a 413, 0
+#   for no limit
+config['app']['client_jobs'] = 4
+# ^ builds a client can have queued or running at once, more are refused with
+#   a 429, 0 for no limit
+config['app']['build_timeout'] = 7200
+# ^ seconds a build can run before it is stopped, 0 for no limit
+config['app']['cancel_grace'] = 30
+# ^ seconds a cancelled or timed out build has to stop at one of its
+#   checkpoints before its worker is killed
+config['app']['job_ttl'] = 3600
+# ^ seconds a finished job can still be looked up at /jobs/<id>
+config['app']['admin_token'] = ''
+# ^ requests with this token in their 'X-Admin-Token' header can use the admin
+#   only options (like 'profile'), leave it empty to turn them off
+config['app']['profile_top'] = 20
+# ^ the number of hottest functions a profiled build adds to its result
 config['app']['debug'] = False
 config['app']['log'] = './kb_builder.log'
 
@@ -17,49 +17,367 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import lib.builder as builder
-import hashlib
+import hmac
 import json
 import logging
+import mimetypes
+import os
+import re
+import threading
 import time
 import tornado.gen
 import tornado.httpclient
 import tornado.ioloop
+import tornado.iostream
 import tornado.options
+import tornado.queues
 import tornado.web
 
 from config import config
+from lib import bundle
+from lib import compress
+from lib import metrics
+from lib.cache import ResultCache, digest
+from lib.jobs import JobManager, Rejected
+from lib.planner import plan
+from lib.pool import BuildError, BuildPool
+from lib.store import ExportStore
 
-builder_timeout = 7200
 
 logging.basicConfig()
 
+# the preview and glb meshes are binary glTF
+mimetypes.add_type('model/gltf-binary', '.glb')
+mimetypes.add_type('model/gltf-binary', '.preview')
+
+
+def hash_data(data):
+    return digest(data)
+
+
+# does the request carry the admin token
+def is_admin(request):
+    token = config['app']['admin_token']
+    return bool(token) and hmac.compare_digest(
+        request.headers.get('X-Admin-Token', ''), token)
+
+
+# take the build options out of the request 'data', they are not part of what
+# is built.  'profile' is only allowed for admins.
+def pop_options(handler, data):
+    options = {}
+    if data.pop('profile', False):
+        if not is_admin(handler.request):
+            raise tornado.web.HTTPError(403, "Profiling is only for admins")
+        options['profile'] = True
+    return options
+
+
+# answer a build the job manager refused to queue.  tornado does not know
+# the reason phrase of a 429.
+def refuse(handler, e):
+    logging.info("Refused a build: %s" % e)
+    handler.set_status(e.status, {413: 'Request Entity Too Large',
+                                  429: 'Too Many Requests'}.get(e.status))
+    if e.retry_after:
+        handler.set_header('Retry-After', e.retry_after)
+    handler.write({'error': str(e), 'cost': round(e.cost or 0, 1)})
+
 
 class IndexHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+        self.job = None
+
     def get(self):
         self.render('index.html')
 
     @tornado.gen.coroutine
     def post(self):
         data = json.loads(self.request.body)
-        data_hash = hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+        options = pop_options(self, data)
+        data_hash = hash_data(data)
         build_start = time.time()
         logging.info("Processing: %s" % (data_hash))
-        cad = builder.build(data_hash, data, config)
+        try:
+            job = self.jobs.submit(data_hash, data,
+                                   client=self.request.remote_ip, **options)
+        except Rejected as e:
+            refuse(self, e)
+            return
+        self.job = job
+        try:
+            cad = yield self.jobs.wait(job)
+        finally:
+            self.job = None
         logging.info("Finished: %s" % (data_hash))
         logging.info("Processing took: {0:.2f} seconds".format(time.time() -
                                                                build_start))
         self.write(cad)
 
+    # nobody is left to take the result, so the build is cancelled unless
+    # another request waits on it too
+    def on_connection_close(self):
+        if self.job:
+            self.jobs.leave(self.job)
+
 
-def make_app():
+# start a build and return right away with the id to follow it by
+class JobsHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    def post(self):
+        data = json.loads(self.request.body)
+        options = pop_options(self, data)
+        data_hash = hash_data(data)
+        try:
+            job = self.jobs.submit(data_hash, data,
+                                   client=self.request.remote_ip, **options)
+        except Rejected as e:
+            refuse(self, e)
+            return
+        # the client comes back for it later, so it is not cancelled when
+        # this connection closes
+        job.kept = True
+        logging.info("Queued job %s: %s" % (job.id, data_hash))
+        self.set_status(202)
+        self.write({
+            'id': job.id,
+            'url': self.reverse_url('job', job.id),
+            'events': self.reverse_url('job-events', job.id),
+        })
+
+
+class JobHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job:
+            raise tornado.web.HTTPError(404)
+        self.write(job.status())
+
+
+# stream the events of a job to the browser as server-sent events
+class JobEventsHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+        self.job = None
+        self.queue = tornado.queues.Queue()
+
+    @tornado.gen.coroutine
+    def get(self, job_id):
+        self.job = self.jobs.get(job_id)
+        if not self.job:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # replay what already happened, then follow along
+        for event in self.job.events:
+            self.queue.put_nowait(event)
+        finished = self.job.is_finished()
+        if not finished:
+            self.job.subscribe(self.on_event)
+        try:
+            while not self.queue.empty() or not finished:
+                event, payload = yield self.queue.get()
+                if event is None:  # the client went away
+                    break
+                self.write('event: %s\ndata: %s\n\n' % (event,
+                                                         json.dumps(payload)))
+                yield self.flush()
+                finished = self.job.is_finished()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.job.unsubscribe(self.on_event)
+
+    def on_event(self, event, payload):
+        self.queue.put_nowait((event, payload))
+
+    def on_connection_close(self):
+        if self.job:
+            self.job.unsubscribe(self.on_event)
+        # wake up the loop so the handler can finish
+        self.queue.put_nowait((None, None))
+
+
+# the geometry of a request, worked out right away without building it
+class PlanHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    def post(self):
+        try:
+            data = json.loads(self.request.body)
+            result = plan(data, config)
+            result['cost'] = round(self.jobs.estimate(data)[0], 3)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logging.info("Invalid plan request: %r" % e)
+            self.set_status(400)
+            self.write({'error': 'invalid request: %r' % e})
+            return
+        self.write(result)
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    def get(self):
+        self.write(self.jobs.stats())
+
+
+# the build metrics for prometheus to scrape
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    def get(self):
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(self.jobs.render_metrics())
+
+
+# serves the static files and exports the formats a build only offered on
+# demand the first time they are downloaded.  an export is served from its
+# gzip or brotli copy to the browsers accepting it, and the exports named by
+# a request hash can be cached for good.
+class ExportFileHandler(tornado.web.StaticFileHandler):
+    # <layer>_<hash>.<format> in the exports directory
+    EXPORT = re.compile(r'^%s/([a-z]+)_([^/]+)\.([a-z]+)$' % re.escape(
+        os.path.relpath(config['app']['export'], config['app']['static'])))
+    # a request hash, builds from kb_cli are named after their layout file
+    HASH = re.compile(r'^[0-9a-f]{40}$')
+
+    def initialize(self, path, default_filename=None, jobs=None):
+        super(ExportFileHandler, self).initialize(path, default_filename)
+        self.jobs = jobs
+        self.encoding = None
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(ExportFileHandler, self).validate_absolute_path(
+            root, absolute_path)
+        if absolute_path and self.EXPORT.match(self.path):
+            accepted = compress.accepted(
+                self.request.headers.get('Accept-Encoding'))
+            for encoding, suffix in compress.ENCODINGS:
+                if encoding in accepted and \
+                        os.path.isfile(absolute_path + suffix):
+                    self.encoding = encoding
+                    return absolute_path + suffix
+        return absolute_path
+
+    # the type of the export itself, not of its compressed copy
+    def get_content_type(self):
+        if self.encoding:
+            mime_type = mimetypes.guess_type(
+                self.absolute_path.rpartition('.')[0])[0]
+            return mime_type or 'application/octet-stream'
+        return super(ExportFileHandler, self).get_content_type()
+
+    # the size and time of the file instead of a hash of all of it
+    def compute_etag(self):
+        if not self.EXPORT.match(self.path):
+            return super(ExportFileHandler, self).compute_etag()
+        stat = os.stat(self.absolute_path)
+        return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+    def is_immutable(self, path):
+        match = self.EXPORT.match(path)
+        return bool(match and self.HASH.match(match.group(2)))
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.is_immutable(path):
+            return config['app']['export_max_age']
+        return super(ExportFileHandler, self).get_cache_time(
+            path, modified, mime_type)
+
+    def set_extra_headers(self, path):
+        if self.EXPORT.match(path):
+            self.set_header('Vary', 'Accept-Encoding')
+        if self.encoding:
+            self.set_header('Content-Encoding', self.encoding)
+        if self.is_immutable(path):
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable'
+                            % config['app']['export_max_age'])
+
+    @tornado.gen.coroutine
+    def get(self, path, include_body=True):
+        match = self.EXPORT.match(path)
+        if match:
+            self.jobs.touch(match.group(2))
+        if match and not os.path.exists(os.path.join(self.root, path)):
+            label, data_hash, name = match.groups()
+            job = self.jobs.export(data_hash, label, name)
+            if job:
+                logging.info("Exporting %s on demand" % path)
+                try:
+                    yield job.wait()
+                except BuildError as e:
+                    logging.warning("Could not export %s: %s" % (path, e))
+        yield super(ExportFileHandler, self).get(path, include_body)
+
+
+# a ZIP of every layer of a build in every format, written as it is sent.
+# the formats offered on demand are exported first.
+class BundleHandler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    @tornado.gen.coroutine
+    def get(self, data_hash):
+        manifest = self.jobs.cache.load(data_hash)
+        if not manifest:
+            raise tornado.web.HTTPError(404)
+        self.jobs.touch(data_hash)
+        exporting = []
+        for label, exports in manifest['result']['exports'].items():
+            for export in exports:
+                if not export.get('lazy') or os.path.exists(
+                        self.jobs.cache.artifact_path(export['url'])):
+                    continue
+                job = self.jobs.export(data_hash, label, export['name'])
+                if job:
+                    exporting.append((export['name'], job))
+        for name, job in exporting:
+            try:
+                yield job.wait()
+            except BuildError as e:
+                logging.warning("Could not export %s for the bundle of %s: %s"
+                                % (name, data_hash, e))
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="%s.zip"' % data_hash)
+        for chunk in bundle.zip_chunks(bundle.members(
+                manifest['result'], self.jobs.cache.artifact_path)):
+            self.write(chunk)
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+
+
+def make_app(jobs):
     settings = {
         'template_path': 'templates',
         'static_path': config['app']['static'],
+        'static_handler_class': ExportFileHandler,
+        'static_handler_args': dict(jobs=jobs),
         'debug': config['app']['debug']
     }
     return tornado.web.Application([
-        (r"/", IndexHandler)
+        (r"/", IndexHandler, dict(jobs=jobs)),
+        (r"/jobs", JobsHandler, dict(jobs=jobs)),
+        tornado.web.url(r"/jobs/([0-9a-f]+)", JobHandler, dict(jobs=jobs),
+                        name='job'),
+        tornado.web.url(r"/jobs/([0-9a-f]+)/events", JobEventsHandler,
+                        dict(jobs=jobs), name='job-events'),
+        (r"/plan", PlanHandler, dict(jobs=jobs)),
+        (r"/bundle/([0-9a-f]+)\.zip", BundleHandler, dict(jobs=jobs)),
+        (r"/stats", StatsHandler, dict(jobs=jobs)),
+        (r"/metrics", MetricsHandler, dict(jobs=jobs)),
     ], **settings)
 
 
@@ -67,7 +385,19 @@ def main():
     tornado.options.options.log_file_prefix = config['app']['log']
     tornado.options.parse_command_line()
     logging.info("Started the kb_builder...")
-    app = make_app()
+    pool = BuildPool(config)
+    pool.start()
+    cache = ResultCache(config)
+    store = ExportStore(config, cache)
+
+    # builds from before the store was used are counted in the background
+    def sync():
+        store.sync()
+        store.evict()
+    thread = threading.Thread(target=sync, name='export-sync')
+    thread.daemon = True
+    thread.start()
+    app = make_app(JobManager(pool, cache, config, store))
     app.listen(config['app']['port'])
     tornado.ioloop.IOLoop.current().start()
 
@@ -0,0 +1,400 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# 'kb_cli batch' builds many layouts in one go, each of them with every
+# combination of the options it is swept over, on a pool of workers which
+# import the CAD libraries once:
+#
+#   kb_cli batch layouts/*.txt --kerf 0,0.1,0.15 --case poker,sandwich \
+#       -o summary.csv
+from __future__ import print_function
+
+import argparse
+import collections
+import csv
+import glob
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import hjson
+
+from lib import pool
+from lib.cache import ResultCache
+from lib.planner import outputs, plates
+from lib.store import ExportStore, remove_partial
+
+log = logging.getLogger()
+
+# the names kb_cli takes for the switch and stabilizer types
+SWITCH_TYPES = {'mx': 1, 'alpsmx': 2, 'mx-open': 3, 'alps': 4}
+STAB_TYPES = {'cherry': 1, 'costar': 2, 'cherry-costar': 3, 'alps': 4}
+CASE_TYPES = {'none': '', 'poker': 'poker', 'sandwich': 'sandwich'}
+
+# the options which can be swept: (option, request key, parse, kb_cli default).
+# the default is left out of the request when it is 0, like kb_cli does.
+OPTIONS = [
+    ('switch', 'switch-type', lambda v: int(SWITCH_TYPES.get(v, v)), 1),
+    ('stab', 'stab-type', lambda v: int(STAB_TYPES.get(v, v)), 3),
+    ('case', 'case-type', lambda v: CASE_TYPES[v], ''),
+    ('holes', 'mount-holes-num', int, 6),
+    ('hole-diameter', 'mount-holes-size', float, 3),
+    ('width', 'width-padding', float, 4),
+    ('height', 'height-padding', float, 4),
+    ('corners', 'fillet', float, 0),
+    ('thickness', 'thickness', float, 0),
+    ('kerf', 'kerf', float, 0),
+]
+
+# the columns of the CSV summary, the JSON summary also has the 'stages'
+COLUMNS = ['name', 'file'] + [key for _, key, _, _ in OPTIONS] + [
+    'state', 'width', 'height', 'plates', 'exports', 'wait', 'seconds',
+    'error']
+
+
+# the layout files named by 'paths', which can be files, directories (every
+# file in them) or globs
+def layout_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = [os.path.join(path, name)
+                       for name in sorted(os.listdir(path))
+                       if not name.startswith('.')]
+        else:
+            matches = sorted(glob.glob(path)) or [path]
+        files.extend(match for match in matches if match not in files)
+    return files
+
+
+# read a layout file.  it is either the raw KLE data kb_cli reads or a whole
+# JSON request (like the benchmark corpus), whose options are kept unless
+# they are swept over.  returns the request and whether it was a whole one.
+def load_layout(path):
+    with open(path) as layout_file:
+        layout = hjson.loads('{"layout": [' + layout_file.read() + ']}')
+    layout = layout['layout']
+    if len(layout) == 1 and isinstance(layout[0], dict) and \
+            'layout' in layout[0]:
+        return dict(layout[0]), True
+    return {'layout': layout}, False
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%g' % value
+    return str(value)
+
+
+# a build for every combination of the swept 'options' ({option: [values]})
+# of every layout in 'files'.  returns (name, file, options, request) tuples.
+def expand(files, options, flat=False, formats=None):
+    swept = [option for option, _, _, _ in OPTIONS
+             if len(options.get(option) or []) > 1]
+    jobs = []
+    names = collections.Counter()
+    for path in files:
+        base, whole = load_layout(path)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        values = [options.get(option) or [None]
+                  for option, _, _, _ in OPTIONS]
+        for combination in itertools.product(*values):
+            data = dict(base)
+            chosen = collections.OrderedDict()
+            for (option, key, _, default), value in zip(OPTIONS,
+                                                        combination):
+                if value is None:
+                    if whole and key in data:
+                        chosen[key] = data[key]
+                        continue
+                    value = default
+                chosen[key] = value
+                if value or key in ('switch-type', 'stab-type',
+                                    'case-type'):
+                    data[key] = value
+                else:
+                    data.pop(key, None)
+            if not data.get('case-type'):
+                data.pop('mount-holes-num', None)
+                data.pop('mount-holes-size', None)
+            if flat:
+                data['engine'] = '2d'
+            if formats:
+                data['formats'] = formats
+            name = '-'.join([stem] + [
+                (format_value(chosen[key]) or 'nocase') if option == 'case'
+                else '%s%s' % (option, format_value(chosen[key]))
+                for option, key, _, _ in OPTIONS if option in swept])
+            names[name] += 1
+            if names[name] > 1:  # the same layout name in another directory
+                name = '%s-%s' % (name, names[name])
+            jobs.append((name, path, chosen, data))
+    return jobs
+
+
+class Batch(object):
+    def __init__(self, config, size, use_cache=True):
+        self.config = config
+        self.size = size
+        self.use_cache = use_cache
+        self.cache = ResultCache(config)
+        self.store = ExportStore(config, self.cache)
+        self.events = []  # (job, event, payload, time) from the pool
+        self.done = threading.Condition()
+        self.report = None
+        self.finished = 0
+        self.total = 0
+
+    # build every job and return a summary row for each, in the order the
+    # jobs were given.  'report(row, finished, total)' is called as each one
+    # is finished.
+    def run(self, jobs, report=None):
+        self.report = report
+        self.finished = 0
+        self.total = len(jobs)
+        rows = []
+        pending = []
+        for name, path, chosen, data in jobs:
+            row = self.row(name, path, chosen)
+            rows.append(row)
+            cad, missing = None, None
+            if self.use_cache:
+                cad, missing = self.cache.lookup(name, data)
+            if cad and not missing:
+                self.store.touch(name)
+                self.finish(row, 'cached', cad)
+            else:
+                pending.append((row, data, missing))
+        if pending:
+            self.build(pending)
+        self.store.evict(keep=set(row['name'] for row in rows))
+        return rows
+
+    def row(self, name, path, chosen):
+        row = dict((column, '') for column in COLUMNS)
+        row.update(chosen)
+        row.update({'name': name, 'file': path, 'stages': {}})
+        return row
+
+    def finish(self, row, state, result):
+        row['state'] = state
+        if result:
+            row['width'] = round(result['width'], 4)
+            row['height'] = round(result['height'], 4)
+            row['plates'] = ' '.join(result['plates'])
+            row['exports'] = ' '.join(
+                export['url'] for plate in result['plates']
+                for export in result['exports'].get(plate, []))
+        self.finished += 1
+        if self.report:
+            self.report(row, self.finished, self.total)
+
+    # run the 'pending' builds on the pool of workers.  a build which does
+    # not stop at a checkpoint 'build_timeout' seconds after it started is
+    # killed once 'cancel_grace' more seconds went by, and a dead worker fails
+    # its build, so the batch always comes to an end.
+    def build(self, pending):
+        size = min(self.size, len(pending))
+        # the CAD stack is only imported by workers which build in 3d
+        build_pool = pool.BuildPool(self.config, size, preload=any(
+            data.get('engine') != '2d' for _, data, _ in pending))
+        build_pool.start()
+        timeout = self.config['app']['build_timeout']
+        deadline = timeout + self.config['app']['cancel_grace']
+        try:
+            for i, (row, data, missing) in enumerate(pending):
+                row['submitted'] = time.time()
+                build_pool.submit(i, row['name'], data, self.callback(i),
+                                  formats=missing, timeout=timeout)
+            left = set(range(len(pending)))
+            while left:
+                with self.done:
+                    if not self.events:
+                        self.done.wait(1)
+                    events, self.events = self.events, []
+                for i, event, payload, at in events:
+                    row, data, missing = pending[i]
+                    if event == pool.STARTED:
+                        row['started'] = at
+                        continue
+                    left.discard(i)
+                    row['wait'] = round(row.get('started', at) -
+                                        row['submitted'], 3)
+                    row['seconds'] = round(at - row.get('started', at), 3)
+                    if event == pool.DONE:
+                        row['stages'] = payload['timings']['stages']
+                        result = self.cache.put(row['name'], data, payload)
+                        self.store.record(row['name'])
+                        self.finish(row, 'built', result)
+                    else:
+                        if event == pool.CANCELLED:  # it timed out
+                            remove_partial(self.config, self.cache,
+                                           row['name'],
+                                           outputs(data, self.config,
+                                                   missing))
+                        row['plates'] = ' '.join(plates(data))
+                        row['error'] = payload.strip().splitlines()[-1]
+                        self.finish(row, 'failed', None)
+                if left:
+                    self.overdue(build_pool, pending, left, timeout,
+                                 deadline)
+        finally:
+            build_pool.stop()
+
+    # kill the builds in 'left' which ran past the 'deadline', and fail them
+    # all if the pool stopped listening to its workers
+    def overdue(self, build_pool, pending, left, timeout, deadline):
+        now = time.time()
+        if not build_pool.listener.is_alive():
+            for i in sorted(left):
+                with self.done:
+                    self.events.append((i, pool.ERROR,
+                                        "The build pool stopped", now))
+            return
+        for i in sorted(left):
+            row = pending[i][0]
+            started = row.get('started')
+            if started and now - started > deadline and \
+                    not row.get('killed'):
+                row['killed'] = True
+                build_pool.kill(i, "Timed out after %s seconds" % timeout)
+
+    # the pool listener calls this from its thread, the events are handled
+    # by 'build'
+    def callback(self, i):
+        def on_event(event, payload):
+            if event == pool.PROGRESS:
+                return
+            with self.done:
+                self.events.append((i, event, payload, time.time()))
+                self.done.notify()
+        return on_event
+
+
+def write_summary(path, rows):
+    if path.endswith('.json'):
+        with open(path, 'w') as summary:
+            json.dump([dict((column, row[column])
+                            for column in COLUMNS + ['stages'])
+                       for row in rows], summary, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    else:
+        with open(path, 'w') as summary:
+            writer = csv.DictWriter(summary, COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+# a comma separated list of values of 'option', parsed
+def values(option, parse):
+    def parse_list(text):
+        parsed = []
+        for value in text.split(','):
+            try:
+                parsed.append(parse(value.strip()))
+            except (KeyError, ValueError):
+                raise argparse.ArgumentTypeError(
+                    'Unknown %s: %s' % (option, value))
+        return parsed
+    return parse_list
+
+
+def main(argv, config):
+    parser = argparse.ArgumentParser(
+        prog='kb_cli batch',
+        description='Build many layouts, each with every combination of the '
+        'comma separated values given for the options below, on a pool of '
+        'workers.')
+    parser.add_argument(
+        'layouts', nargs='+',
+        help='Layout files, directories or globs.  A file holds KLE data '
+        'like kb_cli reads it or a whole JSON request.')
+    for option, key, parse, default in OPTIONS:
+        parser.add_argument(
+            '--%s' % option, type=values(option, parse),
+            help='Values of %s (Default: %s, or the value of a JSON request)'
+            % (key, format_value(default) or 'none'))
+    parser.add_argument(
+        '--2d', dest='flat', action='store_true',
+        help='Draw flat plates and only export DXF and SVG (much faster).')
+    parser.add_argument(
+        '--formats',
+        help='Comma separated formats to export (Default: %s)' %
+        ','.join(config['app']['formats']))
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='Number of builds to run at once (Default: %s)' %
+        multiprocessing.cpu_count())
+    parser.add_argument(
+        '--cut-mode', choices=('batch', 'single'),
+        default=config['app']['cut_mode'],
+        help='Cut all the openings at once or one by one (Default: %s)' %
+        config['app']['cut_mode'])
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Build even if the same layout was already built.')
+    parser.add_argument(
+        '-o', '--output',
+        help='Save a summary of every build, as JSON when the file ends in '
+        '.json and as CSV otherwise.')
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='Only list the builds.')
+    args = parser.parse_args(argv)
+
+    config['app']['cut_mode'] = args.cut_mode
+    # there is nothing to download the lazy formats from later, so
+    # everything is exported right away
+    config['app']['lazy_formats'] = []
+    # each worker builds one layout, the exports are not fanned out further
+    config['app']['export_workers'] = 0
+
+    files = layout_files(args.layouts)
+    missing = [path for path in files if not os.path.isfile(path)]
+    if missing:
+        parser.error('No such layout: %s' % ', '.join(missing))
+    try:
+        sweeps = dict((option, getattr(args, option.replace('-', '_')))
+                      for option, _, _, _ in OPTIONS)
+        jobs = expand(files, sweeps, args.flat,
+                      args.formats and args.formats.split(','))
+    except (IOError, ValueError) as e:
+        parser.error('Could not read a layout: %s' % e)
+    if args.dry_run:
+        for name, path, chosen, data in jobs:
+            print(name)
+        return 0
+
+    started = time.time()
+
+    def report(row, finished, total):
+        print('[%s/%s] %-40s %-7s %s' % (
+            finished, total, row['name'], row['state'],
+            row['error'] or '%s x %s mm %ss' % (row['width'], row['height'],
+                                                row['seconds'] or 0)))
+    rows = Batch(config, max(1, args.jobs), not args.no_cache).run(
+        jobs, report)
+    if args.output:
+        write_summary(args.output, rows)
+    failed = len([row for row in rows if row['state'] == 'failed'])
+    print('*** %s builds in %.1f seconds, %s failed' % (
+        len(rows), time.time() - started, failed))
+    return 1 if failed else 0
@@ -0,0 +1,86 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import hashlib
+import json
+import logging
+import os
+
+log = logging.getLogger()
+
+
+# keeps the blank plates (the outline and the case mount holes, before any key
+# is cut) which builds of the same size and case share.  the most recently
+# used blanks are kept in memory by each worker and all of them are saved on
+# disk, where every worker can load them from.  'load(path)' and
+# 'save(blank, path)' read and write a blank as a BREP file.
+class BlankCache(object):
+    def __init__(self, config, load, save):
+        self.path = config['app']['blanks']
+        self.size = config['app']['blank_cache_size']
+        self.load = load
+        self.save = save
+        self.blanks = collections.OrderedDict()  # least recently used first
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    # 'key' is anything json can dump which describes the blank
+    def name(self, key):
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def blank_path(self, name):
+        return os.path.join(self.path, '%s.brp' % name)
+
+    def get(self, key):
+        name = self.name(key)
+        blank = self.blanks.pop(name, None)
+        if blank is None and os.path.exists(self.blank_path(name)):
+            try:
+                blank = self.load(self.blank_path(name))
+            except Exception:
+                log.exception("Could not load blank %s", name)
+        if blank is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.remember(name, blank)
+        self.used(name)
+        return blank
+
+    # the time of the file is when the blank was last used, the least
+    # recently used are evicted first by 'store.ExportStore'
+    def used(self, name):
+        try:
+            os.utime(self.blank_path(name), None)
+        except OSError:
+            pass  # evicted from the disk, only this worker still has it
+
+    def put(self, key, blank):
+        name = self.name(key)
+        path = self.blank_path(name)
+        # write to the side and move it in place so other workers never load
+        # half a blank
+        self.save(blank, path + '.%s.tmp' % os.getpid())
+        os.rename(path + '.%s.tmp' % os.getpid(), path)
+        self.remember(name, blank)
+
+    def remember(self, name, blank):
+        self.blanks[name] = blank
+        while len(self.blanks) > self.size:
+            self.blanks.popitem(last=False)
@@ -17,189 +17,171 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import contextlib
+import copy
 import json
 import logging
 
-import math
 import os
 import sys
+import time
 
 from config import config as cfg
+from lib import blanks
+from lib import compress
+from lib import exporter
+from lib import layers
+from lib import mesh
+from lib import metrics
+from lib import placement
+from lib import planner
+from lib import profiler
+from lib import sketch
+from lib.cache import lazy_formats, requested_formats
+from lib.planner import SWITCH_LAYER, BOTTOM_LAYER, CLOSED_LAYER, OPEN_LAYER
 
 log = logging.getLogger()
 
-if 'lib' in cfg and 'freecad_lib_dir' in cfg['lib'] and \
-        cfg['lib']['freecad_lib_dir'] != "":
-    sys.path.append(cfg['lib']['freecad_lib_dir'])
-if 'lib' in cfg and 'freecad_mod_dir' in cfg['lib'] and \
-        cfg['lib']['freecad_mod_dir'] != "":
-    for mod in os.listdir(cfg['lib']['freecad_mod_dir']):
-        mod_path = os.path.join(cfg['lib']['freecad_mod_dir'], mod)
-        if os.path.isdir(mod_path):
-            sys.path.append(mod_path)
-
-import FreeCAD
-import cadquery
-import importDXF
-import importSVG
-import Mesh
-import Part
-
-SWITCH_LAYER = 'switch'
-BOTTOM_LAYER = 'bottom'
-CLOSED_LAYER = 'closed'
-OPEN_LAYER = 'open'
-
-
-class Plate(object):
+# the CAD stack takes seconds to import, so it is only imported by
+# 'load_cad' when a solid is first drawn, loaded or exported.  the 2d engine,
+# planning and validation never need it.
+FreeCAD = cadquery = importDXF = importSVG = MeshPart = Part = None
+cad_seconds = None  # how long 'load_cad' took to import the CAD stack
+
+
+def load_cad():
+    global FreeCAD, cadquery, importDXF, importSVG, MeshPart, Part, \
+        cad_seconds
+    if cad_seconds is not None:
+        return
+    started = time.time()
+    if 'lib' in cfg and 'freecad_lib_dir' in cfg['lib'] and \
+            cfg['lib']['freecad_lib_dir'] != "":
+        sys.path.append(cfg['lib']['freecad_lib_dir'])
+    if 'lib' in cfg and 'freecad_mod_dir' in cfg['lib'] and \
+            cfg['lib']['freecad_mod_dir'] != "":
+        for mod in os.listdir(cfg['lib']['freecad_mod_dir']):
+            mod_path = os.path.join(cfg['lib']['freecad_mod_dir'], mod)
+            if os.path.isdir(mod_path):
+                sys.path.append(mod_path)
+
+    import FreeCAD
+    import cadquery
+    import importDXF
+    import importSVG
+    import MeshPart
+    import Part
+    cad_seconds = time.time() - started
+    log.info("Imported the CAD libraries in %.2fs", cad_seconds)
+
+
+# draws the plate worked out by 'PlatePlan' and exports it
+class Plate(planner.PlatePlan):
     def __init__(self):
-        self.UOM = "mm"
-        self.width = 0
-        self.height = 0
-        self.thickness = 1.5
-        self.fillet = 0
-        self.kerf = 0.0
-        self.x_pad = 0
-        self.y_pad = 0
-        self.x_off = 0
-        self.grow_y = 0
-        self.grow_x = 0
-        self.u1 = 19.05
-        self.switch_type = 1
-        self.stab_type = 0
-        self.stabs = {
-            "300": 19.05,  # 3 unit
-            "400": 28.575,  # 4 unit
-            "450": 34.671,  # 4.5 unit
-            "550": 42.8625,  # 5.5 unit
-            "625": 50,  # 6.25 unit
-            "650": 52.38,  # 6.5 unit
-            "700": 57.15,  # 7 unit
-            "800": 66.675,  # 8 unit
-            "900": 66.675,  # 9 unit
-            "1000": 66.675  # 10 unit
-        }
-        self.layout = []
-        self.case = {'type': None}
+        super(Plate, self).__init__()
         self.origin = (0, 0)
-        self.usb_width = 10
-
-    def set_x_pad(self, x):
-        self.x_pad = x
-
-    def set_y_pad(self, y):
-        self.y_pad = y
-
-    def set_thickness(self, t):
-        self.thickness = t
-
-    def set_fillet(self, f):
-        self.fillet = f
-
-    def set_kerf(self, k):
-        self.kerf = k/2
-
-    def set_switch_type(self, t):
-        if t in range(5):
-            log.info('Setting switch-type to %s', t)
-            self.switch_type = t
-
-    def set_stab_type(self, s):
-        if s in range(3):
-            log.info('Setting stab-type to %s', s)
-            self.stab_type = s
-
-    def set_poker_holes(self, d):
-        self.case = {'type': 'poker', 'hole_diameter': d}
-
-    def set_sandwich_holes(self, h, d):
-        self.case = {'type': 'sandwich', 'holes': h, 'x_holes': 0,
-                     'y_holes': 0, 'hole_diameter': d}
+        self.progress = None
+        self.engine = '3d'
+        self.cut_mode = 'batch'
+        self.cut_tile = 0
+        self.pending_cuts = []
+        self.blanks = None
+        self.blank_key = None
+        self.base = None  # (blank key, cuts, switch layer) of the base build
+        self.cuts = []
+        self.switch_layer = None
+        self.fan_out = None
+        self.layers = None
+        self.lazy_formats = []
+        self.tolerances = None
+        self.timings = metrics.Timings()
+        self.fingerprint = False
+        self.checker = None
+
+    # '2d' draws the plate as a flat sketch instead of a solid, which is only
+    # good for the 2d formats but skips FreeCAD altogether
+    def set_engine(self, engine):
+        if engine in ('2d', '3d'):
+            self.engine = engine
+
+    def set_cut_mode(self, mode, tile=0):
+        if mode in ('single', 'batch'):
+            self.cut_mode = mode
+            self.cut_tile = tile
+
+    def set_blanks(self, blanks):
+        self.blanks = blanks
+
+    # build on top of a previous build, see 'diff_cuts'
+    def set_base(self, base):
+        self.base = base
+
+    # export the layers with the processes of 'fan_out' (an exporter.FanOut)
+    def set_fan_out(self, fan_out):
+        self.fan_out = fan_out
+
+    # save every layer in 'layers' (a layers.LayerStore) and offer the
+    # 'lazy_formats' it was not exported to, to be exported on download
+    def set_layers(self, layers, lazy_formats=()):
+        self.layers = layers
+        self.lazy_formats = list(lazy_formats)
+
+    # the (linear, angular) deflection of each tessellated format, see
+    # 'mesh.tolerances'
+    def set_tolerances(self, tolerances):
+        self.tolerances = tolerances
+
+    # add the 'fingerprint' of the switch layer to the result
+    def set_fingerprint(self, fingerprint):
+        self.fingerprint = fingerprint
+
+    def set_progress(self, progress):
+        self.progress = progress
+
+    # 'check()' raises to stop the build, it is called between the keys, the
+    # layers and the exports
+    def set_check(self, check):
+        self.checker = check
+
+    def check(self):
+        if self.checker:
+            self.checker()
+
+    # let whoever is waiting on the build know how far along we are
+    def report(self, stage, **info):
+        if self.progress:
+            self.progress(stage, info)
 
     # this is the main draw function for the class and handles the logical flow
     # and orchestration
     def draw(self, result, layout, data_hash, config):
-        self.parse_layout(layout)
-        p = self.init_plate()
+        with self.timings.stage('parse_layout'):
+            self.parse_layout(layout)
+        self.report('parsed', rows=len(self.layout),
+                    keys=sum(len(row) for row in self.layout),
+                    width=self.width, height=self.height)
+        p = self.init_blank()
         result['width'] = self.width
         result['height'] = self.height
-
-        # cut the mount holes in the plate
-        if not self.case['type']:
-            p = self.center(p, -self.width/2 + self.kerf, -self.height/2 +
-                            self.kerf)  # move to top left of the plate
-        if self.case['type'] == 'poker':
-            hole_points = [(-139, 9.2), (-117.3, -19.4), (-14.3, 0),
-                           (48, 37.9), (117.55, -19.4), (139, 9.2)]  # holes
-            rect_points = [(140.75, 9.2), (-140.75, 9.2)]  # edge slots
-            rect_size = (3.5, 5)  # edge slot cutout to edge
-            for c in hole_points:
-                p = self.cut_hole(p, c,
-                                  self.case['hole_diameter']).center(-c[0],
-                                                                     -c[1])
-            for c in rect_points:
-                p = self.cut_rect(p, c, rect_size[0],
-                                  rect_size[1]).center(-c[0], -c[1])
-            p = self.center(p, -self.width/2 + self.kerf, -self.height/2 +
-                            self.kerf)  # move to top left of the plate
-        if self.case['type'] == 'sandwich':
-            p = self.center(p, -self.width/2 + self.kerf, -self.height/2 +
-                            self.kerf)  # move to top left of the plate
-            if 'holes' in self.case and self.case['holes'] >= 4 and \
-                    'x_holes' in self.case and 'y_holes' in self.case:
-                self.layout_sandwich_holes()
-                radius = self.case['hole_diameter']/2 - self.kerf
-                x_gap = (self.width - self.x_pad -
-                         2*self.kerf)/(self.case['x_holes'] + 1)
-                y_gap = (self.height - self.y_pad -
-                         2*self.kerf)/(self.case['y_holes'] + 1)
-                p = p.center(self.x_pad/2, self.y_pad/2)
-                for i in range(self.case['x_holes'] + 1):
-                    p = p.center(x_gap, 0).circle(radius).cutThruAll()
-                for i in range(self.case['y_holes'] + 1):
-                    p = p.center(0, y_gap).circle(radius).cutThruAll()
-                for i in range(self.case['x_holes'] + 1):
-                    p = p.center(-x_gap, 0).circle(radius).cutThruAll()
-                for i in range(self.case['y_holes'] + 1):
-                    p = p.center(0, -y_gap).circle(radius).cutThruAll()
-                if result['has_layers']:
-                    self.export(p, result, BOTTOM_LAYER, data_hash, config)
-                p = p.center(-self.x_pad/2, -self.y_pad/2)
+        if result['has_layers'] and self.sandwich_holes():
+            self.export(p, result, BOTTOM_LAYER, data_hash, config)
 
         # cut all the switch and stabilizer openings...
-        prev_width = None
-        prev_y_off = 0
-        for r, row in enumerate(self.layout):
-            for k, key in enumerate(row):
-                x, y, kx = 0, 0, 0
-                if 'x' in key:
-                    x = key['x']*self.u1
-                    kx = x
-                if 'y' in key and k == 0:
-                    y = key['y']*self.u1
-                if r == 0 and k == 0:
-                    # handle placement of the first key in first row
-                    p = self.center(p, key['w']*self.u1/2, self.u1/2)
-                    x += self.x_pad
-                    y += self.y_pad
-                    # set x_off negative since the 'cut_switch' will append 'x'
-                    # and we need to account inital spacing
-                    self.x_off = -(x - (self.u1/2 + key['w']*self.u1/2) - kx)
-                elif k == 0:  # handle changing rows
-                    # move to the next row
-                    p = self.center(p, -self.x_off, self.u1)
-                    self.x_off = 0  # reset back to the left side of the plate
-                    x += self.u1/2 + key['w']*self.u1/2
-                else:  # handle all other keys
-                    x += prev_width*self.u1/2 + key['w']*self.u1/2
-                if prev_y_off != 0:  # prev_y_off != 0
-                    y += -prev_y_off
-                    prev_y_off = 0
-                if 'h' in key and key['h'] > 1:  # deal with vertical keys
-                    prev_y_off = key['h']*self.u1/2 - self.u1/2
-                    y += prev_y_off
-                p = self.cut_switch(p, (x, y), key)
-                prev_width = key['w']
+        with self.timings.stage('cut_keys'):
+            centers = self.key_centers()
+            i = 0
+            for r, row in enumerate(self.layout):
+                for key in row:
+                    self.check()
+                    with self.timings.sample('key'):
+                        p = self.cut_switch(p, tuple(centers[i]), key)
+                    i += 1
+                self.report('row', row=r+1, rows=len(self.layout))
+        with self.timings.stage('flush_cuts'):
+            p = self.flush_cuts(p)
+        if self.fingerprint:
+            result['fingerprint'] = self.measure(p)
         self.export(p, result, SWITCH_LAYER, data_hash, config)
 
         # cut layers
@@ -218,7 +200,10 @@ class Plate(object):
                 (-self.width/2+self.x_pad+self.kerf*2,
                  -self.height/2+self.y_pad+self.kerf*2)
             ]
-            p = p.polyline(points).cutThruAll()
+            self.check()
+            with self.timings.stage('cut_layers'), \
+                    self.timings.sample('boolean'):
+                p = p.polyline(points).cutThruAll()
             self.export(p, result, CLOSED_LAYER, data_hash, config)
 
             # open layer
@@ -230,115 +215,79 @@ class Plate(object):
                 (-self.usb_width/2+self.kerf, self.y_pad/2+self.kerf),
                 (-self.usb_width/2+self.kerf, -self.y_pad/2-self.kerf)
             ]
-            p = p.polyline(points).cutThruAll()
+            self.check()
+            with self.timings.stage('cut_layers'), \
+                    self.timings.sample('boolean'):
+                p = p.polyline(points).cutThruAll()
             self.export(p, result, OPEN_LAYER, data_hash, config)
+        with self.timings.stage('export_wait'):
+            self.finish_exports(result)
+        result['timings'] = self.timings.summary()
         return result
 
-    # parse the supplied layout to determine size and populate the properties
-    # of each 'key'
-    def parse_layout(self, layout):
-        layout_width = 0
-        layout_height = 0
-        # track if current is not a key and only describes the next key
-        key_desc = False
-        for row in layout:
-            if isinstance(row, list):  # only handle arrays of keys
-                row_width = 0
-                row_height = 0
-                row_layout = []
-                for k in row:
-                    key = {}
-                    if isinstance(k, dict):  # descibes the next key
-                        key = k
-                        if 'w' not in key:
-                            key['w'] = 1
-                        if 'h' not in key:
-                            key['h'] = 1
-                        row_layout.append(key)
-                        key_desc = True
-                    else:
-                        # is just a standard key (we know its a single unit
-                        # key)
-                        if not key_desc:
-                            # only handle if it was not already handled as a
-                            # key_desc
-                            key['w'] = 1
-                            key['h'] = 1
-                            row_layout.append(key)
-                        key_desc = False
-                    if 'w' in key:
-                        row_width += key['w']
-                    if 'x' in key:
-                        # offsets count towards total row width
-                        row_width += key['x']
-                    if 'y' in key:
-                        row_height = key['y']
-                self.layout.append(row_layout)
-                if row_width > layout_width:
-                    layout_width = row_width
-                layout_height += self.u1 + row_height*self.u1
-            # hidden global features
-            if isinstance(row, dict):
-                if 'grow_y' in row and (type(row['grow_y']) == int or
-                                        type(row['grow_y']) == float):
-                    self.grow_y = row['grow_y']/2
-                if 'grow_x' in row and (type(row['grow_x']) == int or
-                                        type(row['grow_x']) == float):
-                    self.grow_x = row['grow_x']/2
-        self.width = layout_width*self.u1 + 2*self.x_pad + 2*self.kerf
-        self.height = layout_height + 2*self.y_pad + 2*self.kerf
+    # the plate with its outline and the case mount holes cut, which builds of
+    # the same size and case share through the blank cache.  the key is a
+    # copy, cutting the holes of a sandwich case lays them out in 'self.case'.
+    def init_blank(self):
+        self.blank_key = json.loads(json.dumps([
+            self.width, self.height, self.thickness, self.fillet, self.kerf,
+            self.x_pad, self.y_pad, self.case]))
+        cached = self.engine == '3d' and self.blanks
+        if cached:
+            with self.timings.stage('blank_cache'):
+                blank = self.blanks.get(self.blank_key)
+            if blank is not None:
+                log.info("Reusing the blank plate")
+                return self.workplane(blank)
+        with self.timings.stage('init_plate'):
+            p = self.init_plate()
+        with self.timings.stage('case_holes'):
+            p = self.cut_mount_holes(p)
+        if cached:
+            with self.timings.stage('blank_cache'):
+                self.blanks.put(self.blank_key, p.findSolid())
+        return p
 
     # initialize the plate object 'p' and get it ready to work with
     def init_plate(self):
+        if self.engine == '2d':
+            return sketch.Sketch(self.width, self.height, self.fillet)
         p = cadquery.Workplane("front").box(self.width, self.height,
                                             self.thickness)
         if self.fillet > 0:
             p = p.edges("|Z").fillet(self.fillet)
         return p.faces("<Z").workplane()
 
-    # since the sandwich plate has a dynamic number of holes, determine where
-    # the specified holes should be placed
-    def layout_sandwich_holes(self):
-        if 'holes' in self.case and self.case['holes'] >= 4 and \
-                'x_holes' in self.case and 'y_holes' in self.case:
-            holes = int(self.case['holes'])
-            if holes % 2 == 0 and holes >= 4:
-                # holes needs to be even and the first 4 are put in the corners
-                x = self.width - self.x_pad - self.kerf  # x length to split
-                y = self.height - self.y_pad - self.kerf  # y length to split
-                # number of holes on each x side (not counting the corner
-                # holes)
-                _x = 0
-                # number of holes on each y side (not counting the corner
-                # holes)
-                _y = 0
-                # number of free holes to be placed on either x or y sides
-                free = (holes-4)/2
-                for f in range(free):
-                    # loop through the available holes and place them
-                    if x/(_x+1) == y/(_y+1):
-                        # if equal, add the hole to the longer side
-                        if x >= y:
-                            _x += 1
-                        else:
-                            _y += 1
-                    elif x/(_x+1) > y/(_y+1):
-                        _x += 1
-                    else:
-                        _y += 1
-                self.case['x_holes'] = _x
-                self.case['y_holes'] = _y
-
-    # take a set of points and rotate them 'r' degrees around 'a'
-    def rotate_points(self, points, r, a):
-        result = []
-        for p in points:
-            px = math.cos(math.radians(r)) * \
-                (p[0]-a[0]) - math.sin(math.radians(r)) * (p[1]-a[1]) + a[0]
-            py = math.sin(math.radians(r)) * \
-                (p[0]-a[0]) + math.cos(math.radians(r)) * (p[1]-a[1]) + a[1]
-            result.append((px, py))
-        return result
+    # the same workplane 'init_plate' returns, on a plate which already exists
+    def workplane(self, solid):
+        plane = cadquery.Plane(cadquery.Vector(0, 0, -self.thickness/2.0),
+                               cadquery.Vector(1, 0, 0),
+                               cadquery.Vector(0, 0, -1))
+        return cadquery.Workplane(plane).newObject([solid])
+
+    # cut the mount holes of the case and come back to the center of the plate
+    def cut_mount_holes(self, p):
+        if self.case['type'] == 'poker':
+            for c in planner.POKER_HOLES:
+                with self.timings.sample('boolean'):
+                    p = self.cut_hole(p, c, self.case['hole_diameter'])
+                p = self.center(p, -c[0], -c[1])
+            for c in planner.POKER_SLOTS:
+                p = self.cut_rect(p, c, planner.POKER_SLOT_SIZE[0],
+                                  planner.POKER_SLOT_SIZE[1])
+                p = self.center(p, -c[0], -c[1])
+            with self.timings.sample('boolean'):
+                p = p.cutThruAll()  # the edge slots
+        if self.case['type'] == 'sandwich':
+            holes = self.sandwich_holes()
+            if holes:
+                radius = self.case['hole_diameter']/2 - self.kerf
+                for c in holes:
+                    p = self.move_to(p, c).circle(radius)
+                    with self.timings.sample('boolean'):
+                        p = p.cutThruAll()
+                p = self.move_to(p, (0, 0))
+        return p
 
     # cut a hole with center 'c' and diameter 'd'
     def cut_hole(self, p, c, d):
@@ -350,229 +299,119 @@ class Plate(object):
         p = self.center(p, c[0], c[1]).rect(w, h)
         return p
 
-    # cut a switch opening with center 'c' defined by the 'key'
+    # cut a switch opening with center 'c' (measured from the center of the
+    # plate) defined by the 'key'.  in 'batch' mode the cutouts are only
+    # recorded and removed later together with the rest of the layer by
+    # 'flush_cuts'.
     def cut_switch(self, p, c, key=None):
-        if not key:
-            key = {}
-
-        w = key['w'] if 'w' in key else 1
-        h = key['h'] if 'h' in key else 1
-        t = key['_t'] if '_t' in key and key['_t'] in range(4) \
-            else self.switch_type
-        s = key['_s'] if '_s' in key and key['_s'] in range(2) \
-            else self.stab_type
-        k = key['_k']/2 if '_k' in key else self.kerf
-        r = key['_r'] if '_r' in key else None
-        rs = key['_rs'] if '_rs' in key else None
-
-        # cut switch cutout
-        rotate = None
-        if 'h' in key and h > w:
-            rotate = True
-        points = []
-        if t == 0:  # standard square switch
-            points = [
-                (7-k+self.grow_x, -7+k-self.grow_y),
-                (7-k+self.grow_x, 7-k+self.grow_y),
-                (-7+k-self.grow_x, 7-k+self.grow_y),
-                (-7+k-self.grow_x, -7+k-self.grow_y),
-                (7-k+self.grow_x, -7+k-self.grow_y)
-            ]
-        elif t == 1:  # mx and alps compatible switch, mx can open
-            points = [
-                (7-k, -7+k), (7-k, -6.4+k), (7.8-k, -6.4+k), (7.8-k, 6.4-k),
-                (7-k, 6.4-k), (7-k, 7-k), (-7+k, 7-k), (-7+k, 6.4-k),
-                (-7.8+k, 6.4-k), (-7.8+k, -6.4+k), (-7+k, -6.4+k),
-                (-7+k, -7+k), (7-k, -7+k)
-            ]
-        elif t == 2:  # mx switch can open (side wings)
-            points = [
-                (7-k, -7+k), (7-k, -6+k), (7.8-k, -6+k), (7.8-k, -2.9-k),
-                (7-k, -2.9-k), (7-k, 2.9+k), (7.8-k, 2.9+k), (7.8-k, 6-k),
-                (7-k, 6-k), (7-k, 7-k), (-7+k, 7-k), (-7+k, 6-k),
-                (-7.8+k, 6-k), (-7.8+k, 2.9+k), (-7+k, 2.9+k), (-7+k, -2.9-k),
-                (-7.8+k, -2.9-k), (-7.8+k, -6+k), (-7+k, -6+k), (-7+k, -7+k),
-                (7-k, -7+k)
-            ]
-        elif t == 3:
-            # rotatable mx switch can open both ways (side and top/bottom
-            # wings)
-            points = [
-                (7-k, -7+k), (7-k, -6+k), (7.8-k, -6+k), (7.8-k, -2.9-k),
-                (7-k, -2.9-k), (7-k, 2.9+k), (7.8-k, 2.9+k), (7.8-k, 6-k),
-                (7-k, 6-k), (7-k, 7-k), (6-k, 7-k), (6-k, 7.8-k),
-                (2.9+k, 7.8-k), (2.9+k, 7-k), (-2.9-k, 7-k), (-2.9-k, 7.8-k),
-                (-6+k, 7.8-k), (-6+k, 7-k), (-7+k, 7-k), (-7+k, 6-k),
-                (-7.8+k, 6-k), (-7.8+k, 2.9+k), (-7+k, 2.9+k), (-7+k, -2.9-k),
-                (-7.8+k, -2.9-k), (-7.8+k, -6+k), (-7+k, -6+k), (-7+k, -7+k),
-                (-6+k, -7+k), (-6+k, -7.8+k), (-2.9-k, -7.8+k), (-2.9-k, -7+k),
-                (2.9+k, -7+k), (2.9+k, -7.8+k), (6-k, -7.8+k), (6-k, -7+k),
-                (7-k, -7+k)
-            ]
-        elif t == 4:  # alps compatible switch, not MX compatible
-            points = [
-                (7.75-k, -6.4+k), (7.75-k, 6.4-k),
-                (-7.75+k, 6.4-k), (-7.75+k, -6.4+k),
-                (7.75-k, -6.4+k),
-            ]
-        if rotate:
-            points = self.rotate_points(points, 90, (0, 0))
-        if r:
-            points = self.rotate_points(points, r, (0, 0))
-        p = self.center(p, c[0], c[1]).polyline(points).cutThruAll()
-
-        # cut 2 unit stabilizer cutout
-        #   2 unit stabilizer
-        if (w >= 2 and w < 3) or (rotate and h >= 2 and h < 3):
-            if s == 0:
-                # modified mx cherry spec 2u stabilizer to support costar
-                points = [
-                    (7-k, -7+k), (7-k, -4.73+k), (8.575+k, -4.73+k),
-                    (8.575+k, -5.53+k), (10.3+k, -5.53+k), (10.3+k, -6.45+k),
-                    (13.6-k, -6.45+k), (13.6-k, -5.53+k), (15.225-k, -5.53+k),
-                    (15.225-k, -2.3+k), (16.1-k, -2.3+k), (16.1-k, 0.5-k),
-                    (15.225-k, 0.5-k), (15.225-k, 6.77-k), (13.6-k, 6.77-k),
-                    (13.6-k, 7.75-k), (10.3+k, 7.75-k), (10.3+k, 6.77-k),
-                    (8.575+k, 6.77-k), (8.575+k, 5.97-k), (7-k, 5.97-k),
-                    (7-k, 7-k), (-7+k, 7-k), (-7+k, 5.97-k),
-                    (-8.575-k, 5.97-k), (-8.575-k, 6.77-k), (-10.3-k, 6.77-k),
-                    (-10.3-k, 7.75-k), (-13.6+k, 7.75-k), (-13.6+k, 6.77-k),
-                    (-15.225+k, 6.77-k), (-15.225+k, 0.5-k), (-16.1+k, 0.5-k),
-                    (-16.1+k, -2.3+k), (-15.225+k, -2.3+k),
-                    (-15.225+k, -5.53+k), (-13.6+k, -5.53+k),
-                    (-13.6+k, -6.45+k), (-10.3-k, -6.45+k), (-10.3-k, -5.53+k),
-                    (-8.575-k, -5.53+k), (-8.575-k, -4.73+k), (-7+k, -4.73+k),
-                    (-7+k, -7+k), (7-k, -7+k)
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0, 0))
-                if rs:
-                    points = self.rotate_points(points, rs, (0, 0))
-                p = p.polyline(points).cutThruAll()
-            if s == 1:
-                # cherry spec 2u stabilizer
-                points = [
-                    (7-k, -7+k), (7-k, -4.73+k), (8.575+k, -4.73+k),
-                    (8.575+k, -5.53+k), (15.225-k, -5.53+k),
-                    (15.225-k, -2.3+k), (16.1-k, -2.3+k), (16.1-k, 0.5-k),
-                    (15.225-k, 0.5-k), (15.225-k, 6.77-k), (13.6-k, 6.77-k),
-                    (13.6-k, 7.97-k), (10.3+k, 7.97-k), (10.3+k, 6.77-k),
-                    (8.575+k, 6.77-k), (8.575+k, 5.97-k), (7-k, 5.97-k),
-                    (7-k, 7-k), (-7+k, 7-k), (-7+k, 5.97-k),
-                    (-8.575-k, 5.97-k), (-8.575-k, 6.77-k), (-10.3-k, 6.77-k),
-                    (-10.3-k, 7.97-k), (-13.6+k, 7.97-k), (-13.6+k, 6.77-k),
-                    (-15.225+k, 6.77-k), (-15.225+k, 0.5-k), (-16.1+k, 0.5-k),
-                    (-16.1+k, -2.3+k), (-15.225+k, -2.3+k),
-                    (-15.225+k, -5.53+k), (-8.575-k, -5.53+k),
-                    (-8.575-k, -4.73+k), (-7+k, -4.73+k), (-7+k, -7+k),
-                    (7-k, -7+k)
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0, 0))
-                if rs:
-                    points = self.rotate_points(points, rs, (0, 0))
-                p = p.polyline(points).cutThruAll()
-            if s == 2:
-                # costar stabilizers only
-                points_l = [(-10.3-k, -6.45+k), (-13.6+k, -6.45+k),
-                            (-13.6+k, 7.75-k), (-10.3-k, 7.75-k),
-                            (-10.3-k, -6.45+k)]
-                points_r = [(10.3+k, -6.45+k), (13.6-k, -6.45+k),
-                            (13.6-k, 7.75-k), (10.3+k, 7.75-k),
-                            (10.3+k, -6.45+k)]
-                if rotate:
-                    points_l = self.rotate_points(points_l, 90, (0, 0))
-                    points_r = self.rotate_points(points_r, 90, (0, 0))
-                if rs:
-                    points_l = self.rotate_points(points_l, rs, (0, 0))
-                    points_r = self.rotate_points(points_r, rs, (0, 0))
-                p = p.polyline(points_l).cutThruAll()
-                p = p.polyline(points_r).cutThruAll()
-
-        # cut spacebar stabilizer cutout
-        if (w >= 3) or (rotate and h >= 3):
-            l = w
-            if rotate:
-                l = h
-            x = 11.95  # default to a 2unit stabilizer if not found...
-            # use the length of the key to determine if we have a known
-            # stabilizer config for that key
-            stab_size = '%s' % (str(l).replace('.', '').ljust(3, '0')
-                                if l < 10
-                                else str(l).replace('.', '').ljust(4, '0'))
-            if stab_size in self.stabs:
-                x = self.stabs[stab_size]
-            if s == 0:
-                # modified mx cherry spec stabilizer to support costar
-                points = [
-                    (7-k, -7+k), (7-k, -2.3+k), (x-3.325+k, -2.3+k),
-                    (x-3.325+k, -5.53+k), (x-1.65+k, -5.53+k),
-                    (x-1.65+k, -6.45+k), (x+1.65-k, -6.45+k),
-                    (x+1.65-k, -5.53+k), (x+3.325-k, -5.53+k),
-                    (x+3.325-k, -2.3+k), (x+4.2-k, -2.3+k), (x+4.2-k, 0.5-k),
-                    (x+3.325-k, 0.5-k), (x+3.325-k, 6.77-k),
-                    (x+1.65-k, 6.77-k), (x+1.65-k, 7.75-k), (x-1.65+k, 7.75-k),
-                    (x-1.65+k, 6.77-k), (x-3.325+k, 6.77-k),
-                    (x-3.325+k, 2.3-k), (7-k, 2.3-k), (7-k, 7-k), (-7+k, 7-k),
-                    (-7+k, 2.3-k), (-x+3.325-k, 2.3-k), (-x+3.325-k, 6.77-k),
-                    (-x+1.65-k, 6.77-k), (-x+1.65-k, 7.75-k),
-                    (-x-1.65+k, 7.75-k), (-x-1.65+k, 6.77-k),
-                    (-x-3.325+k, 6.77-k), (-x-3.325+k, 0.5-k),
-                    (-x-4.2+k, 0.5-k), (-x-4.2+k, -2.3+k),
-                    (-x-3.325+k, -2.3+k), (-x-3.325+k, -5.53+k),
-                    (-x-1.65+k, -5.53+k), (-x-1.65+k, -6.45+k),
-                    (-x+1.65-k, -6.45+k), (-x+1.65-k, -5.53+k),
-                    (-x+3.325-k, -5.53+k), (-x+3.325-k, -2.3+k),
-                    (-7+k, -2.3+k), (-7+k, -7+k), (7-k, -7+k)
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0, 0))
-                if rs:
-                    points = self.rotate_points(points, rs, (0, 0))
-                p = p.polyline(points).cutThruAll()
-            if s == 1:
-                # cherry spec spacebar stabilizer
-                points = [
-                    (7-k, -7+k), (7-k, -2.3+k), (x-3.325+k, -2.3+k),
-                    (x-3.325+k, -5.53+k), (x+3.325-k, -5.53+k),
-                    (x+3.325-k, -2.3+k), (x+4.2-k, -2.3+k), (x+4.2-k, 0.5-k),
-                    (x+3.325-k, 0.5-k), (x+3.325-k, 6.77-k),
-                    (x+1.65-k, 6.77-k), (x+1.65-k, 7.97-k), (x-1.65+k, 7.97-k),
-                    (x-1.65+k, 6.77-k), (x-3.325+k, 6.77-k),
-                    (x-3.325+k, 2.3-k), (7-k, 2.3-k), (7-k, 7-k), (-7+k, 7-k),
-                    (-7+k, 2.3-k), (-x+3.325-k, 2.3-k), (-x+3.325-k, 6.77-k),
-                    (-x+1.65-k, 6.77-k), (-x+1.65-k, 7.97-k),
-                    (-x-1.65+k, 7.97-k), (-x-1.65+k, 6.77-k),
-                    (-x-3.325+k, 6.77-k), (-x-3.325+k, 0.5-k),
-                    (-x-4.2+k, 0.5-k), (-x-4.2+k, -2.3+k),
-                    (-x-3.325+k, -2.3+k), (-x-3.325+k, -5.53+k),
-                    (-x+3.325-k, -5.53+k), (-x+3.325-k, -2.3+k),
-                    (-7+k, -2.3+k), (-7+k, -7+k), (7-k, -7+k)
-                ]
-                if rotate:
-                    points = self.rotate_points(points, 90, (0, 0))
-                if rs:
-                    points = self.rotate_points(points, rs, (0, 0))
-                p = p.polyline(points).cutThruAll()
-            if s == 2:
-                # costar stabilizers only
-                points_l = [(-x+1.65-k, -6.45+k), (-x-1.65+k, -6.45+k),
-                            (-x-1.65+k, 7.75-k), (-x+1.65-k, 7.75-k),
-                            (-x+1.65-k, -6.45+k)]
-                points_r = [(x-1.65+k, -6.45+k), (x+1.65-k, -6.45+k),
-                            (x+1.65-k, 7.75-k), (x-1.65+k, 7.75-k),
-                            (x-1.65+k, -6.45+k)]
-                if rotate:
-                    points_l = self.rotate_points(points_l, 90, (0, 0))
-                    points_r = self.rotate_points(points_r, 90, (0, 0))
-                if rs:
-                    points_l = self.rotate_points(points_l, rs, (0, 0))
-                    points_r = self.rotate_points(points_r, rs, (0, 0))
-                p = p.polyline(points_l).cutThruAll()
-                p = p.polyline(points_r).cutThruAll()
-        self.x_off += c[0]
+        key_profiles = self.key_profiles(key or {})
+        if self.cut_mode == 'batch':
+            self.pending_cuts.append((key_profiles, c))
+            return p
+        p = self.move_to(p, c)
+        for profile in key_profiles:
+            p = p.polyline(profile.points)
+            with self.timings.sample('boolean'):
+                p = p.cutThruAll()
         return p
 
+    # remove all the recorded cutouts from the plate in a single boolean cut
+    # (or one per 'cut_tile' keys).  when the build is based on a previous
+    # build of the same blank, only the keys which changed are cut.
+    def flush_cuts(self, p):
+        if self.cut_mode != 'batch':
+            return p
+        if self.engine == '2d':
+            # the outlines are simply moved into place and drawn
+            p.cut_polygons(placement.outlines(self.pending_cuts))
+            self.pending_cuts = []
+            return p
+        if not self.pending_cuts:
+            return p
+        solid = p.findSolid()
+        cuts = self.pending_cuts
+        if self.base and self.base[0] == self.blank_key:
+            solid, cuts = self.diff_cuts(p, solid)
+        elif self.base:
+            log.info("The base build has a different blank, cutting all keys")
+        tools = self.make_tools(p, cuts)
+        tile = self.cut_tile or len(tools) or 1
+        for i in range(0, len(tools), tile):
+            with self.timings.sample('boolean'):
+                solid = solid.cut(
+                    cadquery.Compound.makeCompound(tools[i:i+tile]))
+        log.info("Cut %s keys in %s boolean operations", len(tools),
+                 (len(tools) + tile - 1) // tile)
+        self.cuts = self.pending_cuts
+        self.switch_layer = solid
+        self.pending_cuts = []
+        return p.newObject([solid])
+
+    # the tools cutting out 'cuts' (a list of (profiles, center)).  the
+    # cutouts of a key overlap each other (the stabilizer includes the switch)
+    # so they are fused first, which leaves a compound of separate tools just
+    # like 'cutThruAll' would build.  the tool for each variant of key is only
+    # built once, around the origin, and then moved to every key using it.
+    def make_tools(self, p, cuts):
+        direction = p.plane.zDir.multiply(-p.largestDimension())
+        variants = {}
+        tools = []
+        for key_cuts, center in cuts:
+            variant = tuple(profile.key for profile in key_cuts)
+            if variant not in variants:
+                tool = None
+                for profile in key_cuts:
+                    points = [p.plane.toWorldCoords(pt).sub(p.plane.origin)
+                              for pt in profile.points]
+                    solid = cadquery.Solid.extrudeLinear(
+                        cadquery.Wire.makePolygon(points), [], direction)
+                    tool = solid if tool is None else tool.fuse(solid)
+                variants[variant] = tool
+            tools.append(variants[variant].translate(p.plane.toWorldCoords(
+                (center[0] - self.origin[0], center[1] - self.origin[1]))))
+        return tools
+
+    # start from the switch layer of the base build and work out what has to
+    # change: the plate is put back where keys were removed and only the new
+    # keys (and the ones next to a removed key) are left to cut.  returns the
+    # solid to cut and the cuts to make.
+    def diff_cuts(self, p, blank):
+        base_cuts, solid = self.base[1], self.base[2]
+        old = collections.Counter(base_cuts)
+        new = collections.Counter(self.pending_cuts)
+        removed = list((old - new).elements())
+        added = list((new - old).elements())
+        if removed:
+            gone = cadquery.Compound.makeCompound(self.make_tools(p, removed))
+            with self.timings.sample('boolean'):
+                solid = solid.fuse(blank.intersect(gone))
+            # merge the faces split by putting the plate back
+            solid = cadquery.Shape.cast(solid.wrapped.removeSplitter())
+            # the plate put back can cover part of a key next to it
+            kept = list((old & new).elements())
+            gone_bounds = placement.bounds(removed)
+            added.extend(cut for cut, b in zip(kept, placement.bounds(kept))
+                         if any(sketch.overlaps(b, g) for g in gone_bounds))
+        log.info("Incremental build: %s keys removed, %s keys to cut",
+                 len(removed), len(added))
+        self.report('incremental', removed=len(removed), cut=len(added))
+        return solid, added
+
+    # the number of cutouts, the area and the volume of the layer 'p', which
+    # have to stay the same whichever way the plate is built
+    def measure(self, p):
+        if self.engine == '2d':
+            cutouts = len(p.cuts)
+            area = p.area()
+            volume = area*self.thickness
+        else:
+            face = p.faces('<Z').val()
+            cutouts = len(face.Wires()) - 1
+            area = face.Area()
+            volume = p.findSolid().Volume()
+        return {'cutouts': cutouts, 'area': round(area, 3),
+                'volume': round(volume, 3)}
+
     # sets the center and also records the relative distance it moved in
     # relation to 'origin'
     def center(self, p, x, y):
@@ -581,129 +420,346 @@ class Plate(object):
         self.origin = (_x+x, _y+y)
         return p.center(x, y)
 
-    def __repr__(self):
-        '''Print out all Plate object configuration settings.'''
-
-        settings = {}
-
-        settings['plate_layout'] = self.layout
-        settings['switch_type'] = self.switch_type
-        settings['stabilizer_type'] = self.stab_type
-        settings['case_type_and_holes'] = self.case
-        settings['width_padding'] = self.x_pad
-        settings['height_padding'] = self.y_pad
-        settings['plate_corners'] = self.fillet
-        settings['kerf'] = self.kerf
-        # XXX line colour?
-
-        return json.dumps(settings, sort_keys=True, indent=4,
-                          separators=(',', ': '))
+    # sets the center to 'c', measured from the center of the plate
+    def move_to(self, p, c):
+        return self.center(p, c[0] - self.origin[0], c[1] - self.origin[1])
 
     def export(self, p, result, label, data_hash, config):
-        # export the plate to different file formats
-        log.info("Exporting %s layer for %s" % (label, data_hash))
-        # draw the part so we can export it
-        Part.show(p.val().wrapped)
-        doc = FreeCAD.ActiveDocument
-        # export the drawing into different formats
-        #   the absolute part of the working directory (aka - outside the web
-        #   space)
+        self.check()
+        if self.engine == '2d':
+            return self.export_sketch(p, result, label, data_hash, config)
+        result['exports'][label] = []
+        formats = [f for f in result['formats'] if f != 'json']
+        path = None
+        if self.layers:
+            with self.timings.stage('save_layer'):
+                path = self.layers.save_layer(data_hash, label, p.val())
+        if self.fan_out and path and formats:
+            # each format is exported from the saved layer by its own
+            # process, while the next layer is being cut
+            log.info("Exporting %s layer for %s in the background" %
+                     (label, data_hash))
+            for name in formats:
+                self.fan_out.submit({
+                    'brep': path, 'label': label, 'hash': data_hash,
+                    'format': name, 'export': config['app']['export'],
+                    'pwd': config['app']['pwd'],
+                    'tolerances': self.tolerances,
+                    'precompress': config['app']['precompress'],
+                    'precompress_min_size':
+                        config['app']['precompress_min_size']})
+        else:
+            started = [time.time()]
+
+            def exported(name):
+                self.timings.export(label, name, time.time() - started[0])
+                started[0] = time.time()
+                self.report('export', layer=label, format=name)
+            with self.timings.stage('export'):
+                result['exports'][label] = export_shape(
+                    p.val(), label, data_hash, formats, config, exported,
+                    self.check, self.tolerances)
+        if path:
+            result['exports'][label].extend(
+                dict(export_url(label, data_hash, name, config), lazy=True)
+                for name in self.lazy_formats)
+        if 'json' in result['formats'] and label == SWITCH_LAYER:
+            self.export_json(result, label, data_hash, config)
+
+    # wait for the exports running in the background and add them to the
+    # result, in the same order as the formats
+    def finish_exports(self, result):
+        if not self.fan_out:
+            return
+        for task, export in self.fan_out.wait(self.check):
+            result['exports'][task['label']].append(export)
+        formats = result['formats'] + self.lazy_formats
+        for exports in result['exports'].values():
+            exports.sort(key=lambda e: formats.index(e['name']))
+
+    # stop whatever is still exporting (when the build failed)
+    def stop_exports(self):
+        if self.fan_out:
+            self.fan_out.stop()
+
+    def export_json(self, result, label, data_hash, config):
+        pwd_len = len(config['app']['pwd'])
+        with open("%s/%s_%s.json" % (config['app']['export'], label,
+                  data_hash), 'w') as json_file:
+            json_file.write(repr(self))
+        compress.precompress("%s/%s_%s.json" % (config['app']['export'],
+                                                label, data_hash), config)
+        result['exports'][label].append(
+            {'name': 'json', 'url': '%s/%s_%s.json' %
+                (config['app']['export'][pwd_len:], label, data_hash)})
+        log.info("Exported 'JSON'")
+        self.report('export', layer=label, format='json')
+
+    # export a flat sketch of the plate, written directly without FreeCAD
+    def export_sketch(self, p, result, label, data_hash, config):
+        log.info("Exporting %s sketch for %s" % (label, data_hash))
         pwd_len = len(config['app']['pwd'])
         result['exports'][label] = []
-        if 'js' in result['formats']:
+        writers = [('dxf', sketch.write_dxf), ('svg', sketch.write_svg)]
+        for name, writer in writers:
+            if name in result['formats']:
+                self.check()
+                started = time.time()
+                with open("%s/%s_%s.%s" % (config['app']['export'], label,
+                                           data_hash, name), "w") as f:
+                    writer(p, f)
+                compress.precompress("%s/%s_%s.%s" % (
+                    config['app']['export'], label, data_hash, name), config)
+                self.timings.export(label, name, time.time() - started)
+                result['exports'][label].append(
+                    {'name': name, 'url': '%s/%s_%s.%s' %
+                        (config['app']['export'][pwd_len:], label, data_hash,
+                         name)})
+                log.info("Exported '%s'" % name.upper())
+                self.report('export', layer=label, format=name)
+        if 'json' in result['formats'] and label == SWITCH_LAYER:
+            self.export_json(result, label, data_hash, config)
+
+
+# the export of the 'label' layer as 'name'
+def export_url(label, data_hash, name, config):
+    # the absolute part of the working directory (aka - outside the web space)
+    pwd_len = len(config['app']['pwd'])
+    return {'name': name, 'url': '%s/%s_%s.%s' % (
+        config['app']['export'][pwd_len:], label, data_hash, name)}
+
+
+# export the layer 'shape' to each of 'formats' and return the exports.
+# 'report(format)' is called after each one and 'check()' before each one.
+# the tessellated formats use the (linear, angular) deflection in
+# 'tolerances' (see 'mesh.tolerances', the configured ones by default) and
+# their exports have the number of 'triangles'.
+def export_shape(shape, label, data_hash, formats, config, report=None,
+                 check=None, tolerances=None):
+    load_cad()
+    if tolerances is None:
+        tolerances = mesh.tolerances({}, config)
+    if check:
+        check()
+    log.info("Exporting %s layer for %s" % (label, data_hash))
+    # draw the part in a document of its own so we can export it
+    with document('export') as doc:
+        feature = doc.addObject('Part::Feature', label)
+        feature.Shape = shape.wrapped
+        doc.recompute()
+        # export the drawing into different formats
+        exports = []
+
+        def exported(name, triangles=None):
+            compress.precompress("%s/%s_%s.%s" % (
+                config['app']['export'], label, data_hash, name), config)
+            exports.append(export_url(label, data_hash, name, config))
+            if triangles is not None:
+                exports[-1]['triangles'] = triangles
+            log.info("Exported '%s'" % name.upper())
+            if report:
+                report(name)
+            if check:
+                check()
+        if 'js' in formats:
             with open("%s/%s_%s.js" % (config['app']['export'], label,
                                        data_hash), "w") as f:
-                cadquery.exporters.exportShape(p, 'TJS', f)
-                result['exports'][label].append(
-                    {'name': 'js', 'url': '%s/%s_%s.js' %
-                        (config['app']['export'][pwd_len:], label, data_hash)})
-                log.info("Exported 'JS'")
-        if 'brp' in result['formats']:
+                cadquery.exporters.exportShape(shape, 'TJS', f,
+                                               tolerances['js'][0])
+            exported('js')
+        for name in mesh.FORMATS:
+            if name in formats:
+                vertices, triangles = triangulate(shape,
+                                                  tolerances[name]).Topology
+                with open("%s/%s_%s.%s" % (config['app']['export'], label,
+                                           data_hash, name), "wb") as f:
+                    mesh.write_glb([(v.x, v.y, v.z) for v in vertices],
+                                   triangles, f)
+                exported(name, len(triangles))
+        if 'brp' in formats:
             Part.export(doc.Objects, "%s/%s_%s.brp" %
                         (config['app']['export'], label, data_hash))
-            result['exports'][label].append(
-                {'name': 'brp', 'url': '%s/%s_%s.brp' %
-                    (config['app']['export'][pwd_len:], label, data_hash)})
-            log.info("Exported 'BRP'")
-        if 'stp' in result['formats']:
+            exported('brp')
+        if 'stp' in formats:
             Part.export(doc.Objects, "%s/%s_%s.stp" %
                         (config['app']['export'], label, data_hash))
-            result['exports'][label].append(
-                {'name': 'stp', 'url': '%s/%s_%s.stp' %
-                    (config['app']['export'][pwd_len:], label, data_hash)})
-            log.info("Exported 'STP'")
-        if 'stl' in result['formats']:
-            Mesh.export(doc.Objects, "%s/%s_%s.stl" %
-                        (config['app']['export'], label, data_hash))
-            result['exports'][label].append(
-                {'name': 'stl', 'url': '%s/%s_%s.stl' %
-                    (config['app']['export'][pwd_len:], label, data_hash)})
-            log.info("Exported 'STL'")
-        if 'dxf' in result['formats']:
+            exported('stp')
+        if 'stl' in formats:
+            stl = triangulate(shape, tolerances['stl'])
+            stl.write("%s/%s_%s.stl" % (config['app']['export'], label,
+                                        data_hash))
+            exported('stl', stl.CountFacets)
+        if 'dxf' in formats:
             importDXF.export(doc.Objects, "%s/%s_%s.dxf" %
                              (config['app']['export'], label, data_hash))
-            result['exports'][label].append(
-                {'name': 'dxf', 'url': '%s/%s_%s.dxf' %
-                    (config['app']['export'][pwd_len:], label, data_hash)})
-            log.info("Exported 'DXF'")
-        if 'svg' in result['formats']:
+            exported('dxf')
+        if 'svg' in formats:
             importSVG.export(doc.Objects, "%s/%s_%s.svg" %
                              (config['app']['export'], label, data_hash))
-            result['exports'][label].append(
-                {'name': 'svg', 'url': '%s/%s_%s.svg' %
-                    (config['app']['export'][pwd_len:], label, data_hash)})
-            log.info("Exported 'SVG'")
-        if 'json' in result['formats'] and label == SWITCH_LAYER:
-            with open("%s/%s_%s.json" % (config['app']['export'], label,
-                      data_hash), 'w') as json_file:
-                json_file.write(repr(self))
-            result['exports'][label].append(
-                {'name': 'json', 'url': '%s/%s_%s.json' %
-                    (config['app']['export'][pwd_len:], label, data_hash)})
-            log.info("Exported 'JSON'")
-        # remove all the documents from the view before we move on
-        for o in doc.Objects:
-            doc.removeObject(o.Label)
+            exported('svg')
+        return exports
+
+
+# a FreeCAD mesh of 'shape' with the (linear, angular) deflection 'tolerance'
+def triangulate(shape, tolerance):
+    return MeshPart.meshFromShape(
+        Shape=shape.wrapped, LinearDeflection=tolerance[0],
+        AngularDeflection=tolerance[1], Relative=False)
+
+
+# a new FreeCAD document, which is closed (and everything in it freed) when
+# the block is done with it
+@contextlib.contextmanager
+def document(name):
+    doc = FreeCAD.newDocument(name)
+    try:
+        yield doc
+    finally:
+        FreeCAD.closeDocument(doc.Name)
+
+
+# the blank plates and the switch layers this worker shares with the others,
+# set up by the first build, and its export processes, started by the first
+# 3d build which exports in the background
+blank_cache = None
+layer_store = None
+fan_out = None
+
+
+def load_brep(path):
+    load_cad()
+    return cadquery.Shape.cast(Part.read(path))
+
+
+def save_brep(shape, path):
+    shape.wrapped.exportBrep(path)
 
 
 # take the input from the webserver and instantiate and draw the plate
-def build(data_hash, data, config):
+#   'formats' limits the export to those formats, which is used to rebuild
+#   the files missing from a cached result.  they are exported from the
+#   saved layers when there are any (see 'export_saved'), the plate is only
+#   cut again when there are not.
+#   'fingerprint' adds the fingerprint of the switch layer to the result (see
+#   'Plate.measure')
+#   'profile' runs the build under cProfile, see 'profile_build'
+#   'check()' raises to stop the build, see 'Plate.set_check'
+def build(data_hash, data, config, progress=None, formats=None,
+          fingerprint=False, profile=False, check=None):
+    if profile:
+        return profile_build(data_hash, data, config, progress=progress,
+                             formats=formats, fingerprint=fingerprint,
+                             check=check)
     # create the result object
-    #   Have to use a copy in case we remove SVG later
     result = {}
-    result['has_layers'] = False
-    result['plates'] = [SWITCH_LAYER]
-    result['formats'] = cfg['app']['formats'][:]
+    result['plates'] = planner.plates(data)
+    result['has_layers'] = len(result['plates']) > 1
+    result['formats'] = formats or requested_formats(data, config)
     result['exports'] = {}
+    global blank_cache, layer_store, fan_out
+    if blank_cache is None:
+        blank_cache = blanks.BlankCache(config, load_brep, save_brep)
+        layer_store = layers.LayerStore(config, load_brep, save_brep)
+    if formats and layer_store.exportable(data_hash, data, formats):
+        return export_saved(data_hash, data, config, formats, progress, check)
     p = Plate()
-    if 'case-type' in data:
-        if data['case-type'] == 'poker':
-            if 'mount-holes-size' in data:
-                p.set_poker_holes(float(data['mount-holes-size']))
-        if data['case-type'] == 'sandwich':
-            result['plates'] = result['plates'] + [OPEN_LAYER, CLOSED_LAYER,
-                                                   BOTTOM_LAYER]
-            result['has_layers'] = True
-            if 'mount-holes-num' in data and 'mount-holes-size' in data:
-                p.set_sandwich_holes(int(data['mount-holes-num']),
-                                     float(data['mount-holes-size']))
-    if 'switch-type' in data:
-        p.set_switch_type(int(data['switch-type']))
-    if 'stab-type' in data:
-        p.set_stab_type(int(data['stab-type']))
-    if 'width-padding' in data:
-        p.set_x_pad(float(data['width-padding']))
-    if 'height-padding' in data:
-        p.set_y_pad(float(data['height-padding']))
-    if 'fillet' in data:
-        p.set_fillet(float(data['fillet']))
-    if 'thickness' in data:
-        p.set_thickness(float(data['thickness']))
-    if 'kerf' in data:
-        p.set_kerf(float(data['kerf']))
-    if 'export_svg' in data and not data['export_svg']:
-        result['formats'].remove('svg')
-    # draw the plate
-    result = p.draw(result, data['layout'], data_hash, config)
+    p.set_blanks(blank_cache)
+    if data.get('base'):
+        p.set_base(layer_store.get(data['base']))
+    p.set_progress(progress)
+    p.set_check(check)
+    p.set_fingerprint(fingerprint)
+    p.set_cut_mode(config['app']['cut_mode'], config['app']['cut_tile'])
+    p.set_tolerances(mesh.tolerances(data, config))
+    if data.get('engine') == '2d':
+        p.set_engine('2d')
+    else:
+        load_cad()
+        p.set_layers(layer_store, lazy_formats(data, config))
+        if config['app']['export_workers']:
+            def exported(label, name, seconds):
+                p.timings.export(label, name, seconds)
+                p.report('export', layer=label, format=name)
+            if fan_out is None:
+                fan_out = exporter.FanOut(config['app']['export_workers'])
+            fan_out.report = exported
+            p.set_fan_out(fan_out)
+    planner.configure(p, data)
+    # draw the plate.  parsing fills in the size of every key, so the request
+    # is left alone: it is what the cache and the saved layers are keyed by.
+    try:
+        result = p.draw(result, copy.deepcopy(data['layout']), data_hash,
+                        config)
+    finally:
+        p.stop_exports()
+    if p.switch_layer is not None:
+        layer_store.put(data_hash, p.blank_key, p.cuts, data)
     log.info("Finished drawing: %s" % (data_hash))
+    log.info("Build timings for %s: %s" % (
+        data_hash, ', '.join('%s %.3fs' % stage for stage in
+                             sorted(result['timings']['stages'].items()))))
     return result  # return the metadata result to the webserver
+
+
+# build under cProfile, as 'profiler.name(data_hash)' so none of the files of
+# the cached build are touched.  the profile is saved next to the exports as
+# 'profile_<name>.pstats' and as collapsed stacks for flame graphs in
+# 'profile_<name>.folded', the hottest functions are added to the result.
+def profile_build(data_hash, data, config, **options):
+    name = profiler.name(data_hash)
+    result, hottest = profiler.profile(
+        os.path.join(config['app']['export'], 'profile_%s' % name),
+        config['app']['profile_top'], build, name, data, config,
+        **options)
+    result['profile'] = {
+        'pstats': export_url('profile', name, 'pstats', config)['url'],
+        'folded': export_url('profile', name, 'folded', config)['url'],
+        'top': hottest,
+    }
+    return result
+
+
+# export the 'label' layer saved by a previous build as 'format', when it is
+# first downloaded.  returns the export.
+def export_layer(data_hash, data, config, progress=None, label=None,
+                 format=None, check=None):
+    global layer_store
+    if layer_store is None:
+        layer_store = layers.LayerStore(config, load_brep, save_brep)
+    exports = export_shape(
+        layer_store.load_layer(data_hash, label), label, data_hash, [format],
+        config, progress and (lambda name: progress(
+            'export', {'layer': label, 'format': name})), check,
+        mesh.tolerances(data, config))
+    return exports[0]
+
+
+# export every layer saved by the build 'data_hash' of 'data' to 'formats',
+# the ones missing from its cached result.  returns the result to merge into
+# the cached one, with the timings of the exports.
+def export_saved(data_hash, data, config, formats, progress=None, check=None):
+    log.info("Exporting %s from the saved layers of %s" % (
+        ','.join(formats), data_hash))
+    timings = metrics.Timings()
+    tolerances = mesh.tolerances(data, config)
+    result = {'plates': planner.plates(data), 'formats': formats,
+              'exports': {}}
+    for label in result['plates']:
+        started = [time.time()]
+
+        def exported(name, label=label):
+            timings.export(label, name, time.time() - started[0])
+            started[0] = time.time()
+            if progress:
+                progress('export', {'layer': label, 'format': name})
+        with timings.stage('export'):
+            result['exports'][label] = export_shape(
+                layer_store.load_layer(data_hash, label), label, data_hash,
+                formats, config, exported, check, tolerances)
+    result['timings'] = timings.summary()
+    return result
+
+
+# work out the geometry of a request without drawing anything
+def plan(data, config):
+    return planner.plan(data, config)
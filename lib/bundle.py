@@ -0,0 +1,145 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import struct
+import time
+import zlib
+
+CHUNK = 64*1024
+
+LOCAL_HEADER = 0x04034b50
+DATA_DESCRIPTOR = 0x08074b50
+CENTRAL_HEADER = 0x02014b50
+END_OF_CENTRAL = 0x06054b50
+DEFLATED = 8
+VERSION = 20  # deflate
+FLAG_DESCRIPTOR = 0x08  # the sizes and crc follow the data
+MADE_BY_UNIX = 3 << 8
+FILE_MODE = 0o644 << 16
+
+
+# the (name in the archive, path) of every export of a build which is on
+# disk, by layer in the order of the plates.  'path(url)' is the file behind
+# an export url.
+def members(result, path):
+    files = []
+    for label in result['plates']:
+        for export in result['exports'].get(label, []):
+            if os.path.exists(path(export['url'])):
+                files.append(('%s.%s' % (label, export['name']),
+                              path(export['url'])))
+    return files
+
+
+def dos_time(seconds):
+    t = time.localtime(seconds)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) |
+            t.tm_mday)
+
+
+# where the deflate data of a gzip file written by 'compress.write_gzip'
+# starts and how long it is, with its crc and uncompressed size.  None when
+# it is not a single deflated member.
+def gzip_member(path):
+    with open(path, 'rb') as gz:
+        header = gz.read(10)
+        if len(header) < 10 or header[:3] != b'\x1f\x8b\x08':
+            return None
+        flags = ord(header[3:4])
+        if flags & 4:  # extra field
+            gz.read(struct.unpack('<H', gz.read(2))[0])
+        for flag in (8, 16):  # file name, comment
+            if flags & flag:
+                while gz.read(1) not in (b'\0', b''):
+                    pass
+        if flags & 2:  # header crc
+            gz.read(2)
+        start = gz.tell()
+        gz.seek(-8, os.SEEK_END)
+        end = gz.tell()
+        crc, size = struct.unpack('<II', gz.read(8))
+    if end < start:
+        return None
+    return start, end - start, crc, size
+
+
+def read(path, start=0, length=None):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length is None or length > 0:
+            chunk = f.read(CHUNK if length is None else min(CHUNK, length))
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+
+# the ZIP archive of 'files' ((name, path) pairs), as it is written.  nothing
+# but a chunk of a file is held at a time: the deflate data of a file's gzip
+# sibling is copied as it is, the other files are deflated on the way and
+# followed by their crc and sizes.  the files have to be under 4 GB (there
+# is no ZIP64).
+def zip_chunks(files):
+    central = []
+    offset = 0
+    for name, path in files:
+        name = name.encode('utf-8')
+        mod_time, mod_date = dos_time(os.path.getmtime(path))
+        member = None
+        if os.path.exists(path + '.gz'):
+            member = gzip_member(path + '.gz')
+        if member:
+            start, length, crc, size = member
+            flags = 0
+        else:
+            crc = length = size = 0
+            flags = FLAG_DESCRIPTOR
+        header = struct.pack('<IHHHHHIIIHH', LOCAL_HEADER, VERSION, flags,
+                             DEFLATED, mod_time, mod_date, crc, length, size,
+                             len(name), 0) + name
+        yield header
+        if member:
+            for chunk in read(path + '.gz', start, length):
+                yield chunk
+            written = len(header) + length
+        else:
+            deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            for chunk in read(path):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = deflate.compress(chunk)
+                length += len(data)
+                if data:
+                    yield data
+            data = deflate.flush()
+            length += len(data)
+            crc &= 0xffffffff
+            descriptor = struct.pack('<IIII', DATA_DESCRIPTOR, crc, length,
+                                     size)
+            yield data + descriptor
+            written = len(header) + length + len(descriptor)
+        central.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', CENTRAL_HEADER, MADE_BY_UNIX | VERSION,
+            VERSION, flags, DEFLATED, mod_time, mod_date, crc, length, size,
+            len(name), 0, 0, 0, 0, FILE_MODE, offset) + name)
+        offset += written
+    directory = b''.join(central)
+    yield directory + struct.pack('<IHHHHIIH', END_OF_CENTRAL, 0, 0,
+                                  len(central), len(central), len(directory),
+                                  offset, 0)
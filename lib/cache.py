@@ -0,0 +1,192 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import json
+import logging
+import os
+
+from lib import sketch
+
+log = logging.getLogger()
+
+
+# the formats a request should be exported to.  a request can list the
+# 'formats' it wants, otherwise it gets all of them but the lazy ones.
+def requested_formats(data, config):
+    if isinstance(data.get('formats'), list):
+        formats = [f for f in config['app']['formats']
+                   if f in data['formats']]
+    else:
+        formats = [f for f in config['app']['formats']
+                   if f not in config['app']['lazy_formats']]
+        if 'export_svg' in data and not data['export_svg'] and \
+                'svg' in formats:
+            formats.remove('svg')
+    if data.get('engine') == '2d':
+        formats = [f for f in formats if f in sketch.FORMATS]
+    return formats
+
+
+# the formats which are only exported when they are first downloaded, from the
+# layers saved by a 3d build
+def lazy_formats(data, config):
+    if data.get('engine') == '2d':
+        return []
+    formats = requested_formats(data, config)
+    return [f for f in config['app']['lazy_formats'] if f not in formats]
+
+
+# the parts of a request an export on demand needs again, saved with its
+# manifest since the request itself is not
+def export_settings(data):
+    return dict((key, data[key]) for key in ('mesh_tolerance',)
+                if key in data)
+
+
+# a digest of the canonical input, stored with the manifest so a result is
+# never served for different input saved under the same name (kb_cli uses the
+# layout file name instead of a hash when building from a file).  the 'base' a
+# build starts from does not change what is built and the 'formats' only which
+# files are exported (the missing ones are built on a lookup), so they are
+# left out.
+def digest(data):
+    data = dict((k, v) for k, v in data.items()
+                if k not in ('base', 'formats'))
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+# keeps the result of every build (the 'width', 'height', 'plates' and
+# 'exports' returned by builder.build) as a manifest on disk, named by the
+# hash of the request.
+class ResultCache(object):
+    def __init__(self, config):
+        self.config = config
+        self.path = config['app']['cache']
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def manifest_path(self, data_hash):
+        return os.path.join(self.path, '%s.json' % data_hash)
+
+    # the file on disk behind an export url
+    def artifact_path(self, url):
+        return os.path.join(self.config['app']['pwd'], url.lstrip('/'))
+
+    def load(self, data_hash, data=None):
+        try:
+            with open(self.manifest_path(data_hash)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+        if data is not None and manifest.get('input') != digest(data):
+            return None
+        return manifest
+
+    # does the build 'data_hash' offer the 'label' layer as 'name' on demand
+    def is_lazy(self, data_hash, label, name):
+        manifest = self.load(data_hash)
+        if not manifest:
+            return False
+        return any(export['name'] == name and export.get('lazy')
+                   for export in manifest['result']['exports'].get(label, []))
+
+    # the 'export_settings' of the request the build 'data_hash' was made for
+    def settings(self, data_hash):
+        manifest = self.load(data_hash)
+        return (manifest or {}).get('settings') or {}
+
+    # record an export built on demand in place of its lazy entry
+    def put_export(self, data_hash, label, export):
+        manifest = self.load(data_hash)
+        if not manifest:
+            return
+        exports = manifest['result']['exports'].get(label, [])
+        manifest['result']['exports'][label] = [
+            export if e['name'] == export['name'] else e for e in exports]
+        self.save(data_hash, manifest)
+
+    # look up a previous build of this request.  returns the cached result
+    # (or None) and the formats which have to be built again because they
+    # were never exported or their files have since been removed.
+    def lookup(self, data_hash, data):
+        manifest = self.load(data_hash, data)
+        if not manifest:
+            self.misses += 1
+            return None, None
+        wanted = requested_formats(data, self.config)
+        found = set()
+        lost = set()
+        for exports in manifest['result']['exports'].values():
+            for export in exports:
+                if export.get('lazy'):  # only exported when downloaded
+                    continue
+                if os.path.exists(self.artifact_path(export['url'])):
+                    found.add(export['name'])
+                else:
+                    lost.add(export['name'])
+        missing = [f for f in wanted if f in lost or f not in found]
+        if missing:
+            self.misses += 1
+            log.info("Cache needs %s for %s", ','.join(missing), data_hash)
+        else:
+            self.hits += 1
+            log.info("Cache hit for %s", data_hash)
+        return manifest['result'], missing
+
+    # save a build result, merging it with what was already cached when only
+    # some of the formats were rebuilt (and the rest of the result is kept).
+    # an export which is on disk is kept over the lazy entry a rebuild offers
+    # in its place.  returns the merged result.
+    def put(self, data_hash, data, result):
+        manifest = self.load(data_hash, data)
+        if manifest:
+            cached = manifest['result']
+            merged = dict(cached)
+            merged.update(result)
+            merged['exports'] = dict(cached['exports'])
+            for plate, exports in result['exports'].items():
+                kept = [export for export in
+                        cached['exports'].get(plate, [])
+                        if not export.get('lazy') and os.path.exists(
+                            self.artifact_path(export['url']))]
+                names = set(export['name'] for export in kept)
+                rebuilt = [export for export in exports
+                           if not (export.get('lazy') and
+                                   export['name'] in names)]
+                names = set(export['name'] for export in rebuilt)
+                merged['exports'][plate] = [
+                    export for export in cached['exports'].get(plate, [])
+                    if export['name'] not in names] + rebuilt
+            merged['formats'] = [f for f in requested_formats(data,
+                                                              self.config)
+                                 if f in cached['formats'] or
+                                 f in result['formats']]
+            result = merged
+        self.save(data_hash, {'input': digest(data),
+                              'settings': export_settings(data),
+                              'result': result})
+        return result
+
+    def save(self, data_hash, manifest):
+        path = self.manifest_path(data_hash)
+        # write to the side and move it in place so readers never see half a
+        # manifest
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(path + '.tmp', path)
@@ -0,0 +1,101 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import logging
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # only gzip siblings are written
+
+log = logging.getLogger()
+
+# the content encodings of the precompressed siblings of an export, the best
+# first, with the suffix of their files
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+SUFFIXES = tuple(suffix for _, suffix in ENCODINGS)
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # 11 takes far too long on a big STEP file
+# a sibling is only kept when it saves at least this share of the size
+MIN_SAVING = 0.1
+
+
+# write the gzip (and, with the brotli module, the brotli) siblings of the
+# export 'path', when its format is in 'config['app']['precompress']'
+def precompress(path, config):
+    name = path.rpartition('.')[2]
+    if name not in config['app']['precompress']:
+        return
+    size = os.path.getsize(path)
+    if size < config['app']['precompress_min_size']:
+        return
+    write_sibling(path, '.gz', size, write_gzip)
+    if brotli:
+        write_sibling(path, '.br', size, write_brotli)
+
+
+# each sibling is written next to it first, so it is never served half done
+def write_sibling(path, suffix, size, writer):
+    partial = path + suffix + '.tmp'
+    try:
+        with open(path, 'rb') as source:
+            with open(partial, 'wb') as target:
+                writer(source, target)
+        if os.path.getsize(partial) > size*(1 - MIN_SAVING):
+            os.remove(partial)
+        else:
+            os.rename(partial, path + suffix)
+    except (IOError, OSError) as e:
+        log.warning("Could not compress %s: %s", path, e)
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+# a single gzip member without a file name or time, so the same export always
+# gives the same file
+def write_gzip(source, target):
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL,
+                       fileobj=target, mtime=0) as gz:
+        shutil.copyfileobj(source, gz, 64*1024)
+
+
+def write_brotli(source, target):
+    target.write(brotli.compress(source.read(), quality=BROTLI_QUALITY))
+
+
+# the precompressed siblings of the export 'path' which exist
+def siblings(path):
+    return [path + suffix for suffix in SUFFIXES
+            if os.path.exists(path + suffix)]
+
+
+# the encodings an 'Accept-Encoding' header accepts
+def accepted(header):
+    encodings = set()
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        q = [p.strip()[2:] for p in params[1:] if p.strip().startswith('q=')]
+        try:
+            if q and float(q[0]) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(params[0].strip().lower())
+    return encodings
@@ -0,0 +1,119 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import json
+import logging
+import os
+
+from lib import planner
+from lib.cache import requested_formats
+
+log = logging.getLogger()
+
+# how much each finished build moves the weights towards its own timings
+ALPHA = 0.2
+
+# the stages every build goes through once, whatever the layout
+SETUP_STAGES = ('parse_layout', 'blank_cache', 'init_plate', 'case_holes',
+                'save_layer')
+# the stages which take longer with every cutout
+CUT_STAGES = ('cut_keys', 'flush_cuts')
+
+
+# what the time of a build depends on, worked out from the request without
+# any CAD work: the number of keys, of stabilized keys (2u and up, which get
+# a stabilizer cutout too), of layers and the formats to export
+def features(data, config):
+    p = planner.configure(planner.PlatePlan(), data)
+    # parsing fills in the size of every key, so the request is left alone
+    p.parse_layout(copy.deepcopy(data['layout']))
+    keys = [key for row in p.layout for key in row]
+    return {
+        'engine': '2d' if data.get('engine') == '2d' else '3d',
+        'keys': len(keys),
+        'stabs': len([key for key in keys
+                      if max(key.get('w', 1), key.get('h', 1)) >= 2]),
+        'layers': len(planner.plates(data)),
+        'formats': requested_formats(data, config),
+    }
+
+
+# estimates how many seconds a build takes.  each engine has a linear model
+# with a weight for the 'build' itself, each 'cutout', each 'layer' past the
+# switch layer and, in 'export', each format for every cutout and layer.  the
+# weights start from 'config['app']['cost_weights']' and follow the stage
+# timings of the builds as they finish, they are kept in
+# 'config['app']['cost_model']' across restarts.
+class CostModel(object):
+    def __init__(self, config):
+        self.config = config
+        self.path = config['app']['cost_model']
+        self.weights = copy.deepcopy(config['app']['cost_weights'])
+        try:
+            with open(self.path) as model_file:
+                saved = json.load(model_file)
+        except (IOError, ValueError):
+            saved = {}
+        for engine, weights in saved.items():
+            if engine in self.weights:
+                self.weights[engine]['export'].update(weights.pop('export',
+                                                                  {}))
+                self.weights[engine].update(weights)
+
+    def features(self, data):
+        return features(data, self.config)
+
+    def estimate(self, f):
+        w = self.weights[f['engine']]
+        cutouts = f['keys'] + f['stabs']
+        cost = w['build'] + w['cutout']*cutouts + \
+            w['layer']*(f['layers'] - 1)
+        for name in f['formats']:
+            cost += w['export'].get(name, 0)*(cutouts + f['layers'])
+        return cost
+
+    # move the weights towards the 'timings' of a finished build of
+    # 'features' f
+    def calibrate(self, f, timings):
+        w = self.weights[f['engine']]
+        stages = timings['stages']
+        cutouts = f['keys'] + f['stabs']
+
+        def follow(weights, name, value):
+            weights[name] += ALPHA*(value - weights[name])
+        follow(w, 'build', sum(stages.get(stage, 0)
+                               for stage in SETUP_STAGES))
+        if cutouts:
+            follow(w, 'cutout', sum(stages.get(stage, 0)
+                                    for stage in CUT_STAGES)/cutouts)
+        if f['layers'] > 1:
+            follow(w, 'layer', stages.get('cut_layers', 0)/(f['layers'] - 1))
+        exported = {}
+        for layer, name, seconds in timings['exports']:
+            exported[name] = exported.get(name, 0) + seconds
+        for name, seconds in exported.items():
+            w['export'].setdefault(name, 0)
+            follow(w['export'], name, seconds/(cutouts + f['layers']))
+        self.save()
+
+    def save(self):
+        try:
+            with open(self.path + '.tmp', 'w') as model_file:
+                json.dump(self.weights, model_file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            log.warning("Could not save the cost model to %s", self.path)
@@ -0,0 +1,218 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import time
+import traceback
+
+log = logging.getLogger()
+
+# the directory 'lib' is in, which the export processes run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMAND = [sys.executable, '-m', 'lib.exporter']
+# the lines an export process answers with start with this, anything else it
+# prints is FreeCAD talking
+REPLY = 'kb_export '
+
+
+class ExportError(Exception):
+    pass
+
+
+# a long lived export process: it imports the CAD stack once and then exports
+# one task after the other, read as lines of JSON from its stdin
+class ExportProcess(object):
+    def __init__(self, command=COMMAND):
+        self.process = subprocess.Popen(
+            command, cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, close_fds=True)
+        self.buffer = b''
+        self.output = collections.deque(maxlen=10)  # what it printed last
+        self.task = None  # the task it is working on
+        self.started = None
+
+    def send(self, task):
+        self.task = task
+        self.started = time.time()
+        self.process.stdin.write(json.dumps(task).encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+
+    # the replies it sent since the last call, without waiting for more.
+    # everything else it printed is kept in 'output', so a chatty export never
+    # blocks on a full pipe.
+    def read(self):
+        stdout = self.process.stdout
+        while select.select([stdout], [], [], 0)[0]:
+            chunk = os.read(stdout.fileno(), 64*1024)
+            if not chunk:
+                break
+            self.buffer += chunk
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        replies = []
+        for line in lines:
+            line = line.decode('utf-8', 'replace')
+            if line.startswith(REPLY):
+                replies.append(json.loads(line[len(REPLY):]))
+            elif line.strip():
+                self.output.append(line)
+        return replies
+
+    def alive(self):
+        return self.process.poll() is None
+
+    # let it finish and exit, it stops once its stdin is closed
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+# runs the exports of the builds of a worker on 'workers' export processes,
+# which are started when they are first needed and then kept for the next
+# builds.  each task is a dict with the 'brep' file of a layer, its 'label',
+# the build 'hash', the 'format' to export it to, the 'export' and 'pwd'
+# directories, the 'tolerances' of the tessellated formats and the
+# 'precompress' settings.  'report(label, format, seconds)' is called as each
+# export finishes.  the build workers are daemonic processes which
+# multiprocessing does not let have children of their own, so plain
+# subprocesses are used.
+class FanOut(object):
+    def __init__(self, workers, report=None, command=COMMAND):
+        self.workers = workers
+        self.report = report
+        self.command = command
+        self.processes = []
+        self.waiting = []
+        self.exports = []  # (task, export)
+
+    def submit(self, task):
+        self.waiting.append(task)
+        self.poll()
+
+    # collect the finished exports and hand the waiting ones to the idle
+    # processes
+    def poll(self):
+        for process in self.processes[:]:
+            if process.task is None:
+                if not process.alive():
+                    self.processes.remove(process)
+                continue
+            task = process.task
+            for reply in process.read():
+                process.task = None
+                if 'error' in reply:
+                    self.stop()
+                    raise ExportError("Exporting %s as %s failed: %s" % (
+                        task['label'], task['format'], reply['error']))
+                self.exports.append((task, reply['export']))
+                if self.report:
+                    self.report(task['label'], task['format'],
+                                time.time() - process.started)
+            if process.task is not None and not process.alive():
+                process.read()
+                self.processes.remove(process)
+                self.stop()
+                raise ExportError("Exporting %s as %s failed: %s" % (
+                    task['label'], task['format'],
+                    (list(process.output) or ['the export process died'])[-1]
+                ))
+        while self.waiting:
+            idle = [process for process in self.processes
+                    if process.task is None]
+            if idle:
+                process = idle[0]
+            elif len(self.processes) < self.workers:
+                process = ExportProcess(self.command)
+                self.processes.append(process)
+            else:
+                break
+            process.send(self.waiting.pop(0))
+
+    # wait for all the exports, returns a list of (task, export).  'check()'
+    # is called while waiting and can raise to stop waiting.
+    def wait(self, check=None):
+        while self.waiting or any(process.task for process in
+                                  self.processes):
+            if check:
+                check()
+            self.poll()
+            time.sleep(0.05)
+        exports = self.exports
+        self.exports = []
+        return exports
+
+    # drop the waiting exports and kill the processes still exporting (when
+    # the build failed), the idle ones are kept
+    def stop(self):
+        self.waiting = []
+        self.exports = []
+        for process in self.processes[:]:
+            if process.task is not None:
+                process.kill()
+                self.processes.remove(process)
+
+    # end every process and wait for it to exit, once nothing is exported
+    # any more
+    def close(self):
+        self.stop()
+        for process in self.processes:
+            process.close()
+        self.processes = []
+
+
+def reply(message):
+    sys.stdout.write('\n%s%s\n' % (REPLY, json.dumps(message)))
+    sys.stdout.flush()
+
+
+# export layers from their BREP files, a task per line of stdin, until stdin
+# is closed
+def main():
+    from lib import builder
+    builder.load_cad()
+    for line in iter(sys.stdin.readline, ''):
+        task = json.loads(line)
+        config = {'app': {
+            'export': task['export'], 'pwd': task['pwd'],
+            'precompress': task['precompress'],
+            'precompress_min_size': task['precompress_min_size']}}
+        try:
+            exports = builder.export_shape(
+                builder.load_brep(task['brep']), task['label'], task['hash'],
+                [task['format']], config, tolerances=task['tolerances'])
+        except Exception as e:
+            traceback.print_exc()
+            reply({'error': '%s: %s' % (type(e).__name__, e)})
+        else:
+            reply({'export': exports[0]})
+
+
+if __name__ == '__main__':
+    main()
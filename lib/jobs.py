@@ -0,0 +1,512 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import time
+import tornado.concurrent
+import tornado.ioloop
+import uuid
+
+from lib import cost
+from lib import metrics
+from lib import pool
+from lib import profiler
+from lib.cache import requested_formats
+from lib.planner import outputs
+from lib.store import remove_partial
+
+log = logging.getLogger()
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+# a build refused before it was queued: 413 when it would take too long, 429
+# when the client already has too many builds going
+class Rejected(Exception):
+    def __init__(self, status, message, cost=None, retry_after=None):
+        super(Rejected, self).__init__(message)
+        self.status = status
+        self.cost = cost
+        self.retry_after = retry_after
+
+
+class Job(object):
+    def __init__(self, data_hash, data, target='build', key=None,
+                 client=None):
+        self.id = uuid.uuid4().hex
+        self.data_hash = data_hash
+        self.data = data
+        self.target = target  # 'build' or 'export'
+        self.key = key or data_hash  # what identical jobs are coalesced by
+        self.formats = set()  # the formats of the build once it is done
+        self.after = None  # the job of the same build it waits for
+        self.profile = False  # a profiled build, see 'profiler.name'
+        self.client = client  # who asked for it, see 'JobManager.admit'
+        self.features = None  # what the cost was estimated from
+        self.cost = 0  # the estimated seconds of work
+        self.calibrate = False  # do its timings calibrate the cost model
+        self.outputs = []  # the (layer, format) files it writes
+        self.waiters = 0  # open requests waiting on it, see 'JobManager.wait'
+        self.kept = False  # someone will come back for it (/jobs)
+        self.state = QUEUED
+        self.progress = None
+        self.cached = False
+        self.coalesced = 0  # requests which joined this job while it ran
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.events = []  # every (event, payload) reported so far
+        self.listeners = []
+
+    def is_finished(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    # record an event and pass it on to anyone following the job
+    def publish(self, event, payload):
+        self.events.append((event, payload))
+        for listener in self.listeners[:]:
+            listener(event, payload)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    # a future resolved with the result once the job is finished
+    def wait(self):
+        future = tornado.concurrent.Future()
+
+        def resolve(event=None, payload=None):
+            if self.state == DONE:
+                future.set_result(self.result)
+            elif self.state in (FAILED, CANCELLED):
+                future.set_exception(pool.BuildError(self.error))
+            else:
+                return
+            self.unsubscribe(resolve)
+        resolve()
+        if not future.done():
+            self.subscribe(resolve)
+        return future
+
+    def status(self):
+        status = {
+            'id': self.id,
+            'hash': self.data_hash,
+            'state': self.state,
+            'progress': self.progress,
+            'cached': self.cached,
+            'coalesced': self.coalesced,
+            'cost': round(self.cost, 3),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if self.state == DONE:
+            status['result'] = self.result
+        if self.state in (FAILED, CANCELLED):
+            status['error'] = self.error
+        return status
+
+
+# keeps track of the builds handed to the worker pool.  all of the job state is
+# only ever touched on the IOLoop thread.
+#
+# the jobs are not handed to the pool in the order they came in: each build is
+# given an estimate of its cost (see lib/cost.py) and whenever a worker is
+# free the queued job with the lowest cost, less the time it already waited,
+# goes next.  small builds go ahead of the big ones, and the big ones still
+# get their turn once they waited for as long as they would take.
+#
+# a job is cancelled when it runs for longer than 'build_timeout' or every
+# request waiting on it went away.  the worker stops it at the next
+# checkpoint and, if it is stuck somewhere without one, the worker is killed
+# 'cancel_grace' seconds later.  the files it was writing are removed.
+class JobManager(object):
+    def __init__(self, build_pool, cache, config, store=None):
+        self.pool = build_pool
+        self.cache = cache
+        self.store = store  # a store.ExportStore keeping the disk use down
+        self.ttl = config['app']['job_ttl']
+        self.max_cost = config['app']['max_cost']
+        self.client_jobs = config['app']['client_jobs']
+        self.timeout = config['app']['build_timeout']
+        self.grace = config['app']['cancel_grace']
+        self.config = config
+        self.costs = cost.CostModel(config)
+        self.jobs = {}
+        self.building = {}  # job key -> the job building it
+        self.queue = []  # (job, callback, options) waiting for a worker
+        self.dispatched = 0  # jobs handed to the pool and not finished
+        self.coalesced = 0
+        self.metrics = metrics.BuildMetrics()
+        self.io_loop = tornado.ioloop.IOLoop.current()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    # the estimated seconds of work of the build 'data', with what it was
+    # estimated from.  a request which can not be parsed is left for the
+    # build to fail on.
+    def estimate(self, data):
+        try:
+            features = self.costs.features(data)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return 0, None
+        return self.costs.estimate(features), features
+
+    # 'profile' builds under cProfile, even when the result is cached.
+    # 'client' identifies who asked, for 'admit'.
+    def submit(self, data_hash, data, profile=False, client=None):
+        self.expire()
+        if profile:
+            # everything is built again, on its own
+            job = Job(data_hash, data, client=client)
+            job.profile = True
+            job.cost, job.features = self.estimate(data)
+            self.admit(job)
+            job.outputs = outputs(data, self.config)
+            self.jobs[job.id] = job
+            self.enqueue(job, lambda event, payload: self.on_event(
+                job, event, payload), profile=True)
+            return job
+        formats = set(requested_formats(data, self.config))
+        # identical requests share the build already in flight rather than
+        # writing the same files at the same time
+        building = self.building.get(data_hash)
+        if building and formats <= building.formats:
+            building.coalesced += 1
+            self.coalesced += 1
+            log.info("Joined job %s: %s", building.id, data_hash)
+            return building
+        job = Job(data_hash, data, client=client)
+        job.formats = formats
+        if building:
+            # the build in flight does not export all of these formats, the
+            # missing ones are exported once it is done
+            job.cost, job.features = self.estimate(data)
+            self.admit(job)
+            self.jobs[job.id] = job
+            self.building[data_hash] = job
+            self.follow(job, building)
+            return job
+        result, missing = self.cache.lookup(data_hash, data)
+        if result and not missing:
+            self.jobs[job.id] = job
+            job.cached = True
+            self.touch(data_hash)
+            self.finish(job, result)
+            return job
+        job.cost, job.features = self.estimate(data)
+        self.admit(job)
+        self.jobs[job.id] = job
+        self.building[data_hash] = job
+        self.build(job, missing)
+        return job
+
+    # queue 'job' for the 'missing' formats of its cached result, or all of
+    # them
+    def build(self, job, missing):
+        # only whole builds tell how long a build takes
+        job.calibrate = job.features is not None and not missing and \
+            not job.data.get('base')
+        job.outputs = outputs(job.data, self.config, missing)
+        self.enqueue(job, lambda event, payload: self.on_event(
+            job, event, payload), formats=missing)
+
+    # start 'job' once the build 'other' of the same request is finished,
+    # with whatever its result is still missing
+    def follow(self, job, other):
+        def start(event=None, payload=None):
+            if not other.is_finished():
+                return
+            other.unsubscribe(start)
+            job.after = None
+            if job.is_finished():  # cancelled while it waited
+                return
+            result, missing = self.cache.lookup(job.data_hash, job.data)
+            if result and not missing:
+                job.cached = True
+                self.touch(job.data_hash)
+                self.finish(job, result)
+            else:
+                self.build(job, missing)
+        job.after = other
+        other.subscribe(start)
+        log.info("Job %s follows job %s: %s", job.id, other.id,
+                 job.data_hash)
+
+    # refuse the build 'job' when it would take too long or its client has
+    # enough builds going already
+    def admit(self, job):
+        if self.max_cost and job.cost > self.max_cost:
+            self.metrics.rejected.inc(reason='cost')
+            raise Rejected(413, 'the build would take about %d seconds, the '
+                           'limit is %d' % (job.cost, self.max_cost),
+                           cost=job.cost)
+        if self.client_jobs and job.client is not None:
+            now = time.time()
+            going = [other for other in self.jobs.values()
+                     if other.client == job.client and other.target == 'build'
+                     and not other.is_finished()]
+            if len(going) >= self.client_jobs:
+                self.metrics.rejected.inc(reason='client')
+                raise Rejected(
+                    429, 'there are already %s builds going for you' %
+                    len(going), cost=job.cost,
+                    retry_after=max(1, int(min(
+                        other.cost - (now - (other.started or other.created))
+                        for other in going))))
+
+    # queue 'job' for the pool, 'callback(event, payload)' is called on the
+    # IOLoop for the events of the job
+    def enqueue(self, job, callback, **options):
+        def on_event(event, payload):
+            self.io_loop.add_callback(self.on_pool_event, callback, event,
+                                      payload)
+        if self.timeout:
+            options['timeout'] = self.timeout
+        self.queue.append((job, on_event, options))
+        self.schedule()
+
+    # hand the queued jobs to the pool while it has a worker free, the one
+    # with the lowest cost less the time it waited first
+    def schedule(self):
+        while self.queue and self.dispatched < self.pool.size:
+            now = time.time()
+            queued = min(self.queue,
+                         key=lambda queued: queued[0].cost -
+                         (now - queued[0].created))
+            self.queue.remove(queued)
+            job, on_event, options = queued
+            self.dispatched += 1
+            self.pool.submit(job.id, job.data_hash, job.data, on_event,
+                             **options)
+
+    def on_pool_event(self, callback, event, payload):
+        if event in (pool.DONE, pool.ERROR, pool.CANCELLED):
+            self.dispatched -= 1
+            self.schedule()
+        callback(event, payload)
+
+    # export the 'label' layer of the build 'data_hash' as 'name' when the
+    # build only offered it on demand.  returns the job exporting it, or None
+    # if the build has no such export.  someone is waiting on the download,
+    # so it goes ahead of the builds.
+    def export(self, data_hash, label, name):
+        key = 'export:%s:%s:%s' % (data_hash, label, name)
+        if key in self.building:
+            job = self.building[key]
+            job.coalesced += 1
+            self.coalesced += 1
+            return job
+        if not self.cache.is_lazy(data_hash, label, name):
+            return None
+        self.expire()
+        # exported with the mesh tolerance the build was asked for
+        job = Job(data_hash, self.cache.settings(data_hash), target='export',
+                  key=key)
+        job.outputs = [(label, name)]
+        self.jobs[job.id] = job
+        self.building[key] = job
+        self.enqueue(job, lambda event, payload: self.on_export(
+            job, data_hash, label, event, payload),
+            target='export_layer', label=label, format=name)
+        return job
+
+    # a request is waiting on 'job' for as long as its connection is open,
+    # 'leave' when it closed
+    def wait(self, job):
+        job.waiters += 1
+        return job.wait()
+
+    def leave(self, job):
+        job.waiters -= 1
+        if job.waiters <= 0 and not job.kept and not job.is_finished():
+            self.cancel(job, "Cancelled, the client went away")
+
+    # stop 'job', whether it is still queued or already running
+    def cancel(self, job, reason):
+        if job.is_finished():
+            return
+        if job.after:
+            # the build it followed is still running and still owns the
+            # hash, so the next identical request joins it
+            other = job.after
+            self.on_event(job, pool.CANCELLED, reason)
+            if not other.is_finished() and job.key not in self.building:
+                self.building[job.key] = other
+            return
+        for queued in self.queue:
+            if queued[0] is job:
+                self.queue.remove(queued)
+                self.on_event(job, pool.CANCELLED, reason)
+                return
+        log.info("Cancelling job %s: %s", job.id, reason)
+        job.error = reason
+        self.pool.cancel(job.id)
+        self.io_loop.call_later(self.grace, self.overdue, job, reason)
+
+    # the job did not stop at a checkpoint in time, the worker is killed
+    def overdue(self, job, reason):
+        if not job.is_finished():
+            self.pool.kill(job.id, reason)
+
+    def on_export(self, job, data_hash, label, event, payload):
+        if event == pool.DONE:
+            self.cache.put_export(data_hash, label, payload)
+            self.stored(data_hash)
+            self.finish(job, payload)
+        else:
+            self.on_event(job, event, payload)
+
+    # forget the job as the one building its key
+    def release(self, job):
+        if self.building.get(job.key) is job:
+            del self.building[job.key]
+
+    # a build was used, so it is the last to be evicted
+    def touch(self, data_hash):
+        if self.store:
+            self.store.touch(data_hash)
+
+    # the files of a build were written, count them against the quota.  the
+    # disk and the index are left to the thread of the store.
+    def stored(self, data_hash):
+        if self.store:
+            keep = set()
+            for job in self.jobs.values():
+                if not job.is_finished():
+                    keep.add(profiler.name(job.data_hash) if job.profile
+                             else job.data_hash)
+            self.store.record_later(data_hash, keep)
+
+    def finish(self, job, result):
+        self.release(job)
+        job.state = DONE
+        job.result = result
+        job.finished = time.time()
+        self.observe(job)
+        job.publish(DONE, job.status())
+
+    def observe(self, job):
+        state = 'cached' if job.cached else job.state
+        self.metrics.jobs.inc(target=job.target, state=state)
+        self.metrics.job_seconds.observe(job.finished - job.created,
+                                         target=job.target)
+        if job.started:
+            self.metrics.wait_seconds.observe(job.started - job.created,
+                                              target=job.target)
+        if job.state == DONE and not job.cached and \
+                'timings' in (job.result or {}):
+            self.metrics.observe_timings(job.result['timings'])
+            if job.calibrate:
+                self.costs.calibrate(job.features, job.result['timings'])
+
+    def on_event(self, job, event, payload):
+        if event == pool.STARTED:
+            job.state = RUNNING
+            job.started = time.time()
+            if self.timeout:
+                self.io_loop.call_later(
+                    self.timeout + self.grace, self.overdue, job,
+                    "Timed out after %s seconds" % self.timeout)
+            job.publish(RUNNING, job.status())
+        elif event == pool.PROGRESS:
+            job.progress = payload
+            job.publish(pool.PROGRESS, payload)
+        elif event == pool.DONE:
+            if job.profile:
+                # only for the admin who asked, it is never cached
+                self.stored(profiler.name(job.data_hash))
+                self.finish(job, payload)
+                return
+            result = self.cache.put(job.data_hash, job.data, payload)
+            self.stored(job.data_hash)
+            self.finish(job, result)
+        elif event == pool.ERROR:
+            self.release(job)
+            job.state = FAILED
+            # only the last line of the traceback is shown to the client
+            job.error = payload.strip().splitlines()[-1]
+            job.finished = time.time()
+            self.observe(job)
+            job.publish(FAILED, job.status())
+        elif event == pool.CANCELLED:
+            self.release(job)
+            if job.started:
+                remove_partial(self.config, self.cache, profiler.name(
+                    job.data_hash) if job.profile else job.data_hash,
+                    job.outputs)
+            job.state = CANCELLED
+            job.error = job.error or payload
+            job.finished = time.time()
+            self.observe(job)
+            job.publish(CANCELLED, job.status())
+
+    def stats(self):
+        return {
+            'jobs': len(self.jobs),
+            'building': len(self.building),
+            'coalesced': self.coalesced,
+            'queued': len(self.queue),
+            'dispatched': self.dispatched,
+            'cost_weights': self.costs.weights,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'store_bytes': self.store.total if self.store else None,
+            'evicted': self.store.evicted if self.store else 0,
+            'workers': self.pool.worker_stats(),
+            'workers_retired': self.pool.retired,
+            'workers_died': self.pool.died,
+        }
+
+    # the metrics in the prometheus text format, with the gauges brought up to
+    # date
+    def render_metrics(self):
+        m = self.metrics
+        m.cache.set(self.cache.hits, result='hit')
+        m.cache.set(self.cache.misses, result='miss')
+        if self.store:
+            m.store_bytes.set(self.store.total)
+            m.evicted.set(self.store.evicted)
+        m.queued.set(sum(1 for job in self.jobs.values()
+                         if job.state == QUEUED))
+        m.running.set(sum(1 for job in self.jobs.values()
+                          if job.state == RUNNING))
+        m.retired.set(self.pool.retired)
+        m.died.set(self.pool.died)
+        m.workers.clear()
+        for pid in self.pool.pids():
+            rss = metrics.rss(pid)
+            if rss is not None:
+                m.workers.set(rss, pid=pid)
+        return metrics.render(m.all())
+
+    # forget about jobs which finished a while ago
+    def expire(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.is_finished() and now - job.finished > self.ttl:
+                del self.jobs[job_id]
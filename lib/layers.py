@@ -0,0 +1,107 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import json
+import logging
+import os
+
+from lib.cache import digest
+from lib.planner import SWITCH_LAYER, plates
+from lib.profiles import Profile
+
+log = logging.getLogger()
+
+
+# keeps the layers of every 3d build, so the formats which were left out can be
+# exported from them later, and the blank the switch layer was cut from
+# together with the cutouts of each key, so a later build of a slightly
+# different layout can start from it.  'load(path)' and 'save(solid, path)'
+# read and write a BREP file.
+class LayerStore(object):
+    def __init__(self, config, load, save):
+        self.path = config['app']['layers']
+        self.load = load
+        self.save = save
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    # builds from kb_cli are named after their layout file, so the names are
+    # hashed to be safe to use as file names
+    def layer_path(self, data_hash, ext, label=None):
+        name = hashlib.sha1(data_hash.encode('utf-8')).hexdigest()
+        if label:
+            name = '%s_%s' % (name, label)
+        return os.path.join(self.path, '%s.%s' % (name, ext))
+
+    # every file saved for the build 'data_hash'
+    def files(self, data_hash):
+        name = os.path.basename(self.layer_path(data_hash, 'json'))[:-5]
+        return [os.path.join(self.path, f) for f in os.listdir(self.path)
+                if f == name + '.json' or f.startswith(name + '_')]
+
+    # save the 'label' layer of a build, returns the path of its BREP file
+    def save_layer(self, data_hash, label, solid):
+        path = self.layer_path(data_hash, 'brp', label)
+        self.save(solid, path + '.%s.tmp' % os.getpid())
+        os.rename(path + '.%s.tmp' % os.getpid(), path)
+        return path
+
+    def load_layer(self, data_hash, label):
+        return self.load(self.layer_path(data_hash, 'brp', label))
+
+    # returns the (blank key, cuts, switch layer) of a build, or None
+    def get(self, data_hash):
+        try:
+            with open(self.layer_path(data_hash, 'json')) as state_file:
+                state = json.load(state_file)
+            solid = self.load_layer(data_hash, SWITCH_LAYER)
+        except (IOError, ValueError):
+            log.info("No switch layer saved for %s", data_hash)
+            return None
+        cuts = [(tuple(Profile(tuple(key), tuple(tuple(pt) for pt in points))
+                       for key, points in profiles), tuple(center))
+                for profiles, center in state['cuts']]
+        return state['blank'], cuts, solid
+
+    # can the 'formats' missing from the cached build 'data_hash' of 'data' be
+    # exported from its saved layers, rather than building it again.  the
+    # 'json' export describes the plate itself, which is not saved.
+    def exportable(self, data_hash, data, formats):
+        if data.get('engine') == '2d' or 'json' in formats:
+            return False
+        try:
+            with open(self.layer_path(data_hash, 'json')) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            return False
+        return state.get('input') == digest(data) and all(
+            os.path.exists(self.layer_path(data_hash, 'brp', label))
+            for label in plates(data))
+
+    # the switch layer itself is saved with 'save_layer' when it is exported.
+    # 'data' is the request the layers were built from.
+    def put(self, data_hash, blank_key, cuts, data=None):
+        state = {
+            'input': digest(data) if data is not None else None,
+            'blank': blank_key,
+            'cuts': [([(profile.key, profile.points) for profile in profiles],
+                      center) for profiles, center in cuts],
+        }
+        path = self.layer_path(data_hash, 'json')
+        with open(path + '.%s.tmp' % os.getpid(), 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(path + '.%s.tmp' % os.getpid(), path)
@@ -0,0 +1,130 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import math
+import struct
+
+# the mesh formats: 'preview' is the coarse mesh the viewer loads first and
+# 'glb' the finer one it loads when asked to, both are binary glTF
+FORMATS = ['preview', 'glb']
+# the formats which are tessellated, and so have a tolerance
+TESSELLATED = ['js', 'preview', 'glb', 'stl']
+
+GLB_MAGIC = 0x46546C67  # 'glTF'
+GLB_VERSION = 2
+CHUNK_JSON = 0x4E4F534A  # 'JSON'
+CHUNK_BIN = 0x004E4942  # 'BIN'
+
+# gltf constants
+FLOAT = 5126
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+TRIANGLES = 4
+
+
+# the (linear, angular) deflection each tessellated format of a build of
+# 'data' is exported with.  the linear deflection is how far in mm a triangle
+# may be from the surface, the angular one how many radians the normals of
+# neighbouring triangles may turn.  they start from
+# 'config['app']['mesh_tolerance']' (in mm and degrees) and a request can
+# change them with 'mesh_tolerance': a number or [linear, angle] for every
+# format, or a dict of them by format.  nothing goes below
+# 'config['app']['mesh_min_tolerance']'.  without 'data' they are the
+# defaults.
+def tolerances(data, config):
+    requested = (data or {}).get('mesh_tolerance')
+    min_linear, min_angle = config['app']['mesh_min_tolerance']
+    result = {}
+    for name in TESSELLATED:
+        linear, angle = config['app']['mesh_tolerance'][name]
+        value = requested.get(name) if isinstance(requested, dict) else \
+            requested
+        if isinstance(value, (list, tuple)):
+            linear, angle = value[0], value[1] if len(value) > 1 else angle
+        elif value is not None:
+            linear = value
+        result[name] = (max(float(linear), min_linear),
+                        math.radians(max(float(angle), min_angle)))
+    return result
+
+
+# the 'mesh_tolerance' of a request from the command line: comma separated
+# '[format=]linear[:angle]', like '0.05' or 'stl=0.02:10,preview=1'
+def parse_tolerance(text):
+    requested = {}
+    for part in text.split(','):
+        name, _, value = part.rpartition('=')
+        value = [float(v) for v in value.split(':')]
+        if not name:
+            return value
+        requested[name] = value
+    return requested
+
+
+def pad(data, fill):
+    return data + fill*(-len(data) % 4)
+
+
+# write the mesh as a binary glTF 2.0 file: one indexed triangle mesh with
+# float32 positions and uint16 indices (uint32 past 65535 vertices).  the
+# positions stay in mm, which is what the viewer draws, and the node scales
+# them to the metres of the glTF spec for any other viewer.
+def write_glb(vertices, triangles, f):
+    flat = [c for v in vertices for c in v]
+    indices = [i for t in triangles for i in t]
+    if len(vertices) < 0xFFFF:
+        index_type, index_format = UNSIGNED_SHORT, 'H'
+    else:
+        index_type, index_format = UNSIGNED_INT, 'I'
+    positions = struct.pack('<%df' % len(flat), *flat)
+    elements = struct.pack('<%d%s' % (len(indices), index_format), *indices)
+    offset = len(pad(positions, b'\0'))
+    binary = pad(pad(positions, b'\0') + elements, b'\0')
+    if vertices:
+        low = [min(v[i] for v in vertices) for i in range(3)]
+        high = [max(v[i] for v in vertices) for i in range(3)]
+    else:
+        low = high = [0, 0, 0]
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'kb_builder'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0, 'scale': [0.001, 0.001, 0.001]}],
+        'meshes': [{'primitives': [{'attributes': {'POSITION': 0},
+                                    'indices': 1, 'mode': TRIANGLES}]}],
+        'buffers': [{'byteLength': len(binary)}],
+        'bufferViews': [
+            {'buffer': 0, 'byteOffset': 0, 'byteLength': len(positions),
+             'target': ARRAY_BUFFER},
+            {'buffer': 0, 'byteOffset': offset, 'byteLength': len(elements),
+             'target': ELEMENT_ARRAY_BUFFER}],
+        'accessors': [
+            {'bufferView': 0, 'componentType': FLOAT, 'count': len(vertices),
+             'type': 'VEC3', 'min': low, 'max': high},
+            {'bufferView': 1, 'componentType': index_type,
+             'count': len(indices), 'type': 'SCALAR'}],
+    }
+    header = pad(json.dumps(gltf, separators=(',', ':')).encode('utf-8'),
+                 b' ')
+    f.write(struct.pack('<III', GLB_MAGIC, GLB_VERSION,
+                        12 + 8 + len(header) + 8 + len(binary)))
+    f.write(struct.pack('<II', len(header), CHUNK_JSON))
+    f.write(header)
+    f.write(struct.pack('<II', len(binary), CHUNK_BIN))
+    f.write(binary)
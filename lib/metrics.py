@@ -0,0 +1,243 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import contextlib
+import os
+import time
+
+# the content type of the prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+           300, 600, float('inf'))
+
+
+# how long each stage of a build took.  'stages' adds up the seconds spent in
+# each named stage, 'samples' keeps every single measurement of the things
+# which happen many times in a build (cutting a key, a boolean operation) and
+# 'exports' the seconds each layer took to export to each format.
+class Timings(object):
+    def __init__(self):
+        self.start = time.time()
+        self.stages = collections.OrderedDict()
+        self.samples = collections.OrderedDict()
+        self.exports = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + \
+                time.time() - start
+
+    @contextlib.contextmanager
+    def sample(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.time() - start)
+
+    def export(self, layer, name, seconds):
+        self.exports.append((layer, name, seconds))
+
+    # the timings as they are added to the result of a build
+    def summary(self):
+        return {
+            'total': round(time.time() - self.start, 4),
+            'stages': dict((name, round(seconds, 4))
+                           for name, seconds in self.stages.items()),
+            'samples': dict((name, [round(s, 4) for s in seconds])
+                            for name, seconds in self.samples.items()),
+            'exports': [[layer, name, round(seconds, 4)]
+                        for layer, name, seconds in self.exports],
+        }
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+# a prometheus metric, with one value per combination of its 'labels'
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = collections.OrderedDict()
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in self.values.items():
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key),
+                             format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    # follow a count kept somewhere else
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts, total, count = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = [counts, total + value, count + 1]
+
+    def render_value(self, key, value):
+        counts, total, count = value
+        lines = ['%s_bucket%s %s' % (
+            self.name, format_labels(self.labels, key,
+                                     [('le', format_value(bound))]), n)
+            for bound, n in zip(self.buckets, counts)]
+        labels = format_labels(self.labels, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+        lines.append('%s_count%s %s' % (self.name, labels, count))
+        return lines
+
+
+def render(metrics):
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# the resident memory of the process 'pid' in bytes, or None where /proc is
+# not available
+def rss(pid):
+    try:
+        with open('/proc/%s/statm' % pid) as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+# the metrics of the builds run by the web server
+class BuildMetrics(object):
+    def __init__(self):
+        self.jobs = Counter('kb_jobs_total', 'Jobs finished, by outcome.',
+                            ['target', 'state'])
+        self.job_seconds = Histogram(
+            'kb_job_seconds', 'Time from submitting a job until it finished.',
+            ['target'])
+        self.wait_seconds = Histogram(
+            'kb_job_wait_seconds',
+            'Time a job waited in the queue for a worker.', ['target'])
+        self.build_seconds = Histogram(
+            'kb_build_seconds', 'Time a worker spent on a build.')
+        self.stage_seconds = Histogram(
+            'kb_build_stage_seconds', 'Time spent in each stage of a build.',
+            ['stage'])
+        self.sample_seconds = Histogram(
+            'kb_build_operation_seconds',
+            'Time taken by every single key cut and boolean operation.',
+            ['operation'])
+        self.export_seconds = Histogram(
+            'kb_export_seconds', 'Time taken to export a layer to a format.',
+            ['layer', 'format'])
+        self.cache = Counter('kb_cache_lookups_total',
+                             'Result cache lookups, by outcome.', ['result'])
+        self.store_bytes = Gauge('kb_export_store_bytes',
+                                 'Disk space taken by the builds.')
+        self.evicted = Counter('kb_export_evictions_total',
+                               'Builds removed to stay under the quota.')
+        self.rejected = Counter(
+            'kb_jobs_rejected_total',
+            'Builds refused for their cost or because the client had too '
+            'many going.', ['reason'])
+        self.queued = Gauge('kb_jobs_queued', 'Jobs waiting for a worker.')
+        self.running = Gauge('kb_jobs_running', 'Jobs being worked on.')
+        self.retired = Counter(
+            'kb_workers_retired_total',
+            'Build workers replaced after too many builds or too much memory.')
+        self.died = Counter('kb_workers_died_total',
+                            'Build workers which died running a job.')
+        self.workers = Gauge('kb_worker_rss_bytes',
+                             'Resident memory of each build worker.', ['pid'])
+
+    # record the 'timings' a worker added to the result of a build
+    def observe_timings(self, timings):
+        self.build_seconds.observe(timings['total'])
+        for stage, seconds in timings['stages'].items():
+            self.stage_seconds.observe(seconds, stage=stage)
+        for operation, samples in timings['samples'].items():
+            for seconds in samples:
+                self.sample_seconds.observe(seconds, operation=operation)
+        for layer, name, seconds in timings['exports']:
+            self.export_seconds.observe(seconds, layer=layer, format=name)
+
+    def all(self):
+        return [self.jobs, self.job_seconds, self.wait_seconds,
+                self.build_seconds, self.stage_seconds, self.sample_seconds,
+                self.export_seconds, self.cache, self.store_bytes,
+                self.evicted, self.rejected, self.queued, self.running,
+                self.retired, self.died, self.workers]
@@ -0,0 +1,83 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import numpy
+
+
+# where every key of a parsed layout ('Plate.layout') sits on the plate,
+# worked out for all the keys at once.  'centers' are measured from the top
+# left corner of the plate (inside the kerf) with y pointing down, like the
+# workplane the plate is cut on.  'sizes' are the width and height of the keys
+# in units and 'rotations' the '_r' of their switch cutouts in degrees.
+class Placement(object):
+    def __init__(self, layout, u1, x_pad=0, y_pad=0):
+        self.keys = [key for row in layout for key in row]
+        first = numpy.array([k == 0 for row in layout
+                             for k in range(len(row))], dtype=bool)
+        x = numpy.array([key.get('x', 0) for key in self.keys], dtype=float)
+        # only the first key of a row can move the row down
+        y = numpy.array([key.get('y', 0) for key in self.keys], dtype=float)
+        y[~first] = 0
+        self.sizes = numpy.array([(key.get('w', 1), key.get('h', 1))
+                                  for key in self.keys],
+                                 dtype=float).reshape(-1, 2)
+        self.rotations = numpy.array([key.get('_r') or 0
+                                      for key in self.keys], dtype=float)
+        w, h = self.sizes[:, 0], self.sizes[:, 1]
+
+        # keys follow each other along the row and every row starts again at
+        # the left, so x is a running sum restarted on the first key of a row
+        right = numpy.cumsum(x + w)
+        row = numpy.cumsum(first) - 1
+        start = (right - x - w)[first]
+        self.centers = numpy.empty((len(self.keys), 2))
+        self.centers[:, 0] = x_pad + (right - start[row] - w/2)*u1
+        # tall keys hang down from the top of their row
+        self.centers[:, 1] = y_pad + u1/2 + (row + numpy.cumsum(y))*u1 + \
+            numpy.where(h > 1, (h - 1)*u1/2, 0)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+# the outlines of the cutouts recorded for each key ('cuts' is a list of
+# (profiles, center)), all moved onto the center of their key in one go.
+# returns an array of points for every profile, in the order they were cut.
+def outlines(cuts, offset=(0, 0)):
+    points = []
+    counts = []
+    centers = []
+    for profiles, center in cuts:
+        for profile in profiles:
+            points.append(profile.points)
+            counts.append(len(profile.points))
+            centers.append(center)
+    if not points:
+        return []
+    vertices = numpy.concatenate(points) + offset + \
+        numpy.repeat(numpy.array(centers, dtype=float), counts, axis=0)
+    return numpy.split(vertices, numpy.cumsum(counts)[:-1])
+
+
+# the bounding box (min x, min y, max x, max y) of the cutouts of each key
+def bounds(cuts):
+    result = []
+    for profiles, center in cuts:
+        points = numpy.concatenate([profile.points for profile in profiles])
+        low = points.min(axis=0) + center
+        high = points.max(axis=0) + center
+        result.append((low[0], low[1], high[0], high[1]))
+    return result
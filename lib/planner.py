@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import json
+import logging
+import numpy
+
+from lib import placement
+from lib import profiles
+from lib.cache import requested_formats
+
+log = logging.getLogger()
+
+SWITCH_LAYER = 'switch'
+BOTTOM_LAYER = 'bottom'
+CLOSED_LAYER = 'closed'
+OPEN_LAYER = 'open'
+
+# the poker case has its mount holes and edge slots in fixed places
+POKER_HOLES = [(-139, 9.2), (-117.3, -19.4), (-14.3, 0), (48, 37.9),
+               (117.55, -19.4), (139, 9.2)]
+POKER_SLOTS = [(140.75, 9.2), (-140.75, 9.2)]
+POKER_SLOT_SIZE = (3.5, 5)  # edge slot cutout to edge
+
+
+# everything about a plate which can be worked out without any CAD: its size,
+# where every key goes and which cutouts it gets and where the mount holes
+# are.  'Plate' in lib/builder.py draws the plate from this.
+class PlatePlan(object):
+    def __init__(self):
+        self.UOM = "mm"
+        self.width = 0
+        self.height = 0
+        self.thickness = 1.5
+        self.fillet = 0
+        self.kerf = 0.0
+        self.x_pad = 0
+        self.y_pad = 0
+        self.grow_y = 0
+        self.grow_x = 0
+        self.u1 = 19.05
+        self.switch_type = 1
+        self.stab_type = 0
+        self.layout = []
+        self.case = {'type': None}
+        self.usb_width = 10
+
+    def set_x_pad(self, x):
+        self.x_pad = x
+
+    def set_y_pad(self, y):
+        self.y_pad = y
+
+    def set_thickness(self, t):
+        self.thickness = t
+
+    def set_fillet(self, f):
+        self.fillet = f
+
+    def set_kerf(self, k):
+        self.kerf = k/2
+
+    def set_switch_type(self, t):
+        if t in range(5):
+            log.info('Setting switch-type to %s', t)
+            self.switch_type = t
+
+    def set_stab_type(self, s):
+        if s in range(3):
+            log.info('Setting stab-type to %s', s)
+            self.stab_type = s
+
+    def set_poker_holes(self, d):
+        self.case = {'type': 'poker', 'hole_diameter': d}
+
+    def set_sandwich_holes(self, h, d):
+        self.case = {'type': 'sandwich', 'holes': h, 'x_holes': 0,
+                     'y_holes': 0, 'hole_diameter': d}
+
+    # parse the supplied layout to determine size and populate the properties
+    # of each 'key'
+    def parse_layout(self, layout):
+        layout_width = 0
+        layout_height = 0
+        # track if current is not a key and only describes the next key
+        key_desc = False
+        for row in layout:
+            if isinstance(row, list):  # only handle arrays of keys
+                row_width = 0
+                row_height = 0
+                row_layout = []
+                for k in row:
+                    key = {}
+                    if isinstance(k, dict):  # descibes the next key
+                        key = k
+                        if 'w' not in key:
+                            key['w'] = 1
+                        if 'h' not in key:
+                            key['h'] = 1
+                        row_layout.append(key)
+                        key_desc = True
+                    else:
+                        # is just a standard key (we know its a single unit
+                        # key)
+                        if not key_desc:
+                            # only handle if it was not already handled as a
+                            # key_desc
+                            key['w'] = 1
+                            key['h'] = 1
+                            row_layout.append(key)
+                        key_desc = False
+                    if 'w' in key:
+                        row_width += key['w']
+                    if 'x' in key:
+                        # offsets count towards total row width
+                        row_width += key['x']
+                    if 'y' in key:
+                        row_height = key['y']
+                self.layout.append(row_layout)
+                if row_width > layout_width:
+                    layout_width = row_width
+                layout_height += self.u1 + row_height*self.u1
+            # hidden global features
+            if isinstance(row, dict):
+                if 'grow_y' in row and (type(row['grow_y']) == int or
+                                        type(row['grow_y']) == float):
+                    self.grow_y = row['grow_y']/2
+                if 'grow_x' in row and (type(row['grow_x']) == int or
+                                        type(row['grow_x']) == float):
+                    self.grow_x = row['grow_x']/2
+        self.width = layout_width*self.u1 + 2*self.x_pad + 2*self.kerf
+        self.height = layout_height + 2*self.y_pad + 2*self.kerf
+
+    # since the sandwich plate has a dynamic number of holes, determine where
+    # the specified holes should be placed
+    def layout_sandwich_holes(self):
+        if 'holes' in self.case and self.case['holes'] >= 4 and \
+                'x_holes' in self.case and 'y_holes' in self.case:
+            holes = int(self.case['holes'])
+            if holes % 2 == 0 and holes >= 4:
+                # holes needs to be even and the first 4 are put in the corners
+                x = self.width - self.x_pad - self.kerf  # x length to split
+                y = self.height - self.y_pad - self.kerf  # y length to split
+                # number of holes on each x side (not counting the corner
+                # holes)
+                _x = 0
+                # number of holes on each y side (not counting the corner
+                # holes)
+                _y = 0
+                # number of free holes to be placed on either x or y sides
+                free = (holes-4)/2
+                for f in range(free):
+                    # loop through the available holes and place them
+                    if x/(_x+1) == y/(_y+1):
+                        # if equal, add the hole to the longer side
+                        if x >= y:
+                            _x += 1
+                        else:
+                            _y += 1
+                    elif x/(_x+1) > y/(_y+1):
+                        _x += 1
+                    else:
+                        _y += 1
+                self.case['x_holes'] = _x
+                self.case['y_holes'] = _y
+
+    # take a set of points and rotate them 'r' degrees around 'a'
+    def rotate_points(self, points, r, a):
+        return profiles.rotate(points, r, a)
+
+    # the centers of all the keys, measured from the center of the plate
+    def key_centers(self):
+        corner = (-self.width/2 + self.kerf, -self.height/2 + self.kerf)
+        return placement.Placement(self.layout, self.u1, self.x_pad,
+                                   self.y_pad).centers + corner
+
+    # the cutouts of a key: the switch and its stabilizer if it has one
+    def key_profiles(self, key):
+        w = key['w'] if 'w' in key else 1
+        h = key['h'] if 'h' in key else 1
+        t = key['_t'] if '_t' in key and key['_t'] in range(4) \
+            else self.switch_type
+        s = key['_s'] if '_s' in key and key['_s'] in range(2) \
+            else self.stab_type
+        k = key['_k']/2 if '_k' in key else self.kerf
+        r = key['_r'] if '_r' in key else None
+        rs = key['_rs'] if '_rs' in key else None
+
+        # switch cutout
+        rotate = 'h' in key and h > w
+        cuts = list(profiles.switch(t, k, self.grow_x, self.grow_y, rotate, r))
+
+        # 2 unit stabilizer cutout
+        if (w >= 2 and w < 3) or (rotate and h >= 2 and h < 3):
+            cuts.extend(profiles.stab(s, k, rotate, rs))
+
+        # spacebar stabilizer cutout
+        if (w >= 3) or (rotate and h >= 3):
+            l = w
+            if rotate:
+                l = h
+            cuts.extend(profiles.spacebar(s, k, l, rotate, rs))
+        return tuple(cuts)
+
+    # the centers of the sandwich case mount holes (measured from the center
+    # of the plate), going around the plate from the top left corner
+    def sandwich_holes(self):
+        if not ('holes' in self.case and self.case['holes'] >= 4 and
+                'x_holes' in self.case and 'y_holes' in self.case):
+            return []
+        self.layout_sandwich_holes()
+        x_gap = (self.width - self.x_pad -
+                 2*self.kerf)/(self.case['x_holes'] + 1)
+        y_gap = (self.height - self.y_pad -
+                 2*self.kerf)/(self.case['y_holes'] + 1)
+        x = -self.width/2 + self.kerf + self.x_pad/2
+        y = -self.height/2 + self.kerf + self.y_pad/2
+        holes = []
+        for dx, dy, n in [(x_gap, 0, self.case['x_holes'] + 1),
+                          (0, y_gap, self.case['y_holes'] + 1),
+                          (-x_gap, 0, self.case['x_holes'] + 1),
+                          (0, -y_gap, self.case['y_holes'] + 1)]:
+            for i in range(n):
+                x, y = x + dx, y + dy
+                holes.append((x, y))
+        return holes
+
+    # the geometry of the plate as plain data.  every position is in 'UOM'
+    # from the top left corner of the plate with y pointing down.
+    def plan(self):
+        def position(points):
+            return (numpy.round(numpy.array(points, dtype=float).reshape(
+                -1, 2) + (self.width/2, self.height/2), 6) + 0.0).tolist()
+
+        layout_keys = [key for row in self.layout for key in row]
+        cuts = [(self.key_profiles(key), tuple(c))
+                for key, c in zip(layout_keys, self.key_centers())]
+        outlines = iter(placement.outlines(cuts))
+        keys = []
+        for key, (key_profiles, c) in zip(layout_keys, cuts):
+            keys.append({
+                'center': position([c])[0],
+                'size': [key.get('w', 1), key.get('h', 1)],
+                'rotation': key.get('_r') or 0,
+                'cutouts': [{'profile': profile.key[0],
+                             'points': position(next(outlines))}
+                            for profile in key_profiles],
+            })
+        holes = []
+        slots = []
+        if self.case['type'] == 'poker':
+            holes = [{'center': c, 'diameter': self.case['hole_diameter']}
+                     for c in position(POKER_HOLES)]
+            slots = [{'center': c, 'size': list(POKER_SLOT_SIZE)}
+                     for c in position(POKER_SLOTS)]
+        if self.case['type'] == 'sandwich':
+            holes = [{'center': c, 'diameter': self.case['hole_diameter']}
+                     for c in position(self.sandwich_holes())]
+        return {
+            'units': self.UOM,
+            'width': self.width,
+            'height': self.height,
+            'thickness': self.thickness,
+            'fillet': self.fillet,
+            'kerf': self.kerf*2,
+            'switch_type': self.switch_type,
+            'stab_type': self.stab_type,
+            'case': self.case['type'],
+            'rows': len(self.layout),
+            'key_count': len(keys),
+            'keys': keys,
+            'holes': holes,
+            'slots': slots,
+        }
+
+    def __repr__(self):
+        '''Print out all Plate object configuration settings.'''
+
+        settings = {}
+
+        settings['plate_layout'] = self.layout
+        settings['switch_type'] = self.switch_type
+        settings['stabilizer_type'] = self.stab_type
+        settings['case_type_and_holes'] = self.case
+        settings['width_padding'] = self.x_pad
+        settings['height_padding'] = self.y_pad
+        settings['plate_corners'] = self.fillet
+        settings['kerf'] = self.kerf
+        # XXX line colour?
+
+        return json.dumps(settings, sort_keys=True, indent=4,
+                          separators=(',', ': '))
+
+
+# set up the plate 'p' from the request 'data'
+def configure(p, data):
+    if 'case-type' in data:
+        if data['case-type'] == 'poker':
+            if 'mount-holes-size' in data:
+                p.set_poker_holes(float(data['mount-holes-size']))
+        if data['case-type'] == 'sandwich':
+            if 'mount-holes-num' in data and 'mount-holes-size' in data:
+                p.set_sandwich_holes(int(data['mount-holes-num']),
+                                     float(data['mount-holes-size']))
+    if 'switch-type' in data:
+        p.set_switch_type(int(data['switch-type']))
+    if 'stab-type' in data:
+        p.set_stab_type(int(data['stab-type']))
+    if 'width-padding' in data:
+        p.set_x_pad(float(data['width-padding']))
+    if 'height-padding' in data:
+        p.set_y_pad(float(data['height-padding']))
+    if 'fillet' in data:
+        p.set_fillet(float(data['fillet']))
+    if 'thickness' in data:
+        p.set_thickness(float(data['thickness']))
+    if 'kerf' in data:
+        p.set_kerf(float(data['kerf']))
+    return p
+
+
+# the plates a request builds
+def plates(data):
+    if data.get('case-type') == 'sandwich':
+        return [SWITCH_LAYER, OPEN_LAYER, CLOSED_LAYER, BOTTOM_LAYER]
+    return [SWITCH_LAYER]
+
+
+# the (layer, format) files a build of 'data' writes: every plate in each of
+# 'formats', or of the formats the request is exported to
+def outputs(data, config, formats=None):
+    return [(label, name) for label in plates(data)
+            for name in formats or requested_formats(data, config)]
+
+
+# work out the geometry of a request without building anything, which only
+# takes a few milliseconds
+def plan(data, config):
+    p = configure(PlatePlan(), data)
+    p.parse_layout(copy.deepcopy(data['layout']))
+    result = p.plan()
+    result['plates'] = plates(data)
+    result['formats'] = requested_formats(data, config)
+    return result
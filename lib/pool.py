@@ -0,0 +1,430 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gc
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import threading
+import time
+import traceback
+
+from lib import metrics
+
+log = logging.getLogger()
+
+# events a worker reports back to the pool for a job
+STARTED = 'started'
+PROGRESS = 'progress'
+DONE = 'done'
+ERROR = 'error'
+CANCELLED = 'cancelled'
+
+# events a worker reports about itself, with no job
+MEMORY = 'memory'
+RETIRED = 'retired'
+
+
+class BuildError(Exception):
+    pass
+
+
+# raised at a checkpoint of a build which was cancelled or ran out of time
+class Cancelled(Exception):
+    pass
+
+
+# the pids of the processes started by the process 'pid' (the export processes
+# of a worker), empty where /proc is not available
+def children(pid):
+    pids = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return pids
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as stat:
+                # the command may have spaces, the fields after it do not
+                fields = stat.read().rpartition(')')[2].split()
+        except (IOError, OSError):
+            continue
+        if fields and int(fields[1]) == pid:
+            pids.append(int(name))
+    return pids
+
+
+# the resident memory of the worker 'pid' together with its export processes,
+# which it keeps from one build to the next, or None without /proc
+def memory(pid):
+    rss = metrics.rss(pid)
+    if rss is None:
+        return None
+    return rss + sum(metrics.rss(child) or 0 for child in children(pid))
+
+
+# the main loop of a worker process.  the CAD stack is imported once when the
+# worker starts ('preload', a pool of 2d builds never needs it), then the
+# worker takes the jobs the pool sends it over its own 'tasks' pipe, one at a
+# time, and sends everything it reports back over its own 'results' pipe,
+# until it is told to stop.  the build checks now and then
+# (between keys, layers and exports) whether the pool set 'cancel' to the
+# number of its job or it ran past its 'timeout' option, and stops with a
+# CANCELLED event if so.  after each job it reports its memory use, and it
+# retires (the pool starts a new worker in its place) once it has run
+# 'worker_max_builds' jobs or its memory, with that of its export processes,
+# passed 'worker_max_rss'.
+def work(tasks, results, config, cancel, preload=True):
+    import lib.builder as builder
+    if preload:
+        try:
+            builder.load_cad()
+        except Exception:
+            # the 3d builds fail on their own, the 2d ones can still run
+            log.exception("Could not import the CAD libraries")
+    log.info("Worker %s is ready", multiprocessing.current_process().name)
+    max_builds = config['app']['worker_max_builds']
+    max_rss = config['app']['worker_max_rss']
+    builds = 0
+    while True:
+        try:
+            job = tasks.recv()
+        except EOFError:  # the pool went away
+            break
+        if job is None:  # asked to shut down
+            break
+        job_id, number, data_hash, data, options = job
+        results.send((job_id, STARTED, os.getpid()))
+
+        def progress(stage, info, job_id=job_id):
+            results.send((job_id, PROGRESS, dict(info, stage=stage)))
+        timeout = options.pop('timeout', 0)
+
+        def check(number=number, timeout=timeout, started=time.time()):
+            if cancel.value == number:
+                raise Cancelled("Cancelled")
+            if timeout and time.time() - started > timeout:
+                raise Cancelled("Timed out after %s seconds" % timeout)
+        # builds run builder.build, anything else names its own 'target'
+        target = getattr(builder, options.pop('target', 'build'))
+        try:
+            result = target(data_hash, data, config, progress=progress,
+                            check=check, **options)
+        except Cancelled as e:
+            log.info("Build stopped: %s: %s", data_hash, e)
+            results.send((job_id, CANCELLED, str(e)))
+        except Exception:
+            log.exception("Build failed: %s", data_hash)
+            results.send((job_id, ERROR, traceback.format_exc()))
+        else:
+            results.send((job_id, DONE, result))
+        result = None  # nothing of the build is kept until the next one
+        gc.collect()
+        builds += 1
+        rss = memory(os.getpid())
+        results.send((None, MEMORY, {'pid': os.getpid(), 'builds': builds,
+                                     'rss': rss}))
+        if (max_builds and builds >= max_builds) or \
+                (max_rss and rss and rss > max_rss):
+            log.info("Worker %s retires after %s builds using %s bytes",
+                     os.getpid(), builds, rss)
+            results.send((None, RETIRED, os.getpid()))
+            break
+
+
+# the pool hands each job to a free worker itself, so it always knows which
+# job a worker has.  a worker which dies (a crash in the CAD stack, the OOM
+# killer) is noticed by the listener within a second: the job it had fails
+# and a new worker takes its place.
+class BuildPool(object):
+    def __init__(self, config, size=None, preload=True):
+        self.size = size or config['app']['workers']
+        # every worker keeps export processes of its own, all of them
+        # together get about one per CPU
+        self.config = dict(config, app=dict(
+            config['app'], export_workers=min(
+                config['app']['export_workers'],
+                max(1, multiprocessing.cpu_count() // self.size))))
+        self.preload = preload  # import the CAD stack when a worker starts
+        self.workers = []
+        self.pending = []  # tasks waiting for a free worker, oldest first
+        self.memory = {}  # pid -> the last MEMORY report of a worker
+        self.retired = 0
+        self.died = 0
+        self.stopping = False
+        self.callbacks = {}
+        self.numbers = {}  # job id -> its number, which 'cancel' is set to
+        self.number = 0
+        self.running = {}  # job id -> pid of the worker running it
+        self.cancelled = set()  # jobs to stop as soon as they start
+        self.lock = threading.Lock()
+        self.listener = None
+
+    # start the worker processes and the thread listening for their results
+    def start(self):
+        with self.lock:
+            for i in range(self.size):
+                self.spawn()
+        self.listener = threading.Thread(target=self.listen,
+                                         name='pool-listener')
+        self.listener.daemon = True
+        self.listener.start()
+        log.info("Started %s build workers", self.size)
+
+    # a new worker with a pipe each way.  the ends the worker uses are closed
+    # here, so its results pipe ends when it does.
+    def spawn(self):
+        cancel = multiprocessing.Value('l', 0)
+        tasks, send = multiprocessing.Pipe(duplex=False)
+        receive, results = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(
+            target=work, args=(tasks, results, self.config, cancel,
+                               self.preload))
+        worker.cancel = cancel
+        worker.tasks = send
+        worker.results = receive
+        worker.task = None  # the task it was sent and did not finish
+        worker.started = False  # did it report STARTED for it
+        worker.killed = False
+        worker.daemon = True
+        worker.start()
+        tasks.close()
+        results.close()
+        self.workers.append(worker)
+        return worker
+
+    # queue a build.  'callback(event, payload)' is called from the listener
+    # thread when a worker picks the job up (STARTED, payload is the worker
+    # pid), for each PROGRESS report (payload is a dict with a 'stage') and
+    # finally once the job is DONE (payload is the result) or hit an ERROR
+    # (payload is the formatted traceback, or why the worker died) or was
+    # CANCELLED (payload is why).  any 'options' are passed on to
+    # builder.build, or to the builder function named by a 'target' option,
+    # but for the 'timeout' in seconds after which the build is stopped.
+    def submit(self, job_id, data_hash, data, callback, **options):
+        with self.lock:
+            self.callbacks[job_id] = callback
+            self.number += 1
+            number = self.numbers[job_id] = self.number
+            self.pending.append((job_id, number, data_hash, data, options))
+            self.dispatch()
+
+    # send the pending tasks to the free workers
+    def dispatch(self):
+        for worker in self.workers:
+            if not self.pending:
+                break
+            if worker.task or worker.killed:
+                continue
+            task = self.pending.pop(0)
+            worker.task = task
+            worker.started = False
+            self.running[task[0]] = worker.pid
+            if task[0] in self.cancelled:
+                worker.cancel.value = task[1]
+            try:
+                worker.tasks.send(task)
+            except (IOError, OSError):
+                # it is on its way out, the listener gives the task to
+                # another worker or fails it
+                pass
+
+    def listen(self):
+        while True:
+            with self.lock:
+                if self.stopping and not self.workers:
+                    break
+                workers = dict((worker.results.fileno(), worker)
+                               for worker in self.workers)
+            try:
+                ready = select.select(list(workers), [], [], 1)[0]
+            except (select.error, IOError, OSError, ValueError):
+                ready = []  # a worker went away in the meantime
+            for fd in ready:
+                self.receive(workers[fd])
+            self.check()
+
+    # read one message of 'worker'
+    def receive(self, worker):
+        try:
+            message = worker.results.recv()
+        except (EOFError, IOError, OSError):
+            self.bury(worker)
+            return
+        job_id, event, payload = message
+        if job_id is None:
+            self.on_worker(worker, event, payload)
+            return
+        with self.lock:
+            if event in (DONE, ERROR, CANCELLED):
+                callback = self.callbacks.pop(job_id, None)
+                self.forget(job_id)
+                if worker.task and worker.task[0] == job_id:
+                    worker.task = None
+                self.dispatch()
+            else:
+                callback = self.callbacks.get(job_id)
+            if event == STARTED:
+                worker.started = True
+        self.call(callback, job_id, event, payload)
+
+    def call(self, callback, job_id, event, payload):
+        if callback:
+            try:
+                callback(event, payload)
+            except Exception:
+                log.exception("Callback failed for job %s", job_id)
+
+    # bury the workers which exited with nothing left to read
+    def check(self):
+        for worker in self.workers[:]:
+            if worker.exitcode is not None and \
+                    not self.readable(worker.results):
+                self.bury(worker)
+
+    def readable(self, connection):
+        try:
+            return connection.poll()
+        except (EOFError, IOError, OSError):
+            return False
+
+    # 'worker' exited.  the job it had (unless it was killed for it) fails
+    # and a new worker takes its place.
+    def bury(self, worker):
+        with self.lock:
+            if worker not in self.workers:
+                return
+            self.remove(worker)
+            task = worker.task
+            callback = None
+            if task and not worker.killed:
+                self.died += 1
+                log.error("Worker %s died running job %s, exit code %s",
+                          worker.pid, task[0], worker.exitcode)
+                callback = self.callbacks.pop(task[0], None)
+                self.forget(task[0])
+            if not self.stopping:
+                self.spawn()
+                self.dispatch()
+        if callback:
+            self.call(callback, task[0], ERROR,
+                      "The build worker died (exit code %s)" %
+                      worker.exitcode)
+
+    def remove(self, worker):
+        self.workers.remove(worker)
+        self.memory.pop(worker.pid, None)
+        worker.join()
+        for connection in (worker.tasks, worker.results):
+            connection.close()
+
+    def forget(self, job_id):
+        self.numbers.pop(job_id, None)
+        self.running.pop(job_id, None)
+        self.cancelled.discard(job_id)
+
+    def worker(self, pid):
+        for worker in self.workers:
+            if worker.pid == pid:
+                return worker
+
+    # stop the job 'job_id' at its next checkpoint, see 'work'.  a job no
+    # worker took yet is cancelled right away.
+    def cancel(self, job_id):
+        with self.lock:
+            for task in self.pending:
+                if task[0] == job_id:
+                    self.pending.remove(task)
+                    callback = self.callbacks.pop(job_id, None)
+                    self.forget(job_id)
+                    break
+            else:
+                worker = self.worker(self.running.get(job_id))
+                if worker:
+                    self.cancelled.add(job_id)
+                    worker.cancel.value = self.numbers[job_id]
+                return
+        self.call(callback, job_id, CANCELLED, "Cancelled")
+
+    # the last resort for a job which did not stop at a checkpoint (it is
+    # stuck in a boolean or an export): kill the worker running it and its
+    # export processes.  the job is reported as CANCELLED with 'message' and
+    # the listener starts a new worker once the old one is gone.
+    def kill(self, job_id, message):
+        with self.lock:
+            worker = self.worker(self.running.get(job_id))
+            if not worker:
+                return
+            callback = self.callbacks.pop(job_id, None)
+            self.forget(job_id)
+            worker.killed = True
+            log.warning("Killing worker %s, job %s did not stop", worker.pid,
+                        job_id)
+            for pid in children(worker.pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.call(callback, job_id, CANCELLED, message)
+
+    # a worker reported its memory use or retired, in which case a new worker
+    # takes its place.  a task it was sent after its last job goes to
+    # another worker.
+    def on_worker(self, worker, event, payload):
+        if event == MEMORY:
+            self.memory[payload['pid']] = payload
+        elif event == RETIRED:
+            with self.lock:
+                if worker not in self.workers:
+                    return
+                self.remove(worker)
+                if worker.task:
+                    self.pending.insert(0, worker.task)
+                self.retired += 1
+                if not self.stopping:
+                    self.spawn()
+                self.dispatch()
+
+    # the pid, builds run and resident memory of every worker
+    def worker_stats(self):
+        return [self.memory.get(pid, {'pid': pid, 'builds': 0, 'rss': None})
+                for pid in self.pids()]
+
+    def pids(self):
+        return [worker.pid for worker in self.workers
+                if worker.is_alive() and not worker.killed]
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            workers = self.workers[:]
+            for worker in workers:
+                try:
+                    worker.tasks.send(None)
+                except (IOError, OSError):
+                    pass
+        for worker in workers:
+            worker.join()
+        if self.listener:
+            self.listener.join()
@@ -0,0 +1,95 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import cProfile
+import logging
+import os
+import pstats
+
+log = logging.getLogger()
+
+
+# the name a profiled build of 'data_hash' writes its exports, layers and
+# profile under.  they are scratch files of their own, so a profile never
+# rewrites the files of the cached build, which other requests are served.
+def name(data_hash):
+    return '%s-profile' % data_hash
+
+
+# 'file:line(function)' like pstats prints it, the C functions (the OCC
+# booleans, the FreeCAD exporters) only have a name
+def label(func):
+    filename, line, name = func
+    if filename == '~' and line == 0:
+        return name
+    return '%s:%s(%s)' % (os.path.basename(filename), line, name)
+
+
+# the hottest functions by the time spent in the function itself
+def top(stats, n):
+    rows = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({'function': label(func), 'calls': nc,
+                     'tottime': round(tt, 4), 'cumtime': round(ct, 4)})
+    rows.sort(key=lambda row: row['tottime'], reverse=True)
+    return rows[:n]
+
+
+# the profile as collapsed stacks ('root;caller;function microseconds' on
+# each line) for flamegraph.pl and speedscope.  cProfile only keeps the time
+# of each caller and callee pair, so the time of a function called from
+# several places is split between them in proportion to what each caller
+# spent in it.
+def collapse(stats):
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    roots = [func for func, row in stats.stats.items() if not row[4]]
+    lines = {}
+
+    def walk(func, path, scale):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        path = path + [label(func)]
+        if tt*scale > 0:
+            key = ';'.join(path)
+            lines[key] = lines.get(key, 0) + tt*scale
+        for callee, edge_ct in callees.get(func, []):
+            total = stats.stats[callee][3]
+            # cycles are cut and so are branches too small to show
+            if label(callee) not in path and scale*edge_ct >= 1e-6:
+                walk(callee, path, scale*edge_ct/total)
+    for func in roots:
+        walk(func, [], 1.0)
+    return ['%s %d' % (key, round(seconds*1e6))
+            for key, seconds in sorted(lines.items())
+            if round(seconds*1e6) > 0]
+
+
+# run 'func(*args, **kwargs)' under cProfile and write the profile next to the
+# exports as '<prefix>.pstats' and '<prefix>.folded'.  returns what 'func'
+# returned and the 'n' hottest functions.
+def profile(prefix, n, func, *args, **kwargs):
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        stats = pstats.Stats(profiler)
+        stats.dump_stats('%s.pstats' % prefix)
+        with open('%s.folded' % prefix, 'w') as folded:
+            folded.write('\n'.join(collapse(stats)) + '\n')
+        log.info("Saved the profile to %s.pstats", prefix)
+    return result, top(stats, n)
@@ -0,0 +1,253 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import math
+import numpy
+
+# a cutout outline, 'points' are relative to the center of the key and 'key'
+# identifies the variant so it can be shared between keys
+Profile = collections.namedtuple('Profile', ['key', 'points'])
+
+# the distance from the center of the key to the stabilizer wires for the
+# known spacebar lengths (in units)
+STABS = {
+    3: 19.05,
+    4: 28.575,
+    4.5: 34.671,
+    5.5: 42.8625,
+    6.25: 50,
+    6.5: 52.38,
+    7: 57.15,
+    8: 66.675,
+    9: 66.675,
+    10: 66.675,
+}
+
+# the variants built most recently, the least recently used first.  a
+# variant depends on the kerf, the growth and the rotation of a request, so
+# only the last MAX_PROFILES are kept.
+profiles = collections.OrderedDict()
+MAX_PROFILES = 512
+
+
+# take a set of points and rotate them 'r' degrees around 'a'
+def rotate(points, r, a=(0, 0)):
+    cos = math.cos(math.radians(r))
+    sin = math.sin(math.radians(r))
+    m = numpy.array([[cos, sin], [-sin, cos]])
+    points = numpy.array(points, dtype=float).reshape(-1, 2) - a
+    return [tuple(pt) for pt in (numpy.dot(points, m) + a).tolist()]
+
+
+# the switch cutout of type 't' with a kerf of 'k'
+def switch_points(t, k, grow_x, grow_y):
+    points = []
+    if t == 0:  # standard square switch
+        points = [
+            (7-k+grow_x, -7+k-grow_y),
+            (7-k+grow_x, 7-k+grow_y),
+            (-7+k-grow_x, 7-k+grow_y),
+            (-7+k-grow_x, -7+k-grow_y),
+            (7-k+grow_x, -7+k-grow_y)
+        ]
+    elif t == 1:  # mx and alps compatible switch, mx can open
+        points = [
+            (7-k, -7+k), (7-k, -6.4+k), (7.8-k, -6.4+k), (7.8-k, 6.4-k),
+            (7-k, 6.4-k), (7-k, 7-k), (-7+k, 7-k), (-7+k, 6.4-k),
+            (-7.8+k, 6.4-k), (-7.8+k, -6.4+k), (-7+k, -6.4+k),
+            (-7+k, -7+k), (7-k, -7+k)
+        ]
+    elif t == 2:  # mx switch can open (side wings)
+        points = [
+            (7-k, -7+k), (7-k, -6+k), (7.8-k, -6+k), (7.8-k, -2.9-k),
+            (7-k, -2.9-k), (7-k, 2.9+k), (7.8-k, 2.9+k), (7.8-k, 6-k),
+            (7-k, 6-k), (7-k, 7-k), (-7+k, 7-k), (-7+k, 6-k),
+            (-7.8+k, 6-k), (-7.8+k, 2.9+k), (-7+k, 2.9+k), (-7+k, -2.9-k),
+            (-7.8+k, -2.9-k), (-7.8+k, -6+k), (-7+k, -6+k), (-7+k, -7+k),
+            (7-k, -7+k)
+        ]
+    elif t == 3:
+        # rotatable mx switch can open both ways (side and top/bottom
+        # wings)
+        points = [
+            (7-k, -7+k), (7-k, -6+k), (7.8-k, -6+k), (7.8-k, -2.9-k),
+            (7-k, -2.9-k), (7-k, 2.9+k), (7.8-k, 2.9+k), (7.8-k, 6-k),
+            (7-k, 6-k), (7-k, 7-k), (6-k, 7-k), (6-k, 7.8-k),
+            (2.9+k, 7.8-k), (2.9+k, 7-k), (-2.9-k, 7-k), (-2.9-k, 7.8-k),
+            (-6+k, 7.8-k), (-6+k, 7-k), (-7+k, 7-k), (-7+k, 6-k),
+            (-7.8+k, 6-k), (-7.8+k, 2.9+k), (-7+k, 2.9+k), (-7+k, -2.9-k),
+            (-7.8+k, -2.9-k), (-7.8+k, -6+k), (-7+k, -6+k), (-7+k, -7+k),
+            (-6+k, -7+k), (-6+k, -7.8+k), (-2.9-k, -7.8+k), (-2.9-k, -7+k),
+            (2.9+k, -7+k), (2.9+k, -7.8+k), (6-k, -7.8+k), (6-k, -7+k),
+            (7-k, -7+k)
+        ]
+    elif t == 4:  # alps compatible switch, not MX compatible
+        points = [
+            (7.75-k, -6.4+k), (7.75-k, 6.4-k),
+            (-7.75+k, 6.4-k), (-7.75+k, -6.4+k),
+            (7.75-k, -6.4+k),
+        ]
+    return points
+
+
+# the 2 unit stabilizer cutouts of type 's'
+def stab_points(s, k):
+    if s == 0:
+        # modified mx cherry spec 2u stabilizer to support costar
+        points = [
+            (7-k, -7+k), (7-k, -4.73+k), (8.575+k, -4.73+k),
+            (8.575+k, -5.53+k), (10.3+k, -5.53+k), (10.3+k, -6.45+k),
+            (13.6-k, -6.45+k), (13.6-k, -5.53+k), (15.225-k, -5.53+k),
+            (15.225-k, -2.3+k), (16.1-k, -2.3+k), (16.1-k, 0.5-k),
+            (15.225-k, 0.5-k), (15.225-k, 6.77-k), (13.6-k, 6.77-k),
+            (13.6-k, 7.75-k), (10.3+k, 7.75-k), (10.3+k, 6.77-k),
+            (8.575+k, 6.77-k), (8.575+k, 5.97-k), (7-k, 5.97-k),
+            (7-k, 7-k), (-7+k, 7-k), (-7+k, 5.97-k),
+            (-8.575-k, 5.97-k), (-8.575-k, 6.77-k), (-10.3-k, 6.77-k),
+            (-10.3-k, 7.75-k), (-13.6+k, 7.75-k), (-13.6+k, 6.77-k),
+            (-15.225+k, 6.77-k), (-15.225+k, 0.5-k), (-16.1+k, 0.5-k),
+            (-16.1+k, -2.3+k), (-15.225+k, -2.3+k),
+            (-15.225+k, -5.53+k), (-13.6+k, -5.53+k),
+            (-13.6+k, -6.45+k), (-10.3-k, -6.45+k), (-10.3-k, -5.53+k),
+            (-8.575-k, -5.53+k), (-8.575-k, -4.73+k), (-7+k, -4.73+k),
+            (-7+k, -7+k), (7-k, -7+k)
+        ]
+        return [points]
+    if s == 1:
+        # cherry spec 2u stabilizer
+        points = [
+            (7-k, -7+k), (7-k, -4.73+k), (8.575+k, -4.73+k),
+            (8.575+k, -5.53+k), (15.225-k, -5.53+k),
+            (15.225-k, -2.3+k), (16.1-k, -2.3+k), (16.1-k, 0.5-k),
+            (15.225-k, 0.5-k), (15.225-k, 6.77-k), (13.6-k, 6.77-k),
+            (13.6-k, 7.97-k), (10.3+k, 7.97-k), (10.3+k, 6.77-k),
+            (8.575+k, 6.77-k), (8.575+k, 5.97-k), (7-k, 5.97-k),
+            (7-k, 7-k), (-7+k, 7-k), (-7+k, 5.97-k),
+            (-8.575-k, 5.97-k), (-8.575-k, 6.77-k), (-10.3-k, 6.77-k),
+            (-10.3-k, 7.97-k), (-13.6+k, 7.97-k), (-13.6+k, 6.77-k),
+            (-15.225+k, 6.77-k), (-15.225+k, 0.5-k), (-16.1+k, 0.5-k),
+            (-16.1+k, -2.3+k), (-15.225+k, -2.3+k),
+            (-15.225+k, -5.53+k), (-8.575-k, -5.53+k),
+            (-8.575-k, -4.73+k), (-7+k, -4.73+k), (-7+k, -7+k),
+            (7-k, -7+k)
+        ]
+        return [points]
+    if s == 2:
+        # costar stabilizers only
+        points_l = [(-10.3-k, -6.45+k), (-13.6+k, -6.45+k),
+                    (-13.6+k, 7.75-k), (-10.3-k, 7.75-k),
+                    (-10.3-k, -6.45+k)]
+        points_r = [(10.3+k, -6.45+k), (13.6-k, -6.45+k),
+                    (13.6-k, 7.75-k), (10.3+k, 7.75-k),
+                    (10.3+k, -6.45+k)]
+        return [points_l, points_r]
+    return []
+
+
+# the spacebar stabilizer cutouts of type 's' with the wires 'x' from the
+# center of the key
+def spacebar_points(s, k, x):
+    if s == 0:
+        # modified mx cherry spec stabilizer to support costar
+        points = [
+            (7-k, -7+k), (7-k, -2.3+k), (x-3.325+k, -2.3+k),
+            (x-3.325+k, -5.53+k), (x-1.65+k, -5.53+k),
+            (x-1.65+k, -6.45+k), (x+1.65-k, -6.45+k),
+            (x+1.65-k, -5.53+k), (x+3.325-k, -5.53+k),
+            (x+3.325-k, -2.3+k), (x+4.2-k, -2.3+k), (x+4.2-k, 0.5-k),
+            (x+3.325-k, 0.5-k), (x+3.325-k, 6.77-k),
+            (x+1.65-k, 6.77-k), (x+1.65-k, 7.75-k), (x-1.65+k, 7.75-k),
+            (x-1.65+k, 6.77-k), (x-3.325+k, 6.77-k),
+            (x-3.325+k, 2.3-k), (7-k, 2.3-k), (7-k, 7-k), (-7+k, 7-k),
+            (-7+k, 2.3-k), (-x+3.325-k, 2.3-k), (-x+3.325-k, 6.77-k),
+            (-x+1.65-k, 6.77-k), (-x+1.65-k, 7.75-k),
+            (-x-1.65+k, 7.75-k), (-x-1.65+k, 6.77-k),
+            (-x-3.325+k, 6.77-k), (-x-3.325+k, 0.5-k),
+            (-x-4.2+k, 0.5-k), (-x-4.2+k, -2.3+k),
+            (-x-3.325+k, -2.3+k), (-x-3.325+k, -5.53+k),
+            (-x-1.65+k, -5.53+k), (-x-1.65+k, -6.45+k),
+            (-x+1.65-k, -6.45+k), (-x+1.65-k, -5.53+k),
+            (-x+3.325-k, -5.53+k), (-x+3.325-k, -2.3+k),
+            (-7+k, -2.3+k), (-7+k, -7+k), (7-k, -7+k)
+        ]
+        return [points]
+    if s == 1:
+        # cherry spec spacebar stabilizer
+        points = [
+            (7-k, -7+k), (7-k, -2.3+k), (x-3.325+k, -2.3+k),
+            (x-3.325+k, -5.53+k), (x+3.325-k, -5.53+k),
+            (x+3.325-k, -2.3+k), (x+4.2-k, -2.3+k), (x+4.2-k, 0.5-k),
+            (x+3.325-k, 0.5-k), (x+3.325-k, 6.77-k),
+            (x+1.65-k, 6.77-k), (x+1.65-k, 7.97-k), (x-1.65+k, 7.97-k),
+            (x-1.65+k, 6.77-k), (x-3.325+k, 6.77-k),
+            (x-3.325+k, 2.3-k), (7-k, 2.3-k), (7-k, 7-k), (-7+k, 7-k),
+            (-7+k, 2.3-k), (-x+3.325-k, 2.3-k), (-x+3.325-k, 6.77-k),
+            (-x+1.65-k, 6.77-k), (-x+1.65-k, 7.97-k),
+            (-x-1.65+k, 7.97-k), (-x-1.65+k, 6.77-k),
+            (-x-3.325+k, 6.77-k), (-x-3.325+k, 0.5-k),
+            (-x-4.2+k, 0.5-k), (-x-4.2+k, -2.3+k),
+            (-x-3.325+k, -2.3+k), (-x-3.325+k, -5.53+k),
+            (-x+3.325-k, -5.53+k), (-x+3.325-k, -2.3+k),
+            (-7+k, -2.3+k), (-7+k, -7+k), (7-k, -7+k)
+        ]
+        return [points]
+    if s == 2:
+        # costar stabilizers only
+        points_l = [(-x+1.65-k, -6.45+k), (-x-1.65+k, -6.45+k),
+                    (-x-1.65+k, 7.75-k), (-x+1.65-k, 7.75-k),
+                    (-x+1.65-k, -6.45+k)]
+        points_r = [(x-1.65+k, -6.45+k), (x+1.65-k, -6.45+k),
+                    (x+1.65-k, 7.75-k), (x-1.65+k, 7.75-k),
+                    (x-1.65+k, -6.45+k)]
+        return [points_l, points_r]
+    return []
+
+
+# build (or reuse) the profiles of a variant.  'rotate_90' turns a vertical
+# key on its side and 'r' is any additional rotation.
+def lookup(key, build, rotate_90, r):
+    key = key + (rotate_90, r)
+    if key in profiles:
+        variant = profiles.pop(key)
+    else:
+        outlines = build()
+        if rotate_90:
+            outlines = [rotate(points, 90) for points in outlines]
+        if r:
+            outlines = [rotate(points, r) for points in outlines]
+        variant = [Profile(key + (i,), tuple(points))
+                   for i, points in enumerate(outlines)]
+        while len(profiles) >= MAX_PROFILES:
+            profiles.popitem(last=False)
+    profiles[key] = variant
+    return variant
+
+
+def switch(t, k, grow_x, grow_y, rotate_90=False, r=None):
+    return lookup(('switch', t, k, grow_x, grow_y),
+                  lambda: [switch_points(t, k, grow_x, grow_y)], rotate_90, r)
+
+
+def stab(s, k, rotate_90=False, r=None):
+    return lookup(('stab', s, k), lambda: stab_points(s, k), rotate_90, r)
+
+
+# the stabilizer for a key 'l' units long
+def spacebar(s, k, l, rotate_90=False, r=None):
+    x = STABS.get(l, 11.95)  # default to a 2unit stabilizer if not found...
+    return lookup(('spacebar', s, k, x), lambda: spacebar_points(s, k, x),
+                  rotate_90, r)
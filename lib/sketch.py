@@ -0,0 +1,275 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import math
+import numpy
+
+# the formats the 2d engine can export
+FORMATS = ['dxf', 'svg', 'json']
+
+POLYGON = 'polygon'
+CIRCLE = 'circle'
+
+
+# is the point 'pt' inside the closed polygon 'points'
+def inside(pt, points):
+    result = False
+    j = len(points) - 1
+    for i in range(len(points)):
+        (xi, yi), (xj, yj) = points[i], points[j]
+        if (yi > pt[1]) != (yj > pt[1]) and \
+                pt[0] < (xj - xi) * (pt[1] - yi) / (yj - yi) + xi:
+            result = not result
+        j = i
+    return result
+
+
+# the bounding box (min x, min y, max x, max y) of a cutout
+def bounds(shape):
+    if shape[0] == CIRCLE:
+        (x, y), r = shape[1], shape[2]
+        return (x-r, y-r, x+r, y+r)
+    xs = [pt[0] for pt in shape[1]]
+    ys = [pt[1] for pt in shape[1]]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and b[2] <= a[2] and b[3] <= a[3]
+
+
+# the points which have to be inside another cutout for 'shape' to be inside
+def outline_points(shape):
+    if shape[0] == CIRCLE:
+        x0, y0, x1, y1 = bounds(shape)
+        return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    return shape[1]
+
+
+# are all the edges of the polygon horizontal or vertical
+def rectilinear(points):
+    return all(a[0] == b[0] or a[1] == b[1]
+               for a, b in zip(points, points[1:] + points[:1]))
+
+
+# the outline(s) of the union of rectilinear polygons.  the plane is split into
+# cells on every x and y used by the polygons, the cells inside any polygon are
+# filled and the edges between filled and empty cells are chained into closed
+# counter clockwise loops.
+def union(polygons):
+    xs = sorted(set(pt[0] for points in polygons for pt in points))
+    ys = sorted(set(pt[1] for points in polygons for pt in points))
+    filled = set()
+    for i in range(len(xs) - 1):
+        for j in range(len(ys) - 1):
+            c = ((xs[i] + xs[i+1]) / 2.0, (ys[j] + ys[j+1]) / 2.0)
+            if any(inside(c, points) for points in polygons):
+                filled.add((i, j))
+    edges = {}
+    for i, j in filled:
+        if (i, j-1) not in filled:
+            edges.setdefault((i, j), []).append((i+1, j))
+        if (i+1, j) not in filled:
+            edges.setdefault((i+1, j), []).append((i+1, j+1))
+        if (i, j+1) not in filled:
+            edges.setdefault((i+1, j+1), []).append((i, j+1))
+        if (i-1, j) not in filled:
+            edges.setdefault((i, j+1), []).append((i, j))
+    loops = []
+    while edges:
+        start = next(iter(edges))
+        loop = [start]
+        v = start
+        while True:
+            ends = edges[v]
+            nxt = ends.pop()
+            if not ends:
+                del edges[v]
+            if nxt == start:
+                break
+            loop.append(nxt)
+            v = nxt
+        # only keep the corners
+        corners = []
+        for k, (i, j) in enumerate(loop):
+            (pi, pj), (ni, nj) = loop[k-1], loop[(k+1) % len(loop)]
+            if not (pi == i == ni or pj == j == nj):
+                corners.append((xs[i], ys[j]))
+        loops.append(corners + corners[:1])
+    return loops
+
+
+# a flat drawing of a plate which stands in for the cadquery workplane used by
+# 'Plate'.  it supports the same calls the plate makes ('center', 'polyline',
+# 'circle', 'rect', 'hole' and 'cutThruAll') but only records the cutouts in
+# world coordinates instead of building a solid.  like the '<Z' workplane of
+# the plate, its y axis points down.
+class Sketch(object):
+    def __init__(self, width, height, fillet=0):
+        self.width = width
+        self.height = height
+        self.fillet = fillet
+        self.origin = (0.0, 0.0)  # the current center in world coordinates
+        self.pending = []  # drawn but not cut yet
+        self.cuts = []
+
+    def world(self, pt):
+        return (self.origin[0] + pt[0], self.origin[1] - pt[1])
+
+    def center(self, x, y):
+        self.origin = self.world((x, y))
+        return self
+
+    def polyline(self, points):
+        # rounded so edges which are straight on paper compare as straight
+        self.pending.append((POLYGON, [tuple(round(v, 6)
+                                             for v in self.world(pt))
+                                       for pt in points]))
+        return self
+
+    def circle(self, r):
+        self.pending.append((CIRCLE, self.origin, r))
+        return self
+
+    def rect(self, w, h):
+        return self.polyline([(w/2.0, h/2.0), (-w/2.0, h/2.0),
+                              (-w/2.0, -h/2.0), (w/2.0, -h/2.0),
+                              (w/2.0, h/2.0)])
+
+    # cut outlines given as arrays of points measured from the center of the
+    # plate, with the y axis pointing down like 'polyline'
+    def cut_polygons(self, outlines):
+        for points in outlines:
+            # adding 0.0 turns the -0.0 of the flipped axis into 0.0
+            world = numpy.round(points * (1, -1), 6) + 0.0
+            self.cut((POLYGON, [tuple(pt) for pt in world.tolist()]))
+        return self
+
+    def hole(self, d):
+        self.cut((CIRCLE, self.origin, d/2.0))
+        return self
+
+    def cutThruAll(self):
+        for shape in self.pending:
+            self.cut(shape)
+        self.pending = []
+        return self
+
+    # anything already cut which falls inside the new cutout is gone and
+    # overlapping rectilinear cutouts (a switch and its stabilizer) are merged
+    # into a single outline
+    def cut(self, shape):
+        if shape[0] == POLYGON:
+            box = bounds(shape)
+            self.cuts = [c for c in self.cuts
+                         if not (contains(box, bounds(c)) and
+                                 all(inside(pt, shape[1])
+                                     for pt in outline_points(c)))]
+            if rectilinear(shape[1]):
+                group = [c for c in self.cuts if c[0] == POLYGON and
+                         overlaps(box, bounds(c)) and rectilinear(c[1])]
+                if group:
+                    self.cuts = [c for c in self.cuts if c not in group]
+                    for points in union([shape[1]] +
+                                        [c[1] for c in group]):
+                        self.cuts.append((POLYGON, points))
+                    return
+        self.cuts.append(shape)
+
+    # the area of the plate left after the cutouts
+    def area(self):
+        w, h, f = self.width, self.height, max(self.fillet, 0)
+        area = w*h - (4 - math.pi)*f*f
+        for shape in self.cuts:
+            if shape[0] == CIRCLE:
+                area -= math.pi*shape[2]*shape[2]
+            else:
+                points = shape[1]
+                area -= abs(sum(a[0]*b[1] - b[0]*a[1] for a, b in
+                                zip(points, points[1:] + points[:1])))/2.0
+        return area
+
+    # the outline of the plate as (x, y, bulge) vertices, the bulge rounds
+    # the segment to the next vertex like a DXF polyline
+    def outline(self):
+        w, h, f = self.width/2.0, self.height/2.0, self.fillet
+        if f <= 0:
+            return [(w, -h, 0), (w, h, 0), (-w, h, 0), (-w, -h, 0)]
+        b = math.tan(math.radians(90)/4)  # a quarter circle
+        return [(w-f, -h, b), (w, -h+f, 0), (w, h-f, b), (w-f, h, 0),
+                (-w+f, h, b), (-w, h-f, 0), (-w, -h+f, b), (-w+f, -h, 0)]
+
+
+def write_dxf(sketch, f):
+    def entity(*codes):
+        for i in range(0, len(codes), 2):
+            f.write('%s\n%s\n' % (codes[i], codes[i+1]))
+
+    def polyline(vertices):
+        entity(0, 'POLYLINE', 8, 0, 66, 1, 70, 1)
+        for x, y, bulge in vertices:
+            entity(0, 'VERTEX', 8, 0, 10, repr(x), 20, repr(y))
+            if bulge:
+                entity(42, repr(bulge))
+        entity(0, 'SEQEND', 8, 0)
+
+    entity(0, 'SECTION', 2, 'HEADER', 9, '$ACADVER', 1, 'AC1009',
+           9, '$INSUNITS', 70, 4, 0, 'ENDSEC')
+    entity(0, 'SECTION', 2, 'ENTITIES')
+    polyline(sketch.outline())
+    for shape in sketch.cuts:
+        if shape[0] == CIRCLE:
+            entity(0, 'CIRCLE', 8, 0, 10, repr(shape[1][0]),
+                   20, repr(shape[1][1]), 40, repr(shape[2]))
+        else:
+            # the polylines are closed, so the repeated first point is dropped
+            points = shape[1]
+            if points[0] == points[-1]:
+                points = points[:-1]
+            polyline([(x, y, 0) for x, y in points])
+    entity(0, 'ENDSEC', 0, 'EOF')
+
+
+def write_svg(sketch, f):
+    w, h = sketch.width, sketch.height
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+            'width="%smm" height="%smm" viewBox="%s %s %s %s">\n' %
+            (w, h, -w/2.0, -h/2.0, w, h))
+    # svg has y pointing down, so everything is mirrored back
+    f.write('<g transform="scale(1,-1)" fill="none" stroke="black" '
+            'stroke-width="0.1">\n')
+    vertices = sketch.outline()
+    path = 'M %r %r' % vertices[-1][:2]
+    for i, (x, y, bulge) in enumerate(vertices):
+        if vertices[i-1][2]:
+            r = sketch.fillet
+            path += ' A %r %r 0 0 1 %r %r' % (r, r, x, y)
+        else:
+            path += ' L %r %r' % (x, y)
+    f.write('<path d="%s Z"/>\n' % path)
+    for shape in sketch.cuts:
+        if shape[0] == CIRCLE:
+            f.write('<circle cx="%r" cy="%r" r="%r"/>\n' %
+                    (shape[1][0], shape[1][1], shape[2]))
+        else:
+            f.write('<path d="M %s Z"/>\n' % ' L '.join(
+                '%r %r' % pt for pt in shape[1]))
+    f.write('</g>\n</svg>\n')
@@ -0,0 +1,254 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from lib import compress
+from lib import layers
+
+log = logging.getLogger()
+
+# eviction goes down to this share of the quota, so it does not run again on
+# the next build
+LOW_WATER = 0.9
+# the blanks (see 'blanks.BlankCache') are shared by the builds, each is in the
+# index on its own as BLANK + its file name
+BLANK = 'blank:'
+
+
+# remove the files a cancelled build was writing: the 'outputs' ((layer,
+# format) pairs) with their compressed copies and, when it was the first
+# build of 'data_hash', the layers it saved
+def remove_partial(config, cache, data_hash, outputs):
+    paths = [os.path.join(config['app']['export'], '%s_%s.%s%s' % (
+        label, data_hash, name, suffix)) for label, name in outputs
+        for suffix in ('',) + compress.SUFFIXES]
+    if not cache.load(data_hash):
+        paths.extend(layers.LayerStore(config, None, None).files(data_hash))
+    for path in paths:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                log.warning("Could not remove %s", path)
+
+
+# keeps the files of every build (the exports, the saved layers and the
+# manifest) and the blanks under 'config['app']['export_quota']' bytes.  the
+# size and the last access of each build and blank are kept in an SQLite index
+# and the least recently used are removed as a whole, so their next request is
+# simply a cache miss and is built again.  the server records its builds with
+# 'record_later', on a thread of the store.
+class ExportStore(object):
+    def __init__(self, config, cache):
+        self.export = config['app']['export']
+        self.blanks = config['app']['blanks']
+        self.quota = config['app']['export_quota']
+        self.path = config['app']['export_index']
+        self.cache = cache
+        self.layers = layers.LayerStore(config, None, None)
+        self.touched = {}  # data_hash -> last access not written yet
+        self.mutex = threading.Lock()  # guards 'touched' and 'known'
+        self.lock = threading.Lock()  # one eviction at a time
+        self.ready = threading.Condition(threading.Lock())
+        self.pending = []  # the (data_hash, keep) for 'record_later'
+        self.thread = None
+        self.evicted = 0
+        self.query('CREATE TABLE IF NOT EXISTS builds ('
+                   'hash TEXT PRIMARY KEY, bytes INTEGER NOT NULL, '
+                   'accessed REAL NOT NULL)')
+        # what is in the index, only those are touched
+        self.known = set(row[0] for row in self.query(
+            'SELECT hash FROM builds'))
+        self.total = self.usage()
+
+    # run a statement on a connection of its own, so the store can be used
+    # from the eviction thread too
+    def query(self, sql, args=()):
+        with contextlib.closing(sqlite3.connect(self.path,
+                                                timeout=30)) as db:
+            with db:
+                return db.execute(sql, args).fetchall()
+
+    def query_many(self, sql, rows):
+        with contextlib.closing(sqlite3.connect(self.path,
+                                                timeout=30)) as db:
+            with db:
+                db.executemany(sql, rows)
+
+    def usage(self):
+        return self.query('SELECT COALESCE(SUM(bytes), 0) FROM builds')[0][0]
+
+    # the exported files of every build, by hash.  exports are named
+    # '<layer>_<hash>.<format>', their compressed copies have a suffix.
+    def exports(self):
+        exports = {}
+        for name in os.listdir(self.export):
+            export = name
+            if name.endswith(compress.SUFFIXES):
+                export = name.rpartition('.')[0]
+            data_hash = export.partition('_')[2].rpartition('.')[0]
+            if data_hash:
+                exports.setdefault(data_hash, []).append(
+                    os.path.join(self.export, name))
+        return exports
+
+    # every file belonging to the build 'data_hash', the manifest first, or
+    # the file of a blank
+    def files(self, data_hash, exports=None):
+        if data_hash.startswith(BLANK):
+            path = os.path.join(self.blanks, data_hash[len(BLANK):])
+            return [path] if os.path.exists(path) else []
+        if exports is None:
+            exports = self.exports()
+        paths = [self.cache.manifest_path(data_hash)]
+        paths.extend(exports.get(data_hash, []))
+        paths.extend(self.layers.files(data_hash))
+        return [path for path in paths if os.path.exists(path)]
+
+    # add the build 'data_hash' to the index, or update its size
+    def record(self, data_hash, exports=None, accessed=None):
+        size = 0
+        for path in self.files(data_hash, exports):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        with self.mutex:
+            self.touched.pop(data_hash, None)
+            self.known.add(data_hash)
+        self.query('INSERT OR REPLACE INTO builds (hash, bytes, accessed) '
+                   'VALUES (?, ?, ?)',
+                   (data_hash, size, accessed or time.time()))
+        self.record_blanks()
+        self.total = self.usage()
+
+    # index the blanks the workers saved, and when they were last used.  a
+    # worker sets the time of a blank when it uses it.
+    def record_blanks(self):
+        rows = []
+        if not os.path.isdir(self.blanks):
+            return  # no blank was made yet
+        for name in os.listdir(self.blanks):
+            if not name.endswith('.brp'):
+                continue  # being written
+            try:
+                stat = os.stat(os.path.join(self.blanks, name))
+            except OSError:
+                continue
+            rows.append((BLANK + name, stat.st_size, stat.st_mtime))
+        self.query_many('INSERT OR REPLACE INTO builds (hash, bytes, '
+                        'accessed) VALUES (?, ?, ?)', rows)
+        with self.mutex:
+            self.known.update(row[0] for row in rows)
+
+    # record the build 'data_hash' and evict what is over the quota, apart
+    # from 'keep', on the thread of the store, so the caller never waits for
+    # the disk or the index
+    def record_later(self, data_hash, keep=()):
+        with self.ready:
+            self.pending.append((data_hash, keep))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='export-store')
+                self.thread.daemon = True
+                self.thread.start()
+            self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.pending:
+                    self.ready.wait()
+                data_hash, keep = self.pending.pop(0)
+            try:
+                self.record(data_hash)
+                self.evict(keep)
+            except Exception:
+                log.exception("Could not record %s", data_hash)
+
+    # a build was used, only written to the index before evicting.  what is
+    # not in the index is left out, anyone can ask for any hash.
+    def touch(self, data_hash):
+        with self.mutex:
+            if data_hash in self.known:
+                self.touched[data_hash] = time.time()
+
+    def flush(self):
+        with self.mutex:
+            touched, self.touched = self.touched, {}
+        self.query_many('UPDATE builds SET accessed = ? WHERE hash = ?',
+                        [(accessed, data_hash)
+                         for data_hash, accessed in touched.items()])
+
+    def over_quota(self):
+        return self.quota > 0 and self.total > self.quota
+
+    # remove the least recently used builds until the store is back under
+    # its quota.  the builds in 'keep' are being worked on and stay.
+    def evict(self, keep=()):
+        if not self.lock.acquire(False):
+            return  # already evicting
+        try:
+            self.flush()
+            self.total = self.usage()
+            if not self.over_quota():
+                return
+            target = self.quota*LOW_WATER
+            exports = self.exports()
+            for data_hash, size in self.query(
+                    'SELECT hash, bytes FROM builds ORDER BY accessed'):
+                if self.total <= target:
+                    break
+                if data_hash in keep:
+                    continue
+                self.remove(data_hash, exports)
+                self.total -= size
+                self.evicted += 1
+            log.info("Evicted builds, the exports now take %s bytes",
+                     self.total)
+        finally:
+            self.lock.release()
+
+    def remove(self, data_hash, exports=None):
+        for path in self.files(data_hash, exports):
+            try:
+                os.remove(path)
+            except OSError:
+                log.warning("Could not remove %s", path)
+        with self.mutex:
+            self.known.discard(data_hash)
+            self.touched.pop(data_hash, None)
+        self.query('DELETE FROM builds WHERE hash = ?', (data_hash,))
+
+    # index the builds which are on disk but not in the index yet, which were
+    # built before the store was used, and the blanks
+    def sync(self):
+        with self.mutex:
+            known = set(self.known)
+        exports = self.exports()
+        for name in os.listdir(self.cache.path):
+            data_hash, ext = os.path.splitext(name)
+            if ext == '.json' and data_hash not in known:
+                self.record(data_hash, exports, os.path.getmtime(
+                    os.path.join(self.cache.path, name)))
+        self.record_blanks()
+        self.total = self.usage()
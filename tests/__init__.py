@@ -0,0 +1,37 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import os
+import tempfile
+
+from config import config
+
+
+# a copy of the config with every directory it writes to in a new temporary
+# directory, which is returned too
+def temp_config():
+    tmp = tempfile.mkdtemp()
+    app = copy.deepcopy(config['app'])
+    app.update(pwd=tmp, static=os.path.join(tmp, 'static'),
+               export=os.path.join(tmp, 'static', 'exports'),
+               cache=os.path.join(tmp, 'cache'),
+               blanks=os.path.join(tmp, 'cache', 'blanks'),
+               layers=os.path.join(tmp, 'cache', 'layers'),
+               export_index=os.path.join(tmp, 'cache', 'exports.db'),
+               cost_model=os.path.join(tmp, 'cache', 'cost.json'))
+    os.makedirs(app['export'])
+    return dict(config, app=app), tmp
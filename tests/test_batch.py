@@ -0,0 +1,63 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import shutil
+import time
+import unittest
+
+from lib import batch
+from lib import builder
+from tests import temp_config
+
+LAYOUT = 'benchmarks/corpus/40.json'
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.config, self.tmp = temp_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, options):
+        jobs = batch.expand([LAYOUT], options, flat=True)
+        return batch.Batch(self.config, 2).run(jobs)
+
+    # the workers of 2d builds never import the CAD stack, which may not
+    # even be installed
+    def test_2d(self):
+        rows = self.run_batch({'kerf': [0, 0.1]})
+        self.assertEqual([row['state'] for row in rows], ['built', 'built'])
+
+    # the workers are forked, so they build with the stuck 'build'
+    def test_stuck_build_killed(self):
+        def stuck(*args, **kwargs):
+            time.sleep(60)
+        build = builder.build
+        builder.build = stuck
+        self.config['app'].update(build_timeout=0.2, cancel_grace=0.2)
+        try:
+            started = time.time()
+            rows = self.run_batch({})
+        finally:
+            builder.build = build
+        self.assertLess(time.time() - started, 30)
+        self.assertEqual(rows[0]['state'], 'failed')
+        self.assertIn('Timed out', rows[0]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import shutil
+import unittest
+
+from lib import builder
+from lib.blanks import BlankCache
+from lib.cache import ResultCache, digest
+from lib.layers import LayerStore
+from tests import temp_config
+
+DATA = {'layout': [[{'w': 1}]], 'formats': ['dxf', 'stl']}
+# KLE keys with no size, which parsing fills in
+LAYOUT = '[[{"x": 0.5}, "A", "B"], [{"w": 2}, "C", {"y": 0.25}, "D"]]'
+
+
+# a request for LAYOUT as it comes in, parsed from JSON
+def request(**options):
+    return dict(options, layout=json.loads(LAYOUT))
+
+
+# stands in for cadquery and for everything it makes: any attribute or call
+# gives the same object back, so a 3d build runs through 'Plate.draw'
+class FakeCAD(object):
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __neg__(self):
+        return self
+
+
+# stands in for the CAD stack in lib.builder for the length of a test: the
+# saved layers are read as text and 'export_shape' records what it was asked
+# to export
+class BuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.config, self.tmp = temp_config()
+        self.exported = []
+        self.saved = builder.export_shape, builder.blank_cache, \
+            builder.layer_store
+        builder.export_shape = self.export_shape
+        builder.blank_cache = object()
+        builder.layer_store = LayerStore(self.config, self.load, self.save)
+
+    def tearDown(self):
+        builder.export_shape, builder.blank_cache, builder.layer_store = \
+            self.saved
+        shutil.rmtree(self.tmp)
+
+    # a 3d build with the CAD stack faked, see 'FakeCAD'
+    def fake_cad(self):
+        cad = builder.cadquery, builder.cad_seconds, builder.fan_out
+        builder.cadquery, builder.cad_seconds = FakeCAD(), 0
+        builder.blank_cache = BlankCache(self.config, self.load, self.save)
+        self.config['app']['export_workers'] = 0
+
+        def restore():
+            builder.cadquery, builder.cad_seconds, builder.fan_out = cad
+        self.addCleanup(restore)
+
+    def load(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def save(self, solid, path):
+        with open(path, 'w') as f:
+            f.write('solid')
+
+    def export_shape(self, shape, label, data_hash, formats, config,
+                     report=None, check=None, tolerances=None):
+        self.exported.append((shape, label, formats, tolerances))
+        for name in formats:
+            report(name)
+        return [builder.export_url(label, data_hash, name, config)
+                for name in formats]
+
+    def save_layers(self, data):
+        builder.layer_store.put('h', 'blank', [], data)
+        with open(builder.layer_store.layer_path('h', 'brp', 'switch'),
+                  'w') as f:
+            f.write('switch layer')
+
+    def test_missing_formats_from_saved_layers(self):
+        self.save_layers(DATA)
+        progress = []
+        result = builder.build('h', DATA, self.config, formats=['stl'],
+                               progress=lambda *a: progress.append(a))
+        self.assertEqual(len(self.exported), 1)
+        shape, label, formats, tolerances = self.exported[0]
+        self.assertEqual((shape, label, formats),
+                         ('switch layer', 'switch', ['stl']))
+        self.assertIn('stl', tolerances)
+        self.assertEqual(result['plates'], ['switch'])
+        self.assertEqual([e['name'] for e in result['exports']['switch']],
+                         ['stl'])
+        self.assertEqual([e[:2] for e in result['timings']['exports']],
+                         [['switch', 'stl']])
+        self.assertEqual(progress,
+                         [('export', {'layer': 'switch', 'format': 'stl'})])
+
+
+    # the request is left as it was, so its next lookup is a hit
+    def test_build_then_lookup(self):
+        data = request(engine='2d', formats=['dxf'])
+        before = digest(data)
+        cache = ResultCache(self.config)
+        cache.put('h', data, builder.build('h', data, self.config))
+        self.assertEqual(digest(data), before)
+        for i in range(2):
+            result, missing = cache.lookup('h', data)
+            self.assertIsNotNone(result)
+            self.assertEqual(missing, [])
+
+    # the layers saved by 'Plate.draw' are found by the next build, which
+    # only exports the missing formats from them
+    def test_missing_formats_from_drawn_layers(self):
+        self.fake_cad()
+        builder.build('h', request(formats=['dxf']), self.config,
+                      formats=['dxf'])
+        self.assertEqual(len(self.exported), 1)
+        self.assertTrue(builder.layer_store.exportable(
+            'h', request(formats=['dxf']), ['stl']))
+        result = builder.build('h', request(formats=['stl']), self.config,
+                               formats=['stl'])
+        self.assertEqual(self.exported[1][:3], ('solid', 'switch', ['stl']))
+        self.assertIn('timings', result)
+        self.assertNotIn('width', result)  # nothing was drawn again
+
+
+    # the second build of the same blank loads it, also for a sandwich case
+    # whose holes are laid out while they are cut
+    def test_blank_cache(self):
+        self.fake_cad()
+        for case in [{}, {'case-type': 'sandwich', 'mount-holes-num': 12,
+                          'mount-holes-size': 3}]:
+            for i in range(2):
+                builder.build('h%s' % i, request(formats=['dxf'], **case),
+                              self.config, formats=['dxf'])
+        self.assertEqual((builder.blank_cache.misses,
+                          builder.blank_cache.hits), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
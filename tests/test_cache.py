@@ -0,0 +1,108 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import unittest
+
+from lib.cache import ResultCache, digest
+from lib.layers import LayerStore
+from tests import temp_config
+
+DATA = {'layout': [[{'w': 1}]], 'formats': ['dxf', 'stl']}
+
+
+class DigestTest(unittest.TestCase):
+    def test_digest(self):
+        self.assertEqual(digest(DATA), digest(dict(reversed(DATA.items()))))
+        # the base and the formats do not change what is built
+        self.assertEqual(digest(DATA), digest(dict(DATA, base='other')))
+        self.assertEqual(digest(DATA), digest(dict(DATA, formats=['svg'])))
+        self.assertNotEqual(digest(DATA), digest(dict(DATA, kerf=0.1)))
+        self.assertNotEqual(digest(DATA), digest(dict(DATA, layout=[[{}]])))
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.config, self.tmp = temp_config()
+        self.cache = ResultCache(self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    # the export of the 'label' layer as 'name', written to disk unless lazy
+    def export(self, label, name, lazy=False):
+        url = '/static/exports/%s_h.%s' % (label, name)
+        if lazy:
+            return {'name': name, 'url': url, 'lazy': True}
+        with open(self.cache.artifact_path(url), 'w') as f:
+            f.write(name)
+        return {'name': name, 'url': url}
+
+    def result(self, formats, exports):
+        return {'width': 10, 'height': 20, 'plates': ['switch'],
+                'formats': formats, 'exports': {'switch': exports}}
+
+    def names(self, result):
+        return [(e['name'], bool(e.get('lazy')))
+                for e in result['exports']['switch']]
+
+    def test_put_keeps_exported_over_lazy(self):
+        self.cache.put('h', DATA, self.result(
+            ['dxf', 'stl'], [self.export('switch', 'dxf'),
+                             self.export('switch', 'stl'),
+                             self.export('switch', 'brp', lazy=True)]))
+        os.remove(self.cache.artifact_path('/static/exports/switch_h.dxf'))
+        result, missing = self.cache.lookup('h', DATA)
+        self.assertEqual(missing, ['dxf'])
+        # the rebuild of the dxf offers stl and brp on demand again
+        merged = self.cache.put('h', DATA, {
+            'plates': ['switch'], 'formats': ['dxf'],
+            'exports': {'switch': [self.export('switch', 'dxf'),
+                                   self.export('switch', 'stl', lazy=True),
+                                   self.export('switch', 'brp', lazy=True)]}})
+        self.assertEqual(sorted(self.names(merged)), [
+            ('brp', True), ('dxf', False), ('stl', False)])
+        self.assertEqual(merged['width'], 10)  # kept from the first build
+        self.assertEqual(self.cache.lookup('h', DATA)[1], [])
+        self.assertFalse(self.cache.is_lazy('h', 'switch', 'stl'))
+        self.assertTrue(self.cache.is_lazy('h', 'switch', 'brp'))
+
+    def test_put_replaces_lost_export(self):
+        self.cache.put('h', DATA, self.result(
+            ['stl'], [self.export('switch', 'stl')]))
+        os.remove(self.cache.artifact_path('/static/exports/switch_h.stl'))
+        merged = self.cache.put('h', DATA, self.result(
+            ['dxf'], [self.export('switch', 'dxf'),
+                      self.export('switch', 'stl', lazy=True)]))
+        self.assertEqual(sorted(self.names(merged)), [
+            ('dxf', False), ('stl', True)])
+
+    def test_exportable(self):
+        layers = LayerStore(self.config, None, None)
+        self.assertFalse(layers.exportable('h', DATA, ['stl']))
+        layers.put('h', 'blank', [], DATA)
+        with open(layers.layer_path('h', 'brp', 'switch'), 'w') as f:
+            f.write('brep')
+        self.assertTrue(layers.exportable('h', DATA, ['stl']))
+        # the json describes the plate, which is not saved
+        self.assertFalse(layers.exportable('h', DATA, ['json']))
+        self.assertFalse(layers.exportable('h', dict(DATA, kerf=0.1),
+                                           ['stl']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from lib import bundle
+from lib import compress
+
+CONFIG = {'app': {'precompress': ['dxf', 'svg'], 'precompress_min_size': 100}}
+TEXT = b''.join(b'LINE\n%d\n' % i for i in range(2000))
+
+
+class CompressTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_gzip(self):
+        path = self.write('switch_h.dxf', TEXT)
+        compress.precompress(path, CONFIG)
+        self.assertIn(path + '.gz', compress.siblings(path))
+        with gzip.open(path + '.gz', 'rb') as gz:
+            self.assertEqual(gz.read(), TEXT)
+        # the same file always gives the same sibling
+        with open(path + '.gz', 'rb') as gz:
+            first = gz.read()
+        os.remove(path + '.gz')
+        compress.precompress(path, CONFIG)
+        with open(path + '.gz', 'rb') as gz:
+            self.assertEqual(gz.read(), first)
+
+    @unittest.skipUnless(compress.brotli, 'the brotli module is missing')
+    def test_brotli(self):
+        path = self.write('switch_h.svg', TEXT)
+        compress.precompress(path, CONFIG)
+        with open(path + '.br', 'rb') as br:
+            self.assertEqual(compress.brotli.decompress(br.read()), TEXT)
+
+    def test_skipped(self):
+        small = self.write('switch_h.svg', TEXT[:50])
+        other = self.write('switch_h.stl', TEXT)
+        noise = self.write('bottom_h.dxf', os.urandom(4096))
+        for path in (small, other, noise):
+            compress.precompress(path, CONFIG)
+            self.assertEqual(compress.siblings(path), [])
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['bottom_h.dxf', 'switch_h.stl', 'switch_h.svg'])
+
+    def test_accepted(self):
+        self.assertEqual(compress.accepted('gzip, deflate, br;q=1.0'),
+                         set(['gzip', 'deflate', 'br']))
+        self.assertEqual(compress.accepted('br;q=0, GZIP'), set(['gzip']))
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_zip(self):
+        files = {'switch_h.dxf': TEXT, 'switch_h.svg': TEXT[:50],
+                 'bottom_h.dxf': os.urandom(3000) + TEXT}
+        for name, data in files.items():
+            path = os.path.join(self.tmp, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            compress.precompress(path, CONFIG)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp,
+                                                    'switch_h.dxf.gz')))
+        result = {'plates': ['switch', 'bottom'], 'exports': {
+            'switch': [{'name': 'dxf', 'url': '/switch_h.dxf'},
+                       {'name': 'svg', 'url': '/switch_h.svg'},
+                       {'name': 'stl', 'url': '/switch_h.stl'}],  # not there
+            'bottom': [{'name': 'dxf', 'url': '/bottom_h.dxf'}]}}
+        members = bundle.members(
+            result, lambda url: os.path.join(self.tmp, url.lstrip('/')))
+        archive = io.BytesIO()
+        for chunk in bundle.zip_chunks(members):
+            archive.write(chunk)
+        archive = zipfile.ZipFile(archive)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(),
+                         ['switch.dxf', 'switch.svg', 'bottom.dxf'])
+        for name, label in (('switch_h.dxf', 'switch.dxf'),
+                            ('switch_h.svg', 'switch.svg'),
+                            ('bottom_h.dxf', 'bottom.dxf')):
+            self.assertEqual(archive.read(label), files[name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import unittest
+
+from lib import exporter
+
+# stands in for 'python -m lib.exporter': it talks a lot, answers each task
+# with the pid which exported it and fails or dies when the task asks it to
+FAKE = '''
+import json, os, sys
+print('importing the CAD stack')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+    task = json.loads(line)
+    if task['format'] == 'die':
+        os._exit(1)
+    sys.stdout.write('x' * 100000 + '\\n')
+    if task['format'] == 'bad':
+        message = {'error': 'ValueError: bad shape'}
+    else:
+        message = {'export': {'name': task['format'], 'pid': os.getpid()}}
+    sys.stdout.write('\\n%s%s\\n' % (sys.argv[1], json.dumps(message)))
+    sys.stdout.flush()
+'''
+
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        script = os.path.join(self.tmp, 'fake.py')
+        with open(script, 'w') as f:
+            f.write(FAKE)
+        self.reports = []
+        self.fan_out = exporter.FanOut(
+            2, lambda *report: self.reports.append(report[:2]),
+            [sys.executable, script, exporter.REPLY])
+
+    def tearDown(self):
+        for process in self.fan_out.processes:
+            process.kill()
+        shutil.rmtree(self.tmp)
+
+    def export(self, *formats):
+        for name in formats:
+            self.fan_out.submit({'label': 'switch', 'format': name})
+        return self.fan_out.wait()
+
+    def pids(self):
+        return set(process.process.pid for process in self.fan_out.processes)
+
+    def test_processes_are_kept(self):
+        exports = self.export('dxf', 'svg', 'stl', 'stp', 'brp')
+        self.assertEqual(sorted(task['format'] for task, export in exports),
+                         ['brp', 'dxf', 'stl', 'stp', 'svg'])
+        self.assertEqual(sorted(export['name'] for task, export in exports),
+                         ['brp', 'dxf', 'stl', 'stp', 'svg'])
+        self.assertEqual(len(self.reports), 5)
+        pids = self.pids()
+        self.assertEqual(len(pids), 2)
+        self.assertEqual(set(export['pid'] for task, export in exports), pids)
+        # the next build uses the same processes
+        self.export('dxf', 'svg')
+        self.assertEqual(self.pids(), pids)
+
+    def test_error(self):
+        with self.assertRaises(exporter.ExportError) as raised:
+            self.export('bad')
+        self.assertIn('ValueError: bad shape', str(raised.exception))
+        # the process is still good for the next export
+        pids = self.pids()
+        self.assertEqual(len(self.export('dxf')), 1)
+        self.assertEqual(self.pids(), pids)
+
+    def test_died(self):
+        with self.assertRaises(exporter.ExportError) as raised:
+            self.export('die')
+        self.assertIn('Exporting switch as die failed', str(raised.exception))
+        self.assertEqual(self.fan_out.processes, [])
+        self.assertEqual(len(self.export('dxf')), 1)
+
+
+    # closing waits for the processes, so their memory is in the usage of
+    # the children (what the benchmarks report)
+    def test_close(self):
+        self.export('dxf', 'svg')
+        processes = [process.process for process in self.fan_out.processes]
+        self.fan_out.close()
+        self.assertEqual(self.fan_out.processes, [])
+        self.assertEqual([process.returncode for process in processes],
+                         [0, 0])
+        self.assertGreater(resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import unittest
+
+try:
+    import tornado.gen
+    import tornado.testing
+except ImportError:
+    tornado = None
+
+from lib import pool
+from lib.cache import ResultCache
+from tests import temp_config
+
+if tornado:
+    from lib import builder
+    from lib import jobs
+    TestCase = tornado.testing.AsyncTestCase
+else:
+    TestCase = unittest.TestCase
+
+LAYOUT = [[{'w': 1}]]
+
+
+# takes the jobs of a JobManager and finishes them when the test says so
+class FakePool(object):
+    size = 4
+    retired = 0
+    died = 0
+
+    def __init__(self):
+        self.submitted = []  # (job id, data hash, data, callback, options)
+
+    def submit(self, job_id, data_hash, data, callback, **options):
+        self.submitted.append((job_id, data_hash, data, callback, options))
+
+    def cancel(self, job_id):
+        pass
+
+    def worker_stats(self):
+        return []
+
+    def pids(self):
+        return []
+
+
+@unittest.skipUnless(tornado, 'tornado is missing')
+class JobsTest(TestCase):
+    def setUp(self):
+        super(JobsTest, self).setUp()
+        self.config, self.tmp = temp_config()
+        self.config['app'].update(client_jobs=0, max_cost=0)
+        self.pool = FakePool()
+        self.jobs = jobs.JobManager(self.pool, ResultCache(self.config),
+                                    self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super(JobsTest, self).tearDown()
+
+    # let the IOLoop run the callbacks of the pool
+    def settle(self):
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.01))
+
+    # the result of a build of 'data', with its 'formats' written to disk
+    def built(self, data_hash, formats):
+        exports = []
+        for name in formats:
+            url = '/static/exports/switch_%s.%s' % (data_hash, name)
+            with open(os.path.join(self.tmp, url.lstrip('/')), 'w') as f:
+                f.write(name)
+            exports.append({'name': name, 'url': url})
+        return {'width': 1, 'height': 1, 'plates': ['switch'],
+                'has_layers': False, 'formats': formats,
+                'exports': {'switch': exports}}
+
+    # finish the 'i'th job handed to the pool
+    def finish(self, i, formats):
+        job_id, data_hash, data, callback, options = self.pool.submitted[i]
+        callback(pool.STARTED, 1)
+        callback(pool.DONE, self.built(data_hash, formats))
+        self.settle()
+
+    def names(self, job):
+        return sorted(e['name'] for e in job.result['exports']['switch'])
+
+    def test_join_only_with_the_formats(self):
+        a = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']})
+        b = self.jobs.submit('h', {'layout': LAYOUT,
+                                   'formats': ['dxf', 'svg']})
+        c = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['svg']})
+        self.assertIsNot(a, b)
+        self.assertIs(b, c)  # the svg comes with b
+        self.assertIs(self.jobs.submit('h', {'layout': LAYOUT,
+                                             'formats': ['dxf']}), b)
+        # b waits for a rather than exporting the dxf at the same time
+        self.assertEqual(len(self.pool.submitted), 1)
+        self.finish(0, ['dxf'])
+        self.assertEqual(a.state, jobs.DONE)
+        self.assertEqual(self.names(a), ['dxf'])
+        self.assertEqual(len(self.pool.submitted), 2)
+        self.assertEqual(self.pool.submitted[1][4]['formats'], ['svg'])
+        self.finish(1, ['svg'])
+        self.assertEqual(b.state, jobs.DONE)
+        self.assertEqual(self.names(b), ['dxf', 'svg'])
+
+    def test_follower_from_cache(self):
+        a = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']})
+        b = self.jobs.submit('h', {'layout': LAYOUT,
+                                   'formats': ['dxf', 'svg']})
+        self.finish(0, ['dxf', 'svg'])  # a happened to export both
+        self.assertEqual(len(self.pool.submitted), 1)
+        self.assertEqual(b.state, jobs.DONE)
+        self.assertTrue(b.cached)
+        self.assertNotIn('h', self.jobs.building)
+
+    def test_follower_cancelled(self):
+        self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']})
+        b = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['svg']})
+        future = self.jobs.wait(b)
+        self.jobs.leave(b)
+        self.assertEqual(b.state, jobs.CANCELLED)
+        self.assertRaises(pool.BuildError, future.result)
+        self.finish(0, ['dxf'])
+        self.assertEqual(len(self.pool.submitted), 1)
+        self.assertNotIn('h', self.jobs.building)
+
+    # the build a cancelled follower waited for still owns the hash, a new
+    # request joins it rather than building it a second time
+    def test_cancelled_follower_leaves_the_build(self):
+        a = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']})
+        b = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['svg']})
+        self.jobs.cancel(b, 'Cancelled')
+        self.assertEqual(b.state, jobs.CANCELLED)
+        self.assertIs(self.jobs.building['h'], a)
+        c = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']})
+        self.assertIs(c, a)
+        self.assertEqual(len(self.pool.submitted), 1)
+        self.finish(0, ['dxf'])
+        self.assertEqual(a.state, jobs.DONE)
+        self.assertNotIn('h', self.jobs.building)
+
+    def test_profile_not_cached(self):
+        job = self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']},
+                               profile=True)
+        self.assertTrue(self.pool.submitted[0][4]['profile'])
+        result = self.built('h-profile', ['dxf'])
+        result['profile'] = {'top': []}
+        callback = self.pool.submitted[0][3]
+        callback(pool.STARTED, 1)
+        callback(pool.DONE, result)
+        self.settle()
+        self.assertEqual(job.state, jobs.DONE)
+        self.assertIn('profile', job.result)
+        self.assertIsNone(self.jobs.cache.load('h'))
+        # the next request is built, not served the profiled build
+        self.jobs.submit('h', {'layout': LAYOUT, 'formats': ['dxf']})
+        self.assertEqual(len(self.pool.submitted), 2)
+
+    # an export left for its first download is made by 'export_layer' in a
+    # worker, from the saved layer, with the tolerance of the request
+    def test_lazy_export(self):
+        data = {'layout': LAYOUT, 'formats': ['dxf'], 'mesh_tolerance': 0.05}
+        self.jobs.submit('h', data)
+        result = self.built('h', ['dxf'])
+        result['exports']['switch'].append(dict(builder.export_url(
+            'switch', 'h', 'stl', self.config), lazy=True))
+        callback = self.pool.submitted[0][3]
+        callback(pool.STARTED, 1)
+        callback(pool.DONE, result)
+        self.settle()
+        job = self.jobs.export('h', 'switch', 'stl')
+        self.assertIsNotNone(job)
+        self.assertIs(self.jobs.export('h', 'switch', 'stl'), job)
+        job_id, data_hash, data, callback, options = self.pool.submitted[1]
+        self.assertEqual(data, {'mesh_tolerance': 0.05})
+        exported = []
+
+        def export_shape(shape, label, data_hash, formats, config,
+                         report=None, check=None, tolerances=None):
+            exported.append((shape, tolerances))
+            return [builder.export_url(label, data_hash, name, config)
+                    for name in formats]
+        saved = builder.export_shape, builder.layer_store
+        builder.export_shape = export_shape
+        builder.layer_store = FakeLayers()
+        try:
+            # what a worker of the pool does with the job, see 'pool.work'
+            options.pop('timeout', None)
+            target = getattr(builder, options.pop('target'))
+            export = target(data_hash, data, self.config, **options)
+        finally:
+            builder.export_shape, builder.layer_store = saved
+        self.assertEqual(exported[0][0], 'switch layer')
+        self.assertEqual(exported[0][1]['stl'][0], 0.05)
+        callback(pool.STARTED, 1)
+        callback(pool.DONE, export)
+        self.settle()
+        self.assertEqual(job.state, jobs.DONE)
+        self.assertFalse(self.jobs.cache.is_lazy('h', 'switch', 'stl'))
+
+    def test_tolerances_without_data(self):
+        self.assertEqual(builder.mesh.tolerances(None, self.config),
+                         builder.mesh.tolerances({}, self.config))
+
+
+# the layers a build saved, without the CAD stack
+class FakeLayers(object):
+    def load_layer(self, data_hash, label):
+        return '%s layer' % label
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import math
+import unittest
+
+from benchmarks.__main__ import load_corpus
+from lib import placement
+from lib import planner
+from lib import profiles
+
+# the keys are placed with NumPy from cumulative sums, the loop this replaced
+# moved the plate from key to key.  the floating point operations are not done
+# in the same order, so the positions are not bit for bit the same (up to
+# 5e-7 mm apart in the exports), which is far below what any cutter can do.
+TOLERANCE = 1e-6  # mm
+
+
+# the key centers as the loop which walked the plate from key to key had
+# them: every move added to the current center, starting at the top left
+# corner of the plate
+def walk_centers(plate):
+    u1 = plate.u1
+    origin = [-plate.width/2 + plate.kerf, -plate.height/2 + plate.kerf]
+
+    def center(x, y):
+        origin[0] += x
+        origin[1] += y
+    centers = []
+    x_off = 0
+    prev_width = None
+    prev_y_off = 0
+    for r, row in enumerate(plate.layout):
+        for k, key in enumerate(row):
+            x, y, kx = 0, 0, 0
+            if 'x' in key:
+                x = key['x']*u1
+                kx = x
+            if 'y' in key and k == 0:
+                y = key['y']*u1
+            if r == 0 and k == 0:
+                center(key['w']*u1/2, u1/2)
+                x += plate.x_pad
+                y += plate.y_pad
+                x_off = -(x - (u1/2 + key['w']*u1/2) - kx)
+            elif k == 0:
+                center(-x_off, u1)
+                x_off = 0
+                x += u1/2 + key['w']*u1/2
+            else:
+                x += prev_width*u1/2 + key['w']*u1/2
+            if prev_y_off != 0:
+                y += -prev_y_off
+                prev_y_off = 0
+            if 'h' in key and key['h'] > 1:
+                prev_y_off = key['h']*u1/2 - u1/2
+                y += prev_y_off
+            center(x, y)
+            centers.append(tuple(origin))
+            x_off += x
+            prev_width = key['w']
+    return centers
+
+
+# the poker holes as the loop which moved to each of them and back had them
+def walk_holes(points):
+    origin = [0.0, 0.0]
+    holes = []
+    for c in points:
+        origin[0] += c[0]
+        origin[1] += c[1]
+        holes.append(tuple(origin))
+        origin[0] -= c[0]
+        origin[1] -= c[1]
+    return holes
+
+
+# the rotation of the points one at a time
+def rotate(points, r, a=(0, 0)):
+    cos = math.cos(math.radians(r))
+    sin = math.sin(math.radians(r))
+    return [(cos*(x-a[0]) - sin*(y-a[1]) + a[0],
+             sin*(x-a[0]) + cos*(y-a[1]) + a[1]) for x, y in points]
+
+
+class PlacementTest(unittest.TestCase):
+    def plates(self):
+        for name, data in load_corpus().items():
+            for case in ('', 'poker', 'sandwich'):
+                data = dict(data, **{'case-type': case})
+                plate = planner.configure(planner.PlatePlan(), data)
+                plate.parse_layout(data['layout'])
+                yield '%s %s' % (name, case), plate
+
+    def assertClose(self, name, found, expected):
+        self.assertEqual(len(found), len(expected), name)
+        for a, b in zip(found, expected):
+            self.assertEqual(len(a), len(b), name)
+            for u, v in zip(a, b):
+                self.assertLess(abs(u - v), TOLERANCE, '%s: %s != %s' % (
+                    name, a, b))
+
+    def test_centers(self):
+        for name, plate in self.plates():
+            self.assertClose(name, plate.key_centers().tolist(),
+                             walk_centers(plate))
+
+    # the switch and stabilizer outlines of every key
+    def test_outlines(self):
+        for name, plate in self.plates():
+            keys = [key for row in plate.layout for key in row]
+            cuts = [(plate.key_profiles(key), tuple(c))
+                    for key, c in zip(keys, plate.key_centers())]
+            expected = [[(c[0] + x, c[1] + y) for x, y in profile.points]
+                        for key, c in zip(keys, walk_centers(plate))
+                        for profile in plate.key_profiles(key)]
+            found = placement.outlines(cuts)
+            self.assertEqual(len(found), len(expected), name)
+            for a, b in zip(found, expected):
+                self.assertClose(name, a.tolist(), b)
+
+    def test_rotate(self):
+        for t in range(4):
+            points = profiles.switch_points(t, 0.1, 0, 0)
+            for r in (90, -15, 30.5, 180):
+                for a in ((0, 0), (1.5, -2)):
+                    self.assertClose('switch %s %s' % (t, r),
+                                     profiles.rotate(points, r, a),
+                                     rotate(points, r, a))
+
+    def test_holes(self):
+        for name, plate in self.plates():
+            holes = [tuple(hole['center']) for hole in plate.plan()['holes']]
+            if plate.case['type'] == 'poker':
+                expected = walk_holes(planner.POKER_HOLES)
+            elif plate.case['type'] == 'sandwich':
+                expected = plate.sandwich_holes()
+            else:
+                expected = []
+            # the plan measures from the top left corner
+            expected = [(x + plate.width/2, y + plate.height/2)
+                        for x, y in expected]
+            self.assertClose(name, holes, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+import unittest
+
+import lib
+from lib import metrics
+from lib import pool
+
+
+# a lib.builder without the CAD stack, the workers fork with it.  a build
+# exits the worker when asked to, reports progress for ever when 'chatty', or
+# sleeps for 'seconds'.
+def fake_builder():
+    builder = types.ModuleType('lib.builder')
+    builder.load_cad = lambda: None
+
+    def build(data_hash, data, config, progress=None, check=None, **options):
+        if data.get('exit') is not None:
+            os._exit(data['exit'])
+        while data.get('chatty'):
+            progress('chatty', {'padding': 'x'*64*1024})
+        started = time.time()
+        while time.time() - started < data.get('seconds', 0):
+            if check and not data.get('stuck'):
+                check()
+            time.sleep(0.05)
+        return {'hash': data_hash, 'pid': os.getpid()}
+    builder.build = build
+    return builder
+
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.builder = sys.modules.get('lib.builder')
+        sys.modules['lib.builder'] = lib.builder = fake_builder()
+        self.config = {'app': {'workers': 1, 'worker_max_builds': 0,
+                               'worker_max_rss': 0, 'export_workers': 8}}
+        self.pool = pool.BuildPool(self.config)
+        self.pool.start()
+        self.events = {}
+        self.finished = threading.Condition()
+
+    def tearDown(self):
+        self.pool.stop()
+        if self.builder:
+            sys.modules['lib.builder'] = lib.builder = self.builder
+        else:
+            del sys.modules['lib.builder']
+            del lib.builder
+
+    def submit(self, job_id, data, **options):
+        def callback(event, payload):
+            with self.finished:
+                self.events.setdefault(job_id, []).append((event, payload))
+                self.finished.notify()
+        self.pool.submit(job_id, job_id, data, callback, **options)
+
+    # the (event, payload) the job 'job_id' finished with
+    def result(self, job_id, timeout=10):
+        deadline = time.time() + timeout
+        with self.finished:
+            while True:
+                events = self.events.get(job_id, [])
+                if events and events[-1][0] in (pool.DONE, pool.ERROR,
+                                                pool.CANCELLED):
+                    return events[-1]
+                if time.time() > deadline:
+                    self.fail('job %s did not finish' % job_id)
+                self.finished.wait(0.1)
+
+    def test_build(self):
+        self.submit('a', {})
+        event, payload = self.result('a')
+        self.assertEqual(event, pool.DONE)
+        self.assertEqual(payload['hash'], 'a')
+
+    def test_dead_worker(self):
+        self.submit('a', {'exit': 3})
+        self.submit('b', {})
+        event, payload = self.result('a')
+        self.assertEqual(event, pool.ERROR)
+        self.assertIn('exit code 3', payload)
+        # a new worker took its place and the next job still runs
+        self.assertEqual(self.result('b')[0], pool.DONE)
+        self.assertEqual(self.pool.died, 1)
+        self.assertEqual(len(self.pool.pids()), 1)
+        self.assertEqual(self.pool.running, {})
+
+    def test_cancel(self):
+        self.submit('a', {'seconds': 5})
+        self.submit('b', {})
+        self.pool.cancel('b')  # still waiting for the worker
+        self.assertEqual(self.result('b'), (pool.CANCELLED, 'Cancelled'))
+        self.pool.cancel('a')
+        self.assertEqual(self.result('a'), (pool.CANCELLED, 'Cancelled'))
+
+    def test_kill(self):
+        self.submit('a', {'seconds': 30, 'stuck': True})
+        while 'a' not in self.events:
+            time.sleep(0.05)
+        pid = self.pool.pids()[0]
+        self.pool.kill('a', 'Stuck')
+        self.assertEqual(self.result('a'), (pool.CANCELLED, 'Stuck'))
+        self.submit('b', {})
+        event, payload = self.result('b')
+        self.assertEqual(event, pool.DONE)
+        self.assertNotEqual(payload['pid'], pid)
+        self.assertEqual(self.pool.died, 0)
+
+    # each worker has a pipe of its own, so killing one in the middle of a
+    # message does not garble what the others send
+    def test_kill_while_sending(self):
+        self.pool.stop()
+        self.pool = pool.BuildPool(self.config, 2)
+        self.pool.start()
+        self.submit('a', {'chatty': True})
+        self.submit('b', {'seconds': 1})
+        while len(self.events.get('a', [])) < 10:
+            time.sleep(0.01)
+        self.pool.kill('a', 'Stuck')
+        self.assertEqual(self.result('a'), (pool.CANCELLED, 'Stuck'))
+        self.assertEqual(self.result('b')[0], pool.DONE)
+        self.submit('c', {})
+        self.assertEqual(self.result('c')[0], pool.DONE)
+
+
+    # all the export processes of the workers are about one per CPU
+    def test_export_workers(self):
+        export_workers = self.pool.config['app']['export_workers']
+        self.assertEqual(export_workers,
+                         min(8, multiprocessing.cpu_count()))
+        self.assertEqual(self.config['app']['export_workers'], 8)
+        size = multiprocessing.cpu_count() * 2
+        self.assertEqual(pool.BuildPool(self.config, size).config['app'][
+            'export_workers'], 1)
+
+    # the memory of a worker counts its export processes
+    @unittest.skipUnless(os.path.isdir('/proc'), '/proc is missing')
+    def test_memory(self):
+        child = subprocess.Popen([sys.executable, '-c',
+                                  'import time; time.sleep(30)'])
+        try:
+            deadline = time.time() + 5
+            while child.pid not in pool.children(os.getpid()) and \
+                    time.time() < deadline:
+                time.sleep(0.05)
+            self.assertGreater(pool.memory(os.getpid()),
+                               metrics.rss(os.getpid()))
+        finally:
+            child.kill()
+            child.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from lib import profiles
+
+
+class ProfilesTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = profiles.profiles.copy(), profiles.MAX_PROFILES
+        profiles.profiles.clear()
+        profiles.MAX_PROFILES = 4
+
+    def tearDown(self):
+        profiles.profiles.clear()
+        profiles.profiles.update(self.saved[0])
+        profiles.MAX_PROFILES = self.saved[1]
+
+    def test_shared(self):
+        first = profiles.switch(1, 0.1, 0, 0)
+        self.assertIs(profiles.switch(1, 0.1, 0, 0), first)
+        self.assertIsNot(profiles.switch(1, 0.1, 0, 0, rotate_90=True),
+                         first)
+
+    def test_bounded(self):
+        first = profiles.switch(1, 0, 0, 0)
+        for i in range(1, 10):
+            profiles.switch(1, 0.01*i, 0, 0)
+            profiles.switch(1, 0, 0, 0)  # used all along, so it stays
+        self.assertEqual(len(profiles.profiles), 4)
+        self.assertIs(profiles.switch(1, 0, 0, 0), first)
+        self.assertNotIn(('switch', 1, 0.01, 0, 0, False, None),
+                         profiles.profiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from lib import sketch
+
+
+# the area inside the closed polygon 'points'
+def area(points):
+    return abs(sum(a[0]*b[1] - b[0]*a[1]
+                   for a, b in zip(points, points[1:] + points[:1])))/2.0
+
+
+def rect(x0, y0, x1, y1):
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+
+
+class UnionTest(unittest.TestCase):
+    def test_overlapping(self):
+        loops = sketch.union([rect(0, 0, 4, 2), rect(2, 1, 6, 3)])
+        self.assertEqual(len(loops), 1)
+        loop = loops[0]
+        self.assertEqual(loop[0], loop[-1])  # closed
+        self.assertEqual(len(loop), 9)  # 8 corners
+        self.assertEqual(area(loop[:-1]), 4*2 + 4*2 - 2*1)
+        self.assertEqual(set(loop), set([(0, 0), (4, 0), (4, 1), (6, 1),
+                                         (6, 3), (2, 3), (2, 2), (0, 2)]))
+
+    def test_cross(self):
+        # a switch opening with a stabilizer slot across it
+        loops = sketch.union([rect(-7, -7, 7, 7), rect(-12, -2, 12, 2)])
+        self.assertEqual(len(loops), 1)
+        self.assertEqual(len(loops[0]) - 1, 12)
+        self.assertEqual(area(loops[0][:-1]), 14*14 + 2*5*4)
+
+    def test_apart(self):
+        loops = sketch.union([rect(0, 0, 1, 1), rect(2, 0, 3, 1)])
+        self.assertEqual(sorted(area(loop[:-1]) for loop in loops), [1, 1])
+
+    def test_contained(self):
+        loops = sketch.union([rect(0, 0, 10, 10), rect(2, 2, 4, 4)])
+        self.assertEqual(len(loops), 1)
+        self.assertEqual(set(loops[0]),
+                         set([(0, 0), (10, 0), (10, 10), (0, 10)]))
+
+
+class SketchTest(unittest.TestCase):
+    def test_cut_merges_rectilinear(self):
+        s = sketch.Sketch(100, 50)
+        s.rect(14, 14).rect(24, 4).cutThruAll()
+        self.assertEqual(len(s.cuts), 1)
+        self.assertEqual(s.area(), 100*50 - (14*14 + 2*5*4))
+
+    def test_cut_keeps_apart_and_circles(self):
+        s = sketch.Sketch(100, 50)
+        s.rect(10, 10).cutThruAll()
+        s.center(30, 0).rect(10, 10).cutThruAll()
+        s.center(-60, 0).hole(4)
+        self.assertEqual([c[0] for c in s.cuts],
+                         [sketch.POLYGON, sketch.POLYGON, sketch.CIRCLE])
+
+    def test_cut_drops_what_is_inside(self):
+        s = sketch.Sketch(100, 50)
+        s.hole(2)
+        s.rect(4, 2).cutThruAll()
+        s.rect(20, 20).cutThruAll()
+        self.assertEqual(len(s.cuts), 1)
+        self.assertEqual(s.area(), 100*50 - 20*20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# kb_builder builts keyboard plate and case CAD files using JSON input.
+#
+# Copyright (C) 2015  Will Stevens (swill)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import time
+import unittest
+
+from lib.cache import ResultCache
+from lib.store import BLANK, ExportStore
+from tests import temp_config
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.config, self.tmp = temp_config()
+        self.cache = ResultCache(self.config)
+        self.store = ExportStore(self.config, self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, size):
+        with open(path, 'wb') as f:
+            f.write(b'x'*size)
+
+    def export(self, data_hash, size):
+        self.write(os.path.join(self.config['app']['export'],
+                                'switch_%s.dxf' % data_hash), size)
+
+    def blank(self, name, size, accessed):
+        if not os.path.isdir(self.config['app']['blanks']):
+            os.makedirs(self.config['app']['blanks'])
+        path = os.path.join(self.config['app']['blanks'], name + '.brp')
+        self.write(path, size)
+        os.utime(path, (accessed, accessed))
+        return path
+
+    def test_blanks_counted_and_evicted(self):
+        old = self.blank('old', 600, time.time() - 100)
+        self.blank('new', 100, time.time())
+        self.export('h', 100)
+        self.store.record('h')
+        self.assertEqual(self.store.total, 800)
+        self.assertIn(BLANK + 'old.brp', self.store.known)
+        self.store.quota = 500
+        self.store.evict()
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(self.store.total, 200)
+        self.assertEqual(self.store.evicted, 1)
+
+    def test_touch_only_known(self):
+        self.store.touch('unknown')
+        self.assertEqual(self.store.touched, {})
+        self.export('h', 10)
+        self.store.record('h')
+        self.store.touch('h')
+        self.assertIn('h', self.store.touched)
+        self.store.flush()
+        self.assertEqual(self.store.touched, {})
+
+    def test_record_later(self):
+        self.export('h', 10)
+        self.store.record_later('h')
+        deadline = time.time() + 5
+        while self.store.total != 10 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.store.total, 10)
+        self.assertIn('h', self.store.known)
+
+
+if __name__ == '__main__':
+    unittest.main()